@@ -0,0 +1,376 @@
+"""
+Benchmark the extractor, embedding views, the FAISS index and the /query/ and
+/upload/ endpoints.
+
+Everything runs on local stand-ins: SQLite instead of Postgres, moto instead
+of S3, and synthetic images and vectors. The app runs in-process and is driven
+through httpx's ASGI transport. Results are written as JSON so two runs can be
+compared:
+
+    pip install moto
+    python benchmark.py --out bench-before.json
+    python benchmark.py --out bench-after.json --compare bench-before.json
+
+All the usual settings (EXTRACT_BACKEND, INDEX_TYPE, EMBEDDING_*, ...) apply.
+The embedding cache is off unless --cache is given, so every request pays for
+decode and inference.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def percentiles(seconds):
+    """Latency summary in milliseconds."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {"count": 0}
+    return {
+        "count": int(len(ms)),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def synthetic_jpeg(rng, size=(800, 600)):
+    """A random JPEG of size, at a typical phone-photo compression level."""
+    from PIL import Image as PILImage
+    # Upscaled low-resolution noise compresses like a photo, unlike per-pixel noise
+    small = rng.integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+    image = PILImage.fromarray(small).resize(size, PILImage.BILINEAR)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def synthetic_vectors(rng, n, pipeline):
+    """Random search vectors in the pipeline's stored format."""
+    dim = pipeline.pca_dim or 2048
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    if pipeline.metric == "cosine":
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def seed_catalog(rng, pipeline, start, n, images_per_item=4):
+    """Bulk insert n synthetic Image rows (and their Items) after the first start rows."""
+    from sqlalchemy import insert
+    from src.db import Image, Item, session_scope
+    vectors = synthetic_vectors(rng, n, pipeline)
+    item_ids = sorted({f"bench-{(start + i) // images_per_item}" for i in range(n)})
+    with session_scope() as db:
+        known = {row.id for row in db.query(Item.id).filter(Item.id.in_(item_ids))}
+        new_items = [{"id": i, "name": i} for i in item_ids if i not in known]
+        if new_items:
+            db.execute(insert(Item), new_items)
+        for offset in range(0, n, 5000):
+            db.execute(insert(Image), [{
+                "item_id": f"bench-{(start + i) // images_per_item}",
+                "filename": f"{start + i}.jpg",
+                "s3_key": f"bench-{(start + i) // images_per_item}/{start + i}.jpg",
+                "vector": pipeline.encode(vectors[i]),
+                "embedding_version": pipeline.version,
+            } for i in range(offset, min(offset + 5000, n))])
+        db.commit()
+
+
+def bench_extract(extractor, images, batch_size):
+    """Per-image extract() latency, and throughput of one batched forward pass."""
+    extractor.extract(images[0])  # warm-up
+    single = []
+    for data in images:
+        start = time.perf_counter()
+        extractor.extract(data)
+        single.append(time.perf_counter() - start)
+    tensors = [extractor.preprocess(data) for data in images[:batch_size]]
+    start = time.perf_counter()
+    extractor.extract_batch(tensors)
+    batch_s = time.perf_counter() - start
+    return {
+        "backend": extractor.backend,
+        "extract": percentiles(single),
+        "batch_size": len(tensors),
+        "batch_images_per_s": len(tensors) / batch_s,
+    }
+
+
+def off_center(rng, data):
+    """Another photo of the same product: an off-center crop, rescaled and sometimes mirrored."""
+    from PIL import Image as PILImage
+    image = PILImage.open(io.BytesIO(data)).convert("RGB")
+    width, height = image.size
+    scale = rng.uniform(0.6, 0.85)
+    crop_w, crop_h = int(width * scale), int(height * scale)
+    x, y = int(rng.integers(0, width - crop_w + 1)), int(rng.integers(0, height - crop_h + 1))
+    image = image.crop((x, y, x + crop_w, y + crop_h)).resize((width, height), PILImage.BILINEAR)
+    if rng.random() < 0.5:
+        image = image.transpose(PILImage.FLIP_LEFT_RIGHT)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def bench_views(rng, extractor, images, view_sets, topk, batch_size):
+    """
+    Latency and recall of each set of embedding views. Every catalog image is
+    queried with an off-center crop of itself; recall@k is how often the
+    original comes back in the top k by L2 distance. The "full" view alone
+    (no TTA) is always measured first, and each other set reports its p50
+    latency cost and recall gain against it.
+    """
+    from src.embedding import parse_views
+    queries = [off_center(rng, data) for data in images]
+    results = []
+    for views in ["full"] + [v for v in view_sets if parse_views(v) != ("full",)]:
+        views_extractor = extractor.with_views(views)
+        catalog = np.concatenate([
+            views_extractor.extract_batch([views_extractor.preprocess(d) for d in images[i:i + batch_size]])
+            for i in range(0, len(images), batch_size)])
+        views_extractor.extract(queries[0])  # warm-up
+        tensor = views_extractor.preprocess(queries[0])
+        single, found = [], []
+        for data in queries:
+            start = time.perf_counter()
+            found.append(views_extractor.extract(data))
+            single.append(time.perf_counter() - start)
+        found = np.stack(found)
+        distances = (found ** 2).sum(1)[:, None] - 2 * found @ catalog.T + (catalog ** 2).sum(1)[None, :]
+        ranks = np.argsort(distances, axis=1)
+        truth = np.arange(len(images))[:, None]
+        results.append({
+            "views": "+".join(views_extractor.views),
+            "forward_images_per_query": tensor.shape[0] if tensor.dim() == 4 else 1,
+            "extract": percentiles(single),
+            "recall_at_1": float((ranks[:, :1] == truth).any(axis=1).mean()),
+            f"recall_at_{topk}": float((ranks[:, :topk] == truth).any(axis=1).mean()),
+        })
+        row, baseline = results[-1], results[0]
+        if row is not baseline:
+            row["vs_full"] = {
+                "p50_latency_x": row["extract"]["p50_ms"] / baseline["extract"]["p50_ms"],
+                "recall_at_1_gain": row["recall_at_1"] - baseline["recall_at_1"],
+                f"recall_at_{topk}_gain": row[f"recall_at_{topk}"] - baseline[f"recall_at_{topk}"],
+            }
+        print(f"  views {row['views']}: p50 {row['extract']['p50_ms']:.1f} ms"
+              + (f" ({row['vs_full']['p50_latency_x']:.2f}x full)" if "vs_full" in row else "")
+              + f", recall@1 {row['recall_at_1']:.3f}, recall@{topk} {row[f'recall_at_{topk}']:.3f}")
+    return results
+
+
+def bench_index(rng, pipeline, sizes, queries, topk, snapshot_path):
+    """Build, snapshot load and search latency of FaissIndexManager at each catalog size."""
+    from src.index_manager import FaissIndexManager
+    results = []
+    seeded = 0
+    for size in sorted(sizes):
+        seed_catalog(rng, pipeline, seeded, size - seeded)
+        seeded = size
+        manager = FaissIndexManager(pipeline)
+        start = time.perf_counter()
+        manager.build()
+        build_s = time.perf_counter() - start
+        manager.save_snapshot(snapshot_path)
+        start = time.perf_counter()
+        warm = FaissIndexManager(pipeline)
+        warm.warm_start(snapshot_path)
+        warm_start_s = time.perf_counter() - start
+
+        query_vecs = synthetic_vectors(rng, queries, pipeline)
+        search, search_items = [], []
+        for q in query_vecs:
+            start = time.perf_counter()
+            manager.search(q, topk)
+            search.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            manager.search_items(q, topk)
+            search_items.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        manager.search_batch(query_vecs, topk)
+        batch_s = time.perf_counter() - start
+        results.append({
+            "catalog_size": size,
+            "structure": manager.factory_string,
+            "build_s": build_s,
+            "warm_start_s": warm_start_s,
+            "search": percentiles(search),
+            "search_items": percentiles(search_items),
+            "search_batch_per_query_ms": batch_s * 1000 / len(query_vecs),
+        })
+        print(f"  index at {size} vectors: built in {build_s:.2f}s, "
+              f"search p50 {results[-1]['search']['p50_ms']:.2f} ms")
+    return results
+
+
+async def _load(client, make_request, n, concurrency):
+    """Issue n requests, at most concurrency at a time; returns latencies and status counts."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    wall = time.perf_counter() - start
+    return {**percentiles(latencies), "requests_per_s": n / wall,
+            "concurrency": concurrency, "status_codes": {str(k): v for k, v in sorted(statuses.items())}}
+
+
+async def bench_http(app, images, n, concurrency, topk):
+    """Concurrent /query/ then /upload/ load against the in-process app, one distinct image per request."""
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        async def query(client, i):
+            return await client.post("/query/", data={"topk": str(topk)},
+                                     files={"file": (f"q{i}.jpg", images[i + 1], "image/jpeg")})
+
+        async def upload(client, i):
+            return await client.post("/upload/", data={"item_id": f"upload-{i % 50}"},
+                                     files={"file": (f"u{i}.jpg", images[i + 1], "image/jpeg")})
+
+        await query(client, 0)  # warm-up
+        return {
+            "query": await _load(client, query, n, concurrency),
+            "upload": await _load(client, upload, n, concurrency),
+        }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    import torch
+    import faiss
+    settings = ("EXTRACT_BACKEND", "EXTRACT_MAX_BATCH_SIZE", "EXTRACT_MAX_WAIT_MS", "INDEX_TYPE",
+                "EMBEDDING_METRIC", "EMBEDDING_PCA_DIM", "EMBEDDING_DTYPE", "CPU_WORKERS", "IO_WORKERS",
+                "TORCH_NUM_THREADS", "EMBEDDING_CACHE_SIZE")
+    return {
+        "timestamp": time.time(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "faiss": faiss.__version__,
+        "cpu_count": os.cpu_count(),
+        "settings": {name: os.environ[name] for name in settings if name in os.environ},
+    }
+
+
+def compare(previous, current, path=""):
+    """Print p50/p95/p99 of every latency summary in current next to previous."""
+    if isinstance(current, list):
+        def key(row):
+            return row.get("catalog_size", row.get("views"))
+        previous = {key(row): row for row in previous or []}
+        for row in current:
+            compare(previous.get(key(row)), row, f"{path}[{key(row)}]")
+        return
+    if not isinstance(current, dict) or previous is None:
+        return
+    if "p50_ms" in current and "p50_ms" in previous:
+        cells = [f"{p} {previous[p]:.2f} -> {current[p]:.2f} ms ({current[p] / previous[p]:.2f}x)"
+                 for p in ("p50_ms", "p95_ms", "p99_ms") if previous.get(p)]
+        print(f"{path}: " + ", ".join(cells))
+        return
+    for key, value in current.items():
+        compare(previous.get(key), value, f"{path}.{key}" if path else key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extraction, embedding views, the index and the query/upload endpoints.")
+    parser.add_argument("--out", default="benchmark-results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Catalog sizes for the index benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="Search queries per catalog size")
+    parser.add_argument("--images", type=int, default=32, help="Synthetic images for the extraction benchmark")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint in the HTTP load test")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent HTTP requests")
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--cache", action="store_true", help="Keep the embedding cache on")
+    parser.add_argument("--workdir", help="Directory for the SQLite DB, snapshots and re-rank vectors (default: a temp dir)")
+    parser.add_argument("--views", nargs="+", default=["full", "full,flip", "full,center,corners,flip"],
+                        help="Sets of EMBEDDING_VIEWS to compare for latency and recall")
+    parser.add_argument("--view-catalog", type=int, default=100, help="Synthetic images in the views benchmark")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["extract", "views", "index", "http"])
+    parser.add_argument("--tta", action="store_true",
+                        help="Only run the views benchmark: TTA off (full) against each --views set")
+    args = parser.parse_args()
+    if args.tta:
+        args.skip = ["extract", "index", "http"]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="image-rec-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    # Local stand-ins, set before anything in src reads its configuration
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["INDEX_SNAPSHOT_PATH"] = os.path.join(workdir, "index.faiss")
+    os.environ["RERANK_VECTORS_PATH"] = os.path.join(workdir, "vectors.f32")
+    os.environ["S3_BUCKET"] = "benchmark"
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.pop("INDEX_SERVICE_SOCKET", None)
+    os.environ["STARTUP_MODE"] = "eager"
+    if not args.cache:
+        os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit("The benchmark stubs S3 with moto: pip install moto")
+    mock = mock_aws()
+    mock.start()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from src import storage
+    storage.s3_client.create_bucket(Bucket=storage.S3_BUCKET)
+
+    rng = np.random.default_rng(0)
+    # Distinct bytes for every request, so uploads never take the duplicate shortcut
+    images = [synthetic_jpeg(rng) for _ in range(max(args.images, args.requests + 1, args.view_catalog))]
+    start = time.perf_counter()
+    from src import app as api
+    results = {"environment": environment(), "startup_s": time.perf_counter() - start}
+    print(f"App started in {results['startup_s']:.1f}s, work files in {workdir}")
+    if "extract" not in args.skip:
+        print("Benchmarking feature extraction")
+        results["extract"] = bench_extract(api.extractor, images[:args.images], min(16, args.images))
+    if "views" not in args.skip:
+        print(f"Benchmarking embedding views on {args.view_catalog} images: {', '.join(args.views)}")
+        results["views"] = bench_views(rng, api.extractor, images[:args.view_catalog], args.views, args.topk,
+                                       min(16, args.view_catalog))
+    if "index" not in args.skip:
+        print("Benchmarking the index")
+        results["index"] = bench_index(rng, api.embedding_pipeline, args.sizes, args.queries, args.topk,
+                                       os.path.join(workdir, "bench-index.faiss"))
+    if "http" not in args.skip:
+        api.index_manager.build()  # pick up the seeded catalog
+        results["catalog_size"] = len(api.index_manager)
+        print(f"Load testing /query/ and /upload/ ({args.requests} requests each, "
+              f"concurrency {args.concurrency}, {results['catalog_size']} vectors)")
+        results["http"] = asyncio.run(bench_http(api.app, images, args.requests, args.concurrency, args.topk))
+    mock.stop()
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,49 @@ from fastapi import Body
 import os
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
-from fastapi import FastAPI, File, UploadFile, Form, Path, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, Path, Query, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import shutil
+from typing import List
+from datetime import datetime
+from sqlalchemy import func, tuple_
+import asyncio
+import base64
+import json
 import os
+import queue
+import threading
+import time
 import numpy as np
 
-from .feature_extractor import FeatureExtractor
-from .image_database_multi import ImageDatabaseMulti
-from .db import SessionLocal, Item, Image, Base, engine
+# torch, torchvision and faiss are imported by load_models(), not here, so the
+# health and listing endpoints don't wait on them
+from .image_database_multi import AGGREGATE_MODES
+from .attribute_index import parse_filters
+from .db import Item, Image, ensure_schema, get_db, run_db, pool_status, session_scope
 from sqlalchemy.orm import Session
-from .storage import upload_fileobj_to_s3, generate_presigned_url, delete_file_from_s3
+from .storage import upload_fileobj_to_s3, generate_presigned_url, delete_file_from_s3, presigned_url_cache
+from .index_service import IndexClient, ImageRef, INDEX_SERVICE_SOCKET
+from .embedding import RAW_VERSION
+from .batching import BatchScheduler
+from .embedding_cache import EmbeddingCache
+from .uploads import (UPLOAD_MAX_REQUEST_BYTES, DECODE_ERRORS, NOT_AN_IMAGE, EXTRACTION_FAILED, RequestSizeLimit,
+                      UploadTooLarge, scan_upload)
+from .ingest_queue import (INGEST_MODE, INGEST_WORKERS, INGEST_MAX_PENDING, PENDING, FAILED,
+                           IngestWorker, backlog, job_status)
+from .executors import run_io, run_cpu, cpu_executor, configure_torch_threads
+from . import executors
+from .metrics import STAGE_SECONDS, HTTP_REQUEST_SECONDS, GaugeFunc, render as render_metrics
+from .profiler import PROFILER_ENABLED, profiler
 
 app = FastAPI()
 
-# Create database tables on startup if they don't exist
-Base.metadata.create_all(bind=engine)
+# Create database tables (and any newly added columns) on startup if they don't exist
+ensure_schema()
+
+# Refuse oversized bodies before they are parsed, counting bytes when there is no Content-Length.
+# Added first so CORS and the latency middleware wrap it: a 413 carries CORS headers and is timed.
+app.add_middleware(RequestSizeLimit, max_bytes=UPLOAD_MAX_REQUEST_BYTES)
 
 # Add CORS middleware
 app.add_middleware(
@@ -31,11 +57,125 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template (/item/{item_id}), not the raw path, to keep series bounded
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                     route=route.path if route is not None else "unmatched", status=status)
+
 DATA_DIR = "data/images"
+# Largest page /items/ and /items/recent will return
+ITEMS_PAGE_MAX = int(os.getenv("ITEMS_PAGE_MAX", "500"))
+# Most files accepted by one /query/batch request
+QUERY_BATCH_MAX_FILES = int(os.getenv("QUERY_BATCH_MAX_FILES", "64"))
+# Most files accepted by one /items/{item_id}/images request
+ITEM_UPLOAD_MAX_FILES = int(os.getenv("ITEM_UPLOAD_MAX_FILES", "64"))
 FEATURES_PATH = "data/features_multi.npy"
+# "eager" loads the model and index before serving anything. "background" serves
+# /health and the listing endpoints at once and loads them on a thread;
+# GET /ready returns 200 once they are up.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "eager")
 
 os.makedirs(DATA_DIR, exist_ok=True)
-extractor = FeatureExtractor()
+# Repeated identical images are answered from the embedding cache
+embedding_cache = EmbeddingCache()
+# Uploads whose bytes were already stored: for the same item, or for another item (vector reused)
+upload_duplicates = {"same_item": 0, "vector_reused": 0}
+
+# Set by load_models()
+extractor = None
+batcher = None
+embedding_pipeline = None
+index_manager = None
+ingest_worker = None
+# meta_text updates made before index_manager was set, applied by load_models()
+pending_attributes = {}
+pending_attributes_lock = threading.Lock()
+startup_status = {"mode": STARTUP_MODE, "state": "pending", "error": None, "load_seconds": None}
+
+
+def _load_extractor():
+    from .feature_extractor import FeatureExtractor
+    configure_torch_threads()
+    return FeatureExtractor()
+
+def _load_index(pipeline):
+    if INDEX_SERVICE_SOCKET:
+        # Every worker shares the index served by src.index_service, which also owns its snapshot
+        manager = IndexClient(INDEX_SERVICE_SOCKET)
+        service_version = manager.stats()["embedding_version"]
+        if service_version != pipeline.version:
+            raise RuntimeError(f"Index service serves embedding version {service_version}, "
+                               f"this worker is configured for {pipeline.version}")
+        return manager
+    from .index_manager import FaissIndexManager
+    manager = FaissIndexManager(pipeline)
+    # Load the on-disk snapshot (memory-mapped) and catch up from the DB, or build from scratch
+    manager.warm_start()
+    return manager
+
+def load_models():
+    """Load the extractor and the FAISS index side by side, start the batcher and mark the app ready"""
+    global extractor, batcher, embedding_pipeline, index_manager, ingest_worker
+    from .embedding import EmbeddingPipeline
+    startup_status["state"] = "loading"
+    start = time.perf_counter()
+    try:
+        pipeline = EmbeddingPipeline()
+        loading_extractor = cpu_executor.submit(_load_extractor)
+        manager = _load_index(pipeline)
+        loaded_extractor = loading_extractor.result()
+        # Concurrent /query/ and /upload/ calls share batched forward passes
+        scheduler = BatchScheduler(loaded_extractor, decode_executor=cpu_executor, cache=embedding_cache)
+        scheduler.start()
+    except Exception as e:
+        startup_status.update(state="failed", error=f"{type(e).__name__}: {e}")
+        raise
+    with pending_attributes_lock:
+        for item_id, meta_text in pending_attributes.items():
+            manager.set_item_attributes(item_id, meta_text)
+        pending_attributes.clear()
+        extractor, embedding_pipeline, index_manager, batcher = loaded_extractor, pipeline, manager, scheduler
+    if INGEST_MODE == "async":
+        # Embed queued uploads in the background (INGEST_WORKERS=0 leaves it to src.ingest_queue)
+        ingest_worker = IngestWorker(scheduler, pipeline, manager)
+        ingest_worker.start(INGEST_WORKERS)
+    startup_status.update(state="ready", load_seconds=time.perf_counter() - start)
+
+def _not_ready():
+    """503 for endpoints that need the model or index while they are still loading, else None"""
+    if startup_status["state"] == "ready":
+        return None
+    return JSONResponse({"error": "The model and index are still loading, try again shortly",
+                         "startup": startup_status["state"]}, status_code=503)
+
+if STARTUP_MODE == "background":
+    @app.on_event("startup")
+    def start_loading_models():
+        threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+else:
+    load_models()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    if ingest_worker is not None:
+        ingest_worker.stop()
+    if batcher is not None:
+        batcher.stop()
+    executors.shutdown()
+
+@app.on_event("shutdown")
+def save_index_snapshot():
+    if index_manager is not None and not INDEX_SERVICE_SOCKET:
+        index_manager.save_snapshot()
 
 # def update_features():
 #     # This function is no longer needed since we use database-based FAISS index
@@ -56,58 +196,164 @@ extractor = FeatureExtractor()
 
 
 
-@app.post("/upload/")
-async def upload_image(item_id: str = Form(...), file: UploadFile = File(...), item_name: str = Form(None), meta_text: str = Form(None)):
-    import tempfile
-    db: Session = SessionLocal()
-    # Ensure item exists or create it
+def _item_dict(item):
+    return {
+        "item_id": item.id,
+        "item_name": item.name,
+        "meta_text": item.meta_text,
+        "ctime": item.created_at.timestamp() if item.created_at else 0
+    }
+
+def _ensure_item(db: Session, item_id, item_name, meta_text):
+    """Create the item if it doesn't exist (or update its meta_text) and return it as a dict"""
     item = db.query(Item).filter(Item.id == item_id).first()
     if not item:
         item = Item(id=item_id, name=item_name or item_id, meta_text=meta_text)
         db.add(item)
         db.commit()
         db.refresh(item)
-        # Prepare item dict before session closes
-        item_dict = {
-            "item_id": item.id,
-            "item_name": item.name,
-            "meta_text": item.meta_text,
-            "ctime": item.created_at.timestamp() if item.created_at else 0
+    elif meta_text is not None:
+        item.meta_text = meta_text
+        db.commit()
+        db.refresh(item)
+    return _item_dict(item)
+
+async def _refresh_item_attributes(item_id, meta_text):
+    """Let metadata filters on /query/ see an item's new meta_text"""
+    if meta_text is None:
+        return
+    with pending_attributes_lock:
+        if index_manager is None:
+            # The index is still loading and may have read the old meta_text; load_models() applies this
+            pending_attributes[item_id] = meta_text
+            return
+    await run_cpu(index_manager.set_item_attributes, item_id, meta_text)
+
+def _find_duplicates(db: Session, digests):
+    """
+    Images whose original bytes have any of these content hashes. Uploads
+    whose async ingestion failed are left out, so uploading the same bytes
+    again retries them instead of being reported as a duplicate.
+    """
+    return (db.query(Image)
+            .filter(Image.content_hash.in_(digests),
+                    (Image.ingest_status == None) | (Image.ingest_status != FAILED))
+            .order_by(Image.id).all())
+
+async def _scan(file: UploadFile):
+    """Hash an uploaded file in chunks and rewind it, or raise UploadTooLarge"""
+    with STAGE_SECONDS.time(stage="read_upload"):
+        digest, _ = await run_io(scan_upload, file.file)
+    return digest
+
+def _too_large(error):
+    return JSONResponse({"error": str(error)}, status_code=413)
+
+# What decoding a bad upload raises; PIL's UnidentifiedImageError and truncated files are OSErrors
+def _not_an_image():
+    return JSONResponse({"error": NOT_AN_IMAGE}, status_code=400)
+
+def _extraction_error(error, filename):
+    """Client-facing message for a file whose extraction failed; unexpected errors are logged, not echoed"""
+    if isinstance(error, DECODE_ERRORS):
+        return NOT_AN_IMAGE
+    print(f"Feature extraction failed for {filename}: {type(error).__name__}: {error}")
+    return EXTRACTION_FAILED
+
+def _save_image(db: Session, item_id, filename, s3_key, feat_bytes, embedding_version, digest=None,
+                ingest_status=None):
+    """Insert an Image row and return it with its generated id loaded"""
+    image = Image(item_id=item_id, filename=filename, s3_key=s3_key, vector=feat_bytes,
+                  embedding_version=embedding_version, content_hash=digest, ingest_status=ingest_status)
+    db.add(image)
+    db.commit()
+    db.refresh(image)
+    return image
+
+def _save_images(db: Session, rows):
+    """Insert Image rows (dicts of column values) in one transaction and return their ImageRefs"""
+    images = [Image(**row) for row in rows]
+    db.add_all(images)
+    db.flush()
+    refs = [ImageRef(image.id, image.item_id, image.filename, image.s3_key) for image in images]
+    db.commit()
+    return refs
+
+@app.post("/upload/")
+async def upload_image(item_id: str = Form(...), file: UploadFile = File(...), item_name: str = Form(None), meta_text: str = Form(None)):
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    # The upload stays in Starlette's spooled temp file: hash it in chunks, then
+    # decode and send it to S3 straight from that file
+    try:
+        digest = await _scan(file)
+    except UploadTooLarge as e:
+        return _too_large(e)
+    if INGEST_MODE == "async" and await run_db(backlog) >= INGEST_MAX_PENDING:
+        return JSONResponse({"error": "Too many uploads are waiting to be embedded, try again later"},
+                            status_code=503, headers={"Retry-After": "5"})
+    # Ensure item exists or create it
+    item_dict = await run_db(_ensure_item, item_id, item_name, meta_text)
+    await _refresh_item_attributes(item_id, meta_text)
+    duplicates = await run_db(_find_duplicates, [digest])
+    same_item = next((img for img in duplicates if img.item_id == item_id), None)
+    if same_item is not None:
+        # These exact bytes are already stored for this item: nothing new to write
+        upload_duplicates["same_item"] += 1
+        presigned_url = await run_io(generate_presigned_url, same_item.s3_key)
+        return {
+            "item": item_dict,
+            "filename": same_item.filename,
+            "s3_key": same_item.s3_key,
+            "url": presigned_url,
+            "meta_text": item_dict["meta_text"],
+            "status": "duplicate of an image already stored for this item"
         }
+    s3_key = f"{item_id}/{file.filename}"
+    target_version = embedding_pipeline.storage_version
+    reusable = next((img for img in duplicates if img.vector is not None
+                     and (img.embedding_version or RAW_VERSION) == target_version), None)
+    if reusable is not None:
+        # Same bytes stored under another item: copy its vector instead of extracting again
+        upload_duplicates["vector_reused"] += 1
+        feat_bytes = reusable.vector
+        vector = None if embedding_pipeline.needs_pca else embedding_pipeline.decode(feat_bytes)
+    elif INGEST_MODE == "async":
+        # Store the original and queue it; an ingest worker embeds and indexes it later
+        file.file.seek(0)
+        await run_io(upload_fileobj_to_s3, file.file, s3_key, content_type=file.content_type)
+        image = await run_db(_save_image, item_id, file.filename, s3_key, None, None, digest, PENDING)
+        return JSONResponse({
+            "item": item_dict,
+            "image_id": image.id,
+            "filename": file.filename,
+            "s3_key": s3_key,
+            "meta_text": item_dict["meta_text"],
+            "status": PENDING,
+            "status_url": f"/images/{image.id}/status",
+        }, status_code=202)
     else:
-        if meta_text is not None:
-            item.meta_text = meta_text
-            db.commit()
-        item_dict = {
-            "item_id": item.id,
-            "item_name": item.name,
-            "meta_text": item.meta_text,
-            "ctime": item.created_at.timestamp() if item.created_at else 0
-        }
-    # Read file content into memory once
-    from io import BytesIO
+        # Extract features first, so an image that can't be decoded never reaches S3
+        try:
+            with STAGE_SECONDS.time(stage="extract"):
+                feat = await batcher.extract(file.file, key=digest)
+        except queue.Full:
+            return JSONResponse({"error": "Feature extraction queue is full, try again later"}, status_code=503)
+        except DECODE_ERRORS:
+            return _not_an_image()
+        with STAGE_SECONDS.time(stage="embed"):
+            feat_bytes, _, vector = embedding_pipeline.encode_for_storage(feat)
+    # Stream the spooled file to S3 (multipart for large files)
     file.file.seek(0)
-    file_bytes = file.file.read()
-    s3_key = f"{item_id}/{file.filename}"
-    # Upload to S3 from memory
-    upload_fileobj_to_s3(BytesIO(file_bytes), s3_key, content_type=file.content_type)
-    # Save to temp file for feature extraction
-    suffix = os.path.splitext(file.filename)[1]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(file_bytes)
-        temp_path = tmp.name
-    feat = extractor.extract(temp_path)
-    feat_bytes = np.asarray(feat, dtype=np.float32).tobytes()
-    os.remove(temp_path)
+    await run_io(upload_fileobj_to_s3, file.file, s3_key, content_type=file.content_type)
     # Add image record to DB with vector
-    image = Image(item_id=item_id, filename=file.filename, s3_key=s3_key, vector=feat_bytes)
-    db.add(image)
-    db.commit()
-    db.refresh(image)
-    # Rebuild FAISS index after adding new image
-    rebuild_faiss_index()
-    presigned_url = generate_presigned_url(s3_key)
-    db.close()
+    image = await run_db(_save_image, item_id, file.filename, s3_key, feat_bytes, target_version, digest)
+    if vector is not None:
+        # Add the new vector to the FAISS index
+        with STAGE_SECONDS.time(stage="index_add"):
+            await run_cpu(index_manager.add, image, vector)
+    presigned_url = await run_io(generate_presigned_url, s3_key)
     return {
         "item": item_dict,
         "filename": file.filename,
@@ -117,172 +363,496 @@ async def upload_image(item_id: str = Form(...), file: UploadFile = File(...), i
         "status": "uploaded to S3 and DB with vector"
     }
 
+@app.post("/items/{item_id}/images")
+async def upload_item_images(item_id: str = Path(...), files: List[UploadFile] = File(...),
+                             item_name: str = Form(None), meta_text: str = Form(None)):
+    """
+    Add several images to one item. New images share batched forward passes,
+    go to S3 concurrently, are inserted in one transaction and reach the index
+    in one update. Returns a result per file, in request order, so one bad
+    file doesn't fail the rest.
+    """
+    if len(files) > ITEM_UPLOAD_MAX_FILES:
+        return JSONResponse({"error": f"At most {ITEM_UPLOAD_MAX_FILES} files per request"}, status_code=400)
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    results = [{"index": i, "filename": f.filename} for i, f in enumerate(files)]
+    digests = {}
+    for i, f in enumerate(files):
+        try:
+            digests[i] = await _scan(f)
+        except UploadTooLarge as e:
+            results[i].update(status="error", error=str(e))
+    item_dict = await run_db(_ensure_item, item_id, item_name, meta_text)
+    await _refresh_item_attributes(item_id, meta_text)
+    duplicates = await run_db(_find_duplicates, sorted(set(digests.values()))) if digests else []
+    target_version = embedding_pipeline.storage_version
 
-import faiss
-
-# Helper to load all vectors from DB into FAISS
-def build_faiss_index():
-    db: Session = SessionLocal()
-    images = db.query(Image).filter(Image.vector != None).all()
-    if not images:
-        db.close()
-        return None, [], []
-    vectors = [np.frombuffer(img.vector, dtype=np.float32) for img in images]
-    vectors = np.stack(vectors).astype('float32')
-    index = faiss.IndexFlatL2(vectors.shape[1])
-    index.add(vectors)
-    db.close()
-    return index, images, vectors
+    first_seen = {}  # content hash -> index of the first file in this request with it
+    pending = {}     # index -> future of raw features
+    stored = {}      # index -> (stored vector bytes, transformed vector or None)
+    for i, digest in digests.items():
+        same_item = next((img for img in duplicates if img.content_hash == digest and img.item_id == item_id), None)
+        if same_item is not None or digest in first_seen:
+            # Already stored for this item, or repeated within the request: nothing new to write
+            upload_duplicates["same_item"] += 1
+            if same_item is not None:
+                results[i].update(status="duplicate", s3_key=same_item.s3_key)
+            else:
+                results[i].update(status="duplicate", duplicate_of=first_seen[digest])
+            continue
+        first_seen[digest] = i
+        reusable = next((img for img in duplicates if img.content_hash == digest and img.vector is not None
+                         and (img.embedding_version or RAW_VERSION) == target_version), None)
+        if reusable is not None:
+            upload_duplicates["vector_reused"] += 1
+            vector = None if embedding_pipeline.needs_pca else embedding_pipeline.decode(reusable.vector)
+            stored[i] = (reusable.vector, vector)
+            continue
+        try:
+            # Submitted together, so the batcher runs them through shared forward passes
+            pending[i] = asyncio.wrap_future(batcher.submit(files[i].file, key=digest))
+        except queue.Full:
+            results[i].update(status="error", error="Feature extraction queue is full, try again later")
 
-faiss_index, faiss_images, faiss_vectors = build_faiss_index()
+    with STAGE_SECONDS.time(stage="extract"):
+        extracted = await asyncio.gather(*pending.values(), return_exceptions=True)
+    feats = {}
+    for i, feat in zip(pending, extracted):
+        if isinstance(feat, Exception):
+            results[i].update(status="error", error=_extraction_error(feat, files[i].filename))
+        else:
+            feats[i] = feat
+    if feats:
+        with STAGE_SECONDS.time(stage="embed"):
+            data, _, vectors = embedding_pipeline.encode_for_storage(np.stack(list(feats.values())))
+        if vectors is None:
+            vectors = [None] * len(data)
+        stored.update((i, (feat_bytes, v)) for i, feat_bytes, v in zip(feats, data, vectors))
 
-def rebuild_faiss_index():
-    """Rebuild the global FAISS index after database changes"""
-    global faiss_index, faiss_images, faiss_vectors
-    faiss_index, faiss_images, faiss_vectors = build_faiss_index()
+    async def put(i):
+        files[i].file.seek(0)
+        await run_io(upload_fileobj_to_s3, files[i].file, f"{item_id}/{files[i].filename}",
+                     content_type=files[i].content_type)
+    order = sorted(stored)
+    uploaded = await asyncio.gather(*(put(i) for i in order), return_exceptions=True)
+    saved, rows, vectors = [], [], []
+    for i, error in zip(order, uploaded):
+        if isinstance(error, Exception):
+            results[i].update(status="error", error=str(error))
+            continue
+        feat_bytes, vector = stored[i]
+        rows.append(dict(item_id=item_id, filename=files[i].filename, s3_key=f"{item_id}/{files[i].filename}",
+                         vector=feat_bytes, embedding_version=target_version, content_hash=digests[i]))
+        vectors.append(vector)
+        saved.append(i)
+    if rows:
+        refs = await run_db(_save_images, rows)
+        indexed = [(ref, v) for ref, v in zip(refs, vectors) if v is not None]
+        if indexed:
+            with STAGE_SECONDS.time(stage="index_add"):
+                await run_cpu(index_manager.add_many, [ref for ref, _ in indexed], np.stack([v for _, v in indexed]))
+        urls = await run_io(lambda: [generate_presigned_url(ref.s3_key) for ref in refs])
+        for i, ref, url in zip(saved, refs, urls):
+            results[i].update(status="uploaded", s3_key=ref.s3_key, url=url)
+    return {"item": item_dict, "results": results}
 
 @app.post("/query/")
-async def query_image(file: UploadFile = File(...), topk: int = Form(5)):
-    import tempfile
-    global faiss_index, faiss_images, faiss_vectors
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        temp_path = tmp.name
-    query_feat = extractor.extract(temp_path)
-    os.remove(temp_path)
-    if faiss_index is None or len(faiss_images) == 0:
-        return JSONResponse({"matches": []})
-    query_feat = np.asarray(query_feat, dtype=np.float32).reshape(1, -1)
-    D, I = faiss_index.search(query_feat, min(topk, len(faiss_images)))
-    matches = []
-    for idx, dist in zip(I[0], D[0]):
-        if idx < len(faiss_images):
-            img = faiss_images[idx]
-            preview_url = generate_presigned_url(img.s3_key) if hasattr(img, "s3_key") else None
-            matches.append({
-                "item_id": img.item_id,
-                "filename": img.filename,
-                "distance": float(dist),
-                "preview_image": preview_url
-            })
+async def query_image(file: UploadFile = File(...), topk: int = Form(5),
+                      nprobe: int = Form(None), ef_search: int = Form(None), rerank: int = Form(None),
+                      group_by_item: bool = Form(False), aggregate: str = Form("min"),
+                      filters: str = Form(None), item_ids: str = Form(None)):
+    """
+    Find the images closest to the uploaded one. filters (a JSON object of
+    attribute -> value or list of values) and item_ids (comma-separated)
+    restrict the search to matching items; see attribute_index.py.
+    """
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    try:
+        spec = parse_filters(filters, item_ids)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        digest = await _scan(file)
+    except UploadTooLarge as e:
+        return _too_large(e)
+    try:
+        with STAGE_SECONDS.time(stage="extract"):
+            query_feat = await batcher.extract(file.file, key=digest)
+    except queue.Full:
+        return JSONResponse({"error": "Feature extraction queue is full, try again later"}, status_code=503)
+    except DECODE_ERRORS:
+        return _not_an_image()
+    if embedding_pipeline.needs_pca:
+        return JSONResponse({"error": "PCA is enabled but not trained; run src.migrate_vectors"}, status_code=503)
+    with STAGE_SECONDS.time(stage="embed"):
+        query_vec = embedding_pipeline.transform(query_feat)
+    if group_by_item:
+        if aggregate not in AGGREGATE_MODES:
+            return JSONResponse({"error": f"aggregate must be one of {', '.join(AGGREGATE_MODES)}"}, status_code=400)
+        with STAGE_SECONDS.time(stage="search"):
+            results = await run_cpu(index_manager.search_items, query_vec, topk, mode=aggregate,
+                                    nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=spec)
+        with STAGE_SECONDS.time(stage="format"):
+            matches = await run_io(_format_item_matches, results)
+    else:
+        with STAGE_SECONDS.time(stage="search"):
+            results = await run_cpu(index_manager.search, query_vec, topk,
+                                    nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=spec)
+        with STAGE_SECONDS.time(stage="format"):
+            matches = await run_io(_format_matches, results)
     return JSONResponse({"matches": matches})
 
+def _format_matches(results):
+    return [{
+        "item_id": meta["item_id"],
+        "filename": meta["filename"],
+        "distance": dist,
+        "preview_image": generate_presigned_url(meta["s3_key"])
+    } for image_id, meta, dist in results]
 
+@app.post("/query/batch")
+async def query_batch(files: List[UploadFile] = File(...), topk: int = Form(5),
+                      nprobe: int = Form(None), ef_search: int = Form(None), rerank: int = Form(None),
+                      filters: str = Form(None), item_ids: str = Form(None)):
+    """
+    Query many images in one request. The images share batched forward passes
+    and each group that finishes together is searched with one multi-row FAISS
+    search. Results stream back as NDJSON, one line per file in completion order.
+    filters and item_ids apply to every file, as on /query/.
+    """
+    if len(files) > QUERY_BATCH_MAX_FILES:
+        return JSONResponse({"error": f"At most {QUERY_BATCH_MAX_FILES} files per batch"}, status_code=400)
+    try:
+        spec = parse_filters(filters, item_ids)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    if embedding_pipeline.needs_pca:
+        return JSONResponse({"error": "PCA is enabled but not trained; run src.migrate_vectors"}, status_code=503)
+    filenames = [f.filename for f in files]
 
-@app.delete("/item/{item_id}")
-async def delete_item(item_id: str):
-    db: Session = SessionLocal()
-    # Delete all images for this item from S3 and DB
+    pending, failed = {}, {}
+    for i, f in enumerate(files):
+        try:
+            digest = await _scan(f)
+            pending[i] = asyncio.wrap_future(batcher.submit(f.file, key=digest))
+        except UploadTooLarge as e:
+            failed[i] = str(e)
+        except queue.Full:
+            failed[i] = "Feature extraction queue is full, try again later"
+
+    def line(i, **fields):
+        return json.dumps({"index": i, "filename": filenames[i], **fields}) + "\n"
+
+    async def stream():
+        for i, error in failed.items():
+            yield line(i, error=error)
+        while pending:
+            await asyncio.wait(pending.values(), return_when=asyncio.FIRST_COMPLETED)
+            ready = []
+            for i in [i for i, fut in pending.items() if fut.done()]:
+                fut = pending.pop(i)
+                if fut.exception() is not None:
+                    yield line(i, error=_extraction_error(fut.exception(), filenames[i]))
+                else:
+                    ready.append((i, fut.result()))
+            if not ready:
+                continue
+            with STAGE_SECONDS.time(stage="embed"):
+                query_vecs = embedding_pipeline.transform(np.stack([feat for _, feat in ready]))
+            with STAGE_SECONDS.time(stage="search"):
+                results = await run_cpu(index_manager.search_batch, query_vecs, topk,
+                                        nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=spec)
+            with STAGE_SECONDS.time(stage="format"):
+                formatted = await run_io(lambda: [_format_matches(r) for r in results])
+            for (i, _), matches in zip(ready, formatted):
+                yield line(i, matches=matches)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _format_item_matches(results):
+    return [{
+        "item_id": item_id,
+        "filename": meta["filename"],
+        "distance": score,
+        "image_hits": hit_count,
+        "preview_image": generate_presigned_url(meta["s3_key"])
+    } for item_id, score, (image_id, meta, dist), hit_count in results]
+
+
+
+def _delete_item(db: Session, item_id):
+    """Delete an item and its images from the DB, returning the deleted (Image.id, s3_key) pairs"""
     images = db.query(Image).filter(Image.item_id == item_id).all()
+    deleted = [(img.id, img.s3_key) for img in images]
     for img in images:
-        try:
-            delete_file_from_s3(img.s3_key)
-        except Exception:
-            pass
         db.delete(img)
-    # Delete item
     item = db.query(Item).filter(Item.id == item_id).first()
     if item:
         db.delete(item)
     db.commit()
-    db.close()
-    rebuild_faiss_index()  # Rebuild FAISS index after deletion
+    return deleted
+
+def _delete_s3_files(s3_keys):
+    for s3_key in s3_keys:
+        try:
+            delete_file_from_s3(s3_key)
+        except Exception:
+            pass
+
+@app.delete("/item/{item_id}")
+async def delete_item(item_id: str):
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    deleted = await run_db(_delete_item, item_id)
+    await run_io(_delete_s3_files, [s3_key for _, s3_key in deleted])
+    await run_cpu(index_manager.remove, [image_id for image_id, _ in deleted])  # Drop the item's vectors from the FAISS index
     return {"item_id": item_id, "status": "deleted from S3 and DB"}
 
 
 
 @app.delete("/item_image/{item_id}/{filename}")
-def delete_item_image(item_id: str, filename: str):
-    db: Session = SessionLocal()
+def delete_item_image(item_id: str, filename: str, db: Session = Depends(get_db)):
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
     image = db.query(Image).filter(Image.item_id == item_id, Image.filename == filename).first()
     if image:
+        image_id = image.id
         try:
             delete_file_from_s3(image.s3_key)
         except Exception:
             pass
         db.delete(image)
         db.commit()
-        db.close()
-        rebuild_faiss_index()  # Rebuild FAISS index after deletion
+        index_manager.remove([image_id])  # Drop the image's vector from the FAISS index
         return {"item_id": item_id, "filename": filename, "status": "deleted from S3 and DB"}
-    db.close()
     return {"error": "File not found in DB"}
 
 @app.get("/")
 def root():
     return {"message": "Image Recognition API is running."}
 
-@app.post("/item/{item_id}/metadata")
-async def update_item_metadata(item_id: str = Path(...), meta_text: str = Body(...)):
-    db: Session = SessionLocal()
+@app.get("/health")
+def health():
+    """Liveness: the process is up and serving, whether or not the model has loaded"""
+    return {"status": "ok"}
+
+@app.get("/ready")
+def ready():
+    """Readiness: 200 once the model and index are loaded, 503 before (or if loading failed)"""
+    return JSONResponse(startup_status, status_code=200 if startup_status["state"] == "ready" else 503)
+
+@app.get("/stats/extraction")
+def extraction_stats():
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    return batcher.stats()
+
+@app.get("/stats/db")
+def db_stats():
+    return pool_status()
+
+@app.get("/stats/url_cache")
+def url_cache_stats():
+    return presigned_url_cache.stats()
+
+@app.get("/stats/embedding_cache")
+def embedding_cache_stats():
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    return {
+        **embedding_cache.stats(),
+        "coalesced": batcher.coalesced,
+        "upload_duplicates": dict(upload_duplicates),
+    }
+
+@app.get("/images/{image_id}/status")
+def image_status(image_id: int, db: Session = Depends(get_db)):
+    """Ingestion state of an upload: pending, processing, failed (with the error) or done"""
+    image = db.query(Image).filter(Image.id == image_id).first()
+    if image is None:
+        return JSONResponse({"error": "Image not found"}, status_code=404)
+    return job_status(image)
+
+@app.get("/stats/ingest")
+def ingest_stats(db: Session = Depends(get_db)):
+    if ingest_worker is not None:
+        return ingest_worker.stats()
+    return {"mode": INGEST_MODE, "workers": 0, "backlog": backlog(db), "max_pending": INGEST_MAX_PENDING}
+
+@app.get("/stats/index")
+def index_stats():
+    not_ready = _not_ready()
+    if not_ready:
+        return not_ready
+    return index_manager.stats()
+
+def _when_ready(func):
+    """Wrap a gauge callback so it reports nothing until the model and index are loaded"""
+    return lambda: func() if startup_status["state"] == "ready" else None
+
+def _index_stat(name):
+    return _when_ready(lambda: index_manager.stats()[name])
+
+def _ingest_backlog():
+    with session_scope() as db:
+        return backlog(db)
+
+def _cache_counts(stats):
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+GaugeFunc("image_rec_ready", "1 once the model and index are loaded",
+          lambda: 1 if startup_status["state"] == "ready" else 0)
+GaugeFunc("image_rec_extract_queue_depth", "Images waiting for a batched forward pass",
+          _when_ready(lambda: batcher.queue.qsize()))
+GaugeFunc("image_rec_extract_coalesced_total", "Extractions answered by an identical in-flight request",
+          _when_ready(lambda: batcher.coalesced), kind="counter")
+GaugeFunc("image_rec_index_size", "Vectors in the FAISS index", _index_stat("size"))
+GaugeFunc("image_rec_index_tombstones", "Deleted vectors still held by an index that can't remove them",
+          _index_stat("tombstones"))
+GaugeFunc("image_rec_index_builds_total", "Full index builds since the index process started",
+          _index_stat("builds"), kind="counter")
+GaugeFunc("image_rec_index_last_build_seconds", "Duration of the most recent full index build",
+          _index_stat("last_build_seconds"))
+GaugeFunc("image_rec_embedding_cache_requests_total", "Embedding cache lookups by result",
+          lambda: _cache_counts(embedding_cache.stats()), labelnames=("result",), kind="counter")
+GaugeFunc("image_rec_url_cache_requests_total", "Presigned URL cache lookups by result",
+          lambda: _cache_counts(presigned_url_cache.stats()), labelnames=("result",), kind="counter")
+GaugeFunc("image_rec_filter_cache_requests_total", "Metadata filter bitmap cache lookups by result",
+          _when_ready(lambda: _cache_counts(index_manager.stats()["filters"])), labelnames=("result",),
+          kind="counter")
+GaugeFunc("image_rec_upload_duplicates_total", "Uploads whose bytes were already stored",
+          lambda: {(kind,): n for kind, n in upload_duplicates.items()}, labelnames=("kind",), kind="counter")
+GaugeFunc("image_rec_ingest_backlog", "Uploads waiting to be embedded (INGEST_MODE=async)",
+          lambda: _ingest_backlog() if INGEST_MODE == "async" else None)
+GaugeFunc("image_rec_db_pool_checked_out", "Database connections in use", lambda: pool_status().get("checked_out"))
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of the latency histograms, counters and gauges"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+if PROFILER_ENABLED:
+    @app.post("/debug/profiler/start")
+    def start_profiler(interval_ms: float = Query(10, gt=0, le=1000)):
+        """Start sampling every thread's stack; see src/profiler.py"""
+        if not profiler.start(interval_ms / 1000):
+            return JSONResponse({"error": "The profiler is already running"}, status_code=409)
+        return profiler.stats()
+
+    @app.post("/debug/profiler/stop")
+    def stop_profiler():
+        """Stop sampling and return collapsed stacks for flamegraph.pl or speedscope"""
+        return PlainTextResponse(profiler.stop())
+
+    @app.get("/debug/profiler")
+    def profiler_status():
+        return profiler.stats()
+
+def _update_item_metadata(db: Session, item_id, meta_text):
     item = db.query(Item).filter(Item.id == item_id).first()
     if not item:
-        db.close()
-        return JSONResponse({"error": "Item not found"}, status_code=404)
+        return False
     item.meta_text = meta_text
     db.commit()
-    db.close()
+    return True
+
+@app.post("/item/{item_id}/metadata")
+async def update_item_metadata(item_id: str = Path(...), meta_text: str = Body(...)):
+    if not await run_db(_update_item_metadata, item_id, meta_text):
+        return JSONResponse({"error": "Item not found"}, status_code=404)
+    await _refresh_item_attributes(item_id, meta_text)
     return {"item_id": item_id, "meta_text": meta_text, "status": "updated"}
 
 
+def _encode_cursor(item):
+    raw = json.dumps([item.created_at.isoformat() if item.created_at else None, item.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    created_at, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return (datetime.fromisoformat(created_at) if created_at else None), item_id
+
+def _preview_keys(db, item_ids):
+    """s3_key of the first image of each item, fetched in one windowed query"""
+    if not item_ids:
+        return {}
+    ranked = (db.query(
+                  Image.item_id,
+                  Image.s3_key,
+                  func.row_number().over(partition_by=Image.item_id, order_by=Image.id).label("rn"))
+              .filter(Image.item_id.in_(item_ids))
+              .subquery())
+    rows = db.query(ranked.c.item_id, ranked.c.s3_key).filter(ranked.c.rn == 1).all()
+    return {row.item_id: row.s3_key for row in rows}
+
+def _item_page(db: Session, newest_first, limit, cursor):
+    """
+    One page of items ordered by (created_at, id), plus the cursor for the next
+    page (None on the last page). limit=None returns every remaining item.
+    """
+    query = db.query(Item)
+    key = tuple_(Item.created_at, Item.id)
+    if cursor:
+        after = tuple_(*_decode_cursor(cursor))
+        query = query.filter(key < after if newest_first else key > after)
+    if newest_first:
+        query = query.order_by(Item.created_at.desc(), Item.id.desc())
+    else:
+        query = query.order_by(Item.created_at, Item.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    items = query.all()
+    has_more = limit is not None and len(items) > limit
+    items = items[:limit] if limit is not None else items
+    previews = _preview_keys(db, [item.id for item in items])
+    result = [{
+        "item_id": item.id,
+        "item_name": item.name,
+        "preview_image": generate_presigned_url(previews[item.id]) if item.id in previews else None,
+        "meta_text": item.meta_text,
+        "ctime": item.created_at.timestamp() if item.created_at else 0
+    } for item in items]
+    next_cursor = _encode_cursor(items[-1]) if has_more else None
+    return {"items": result, "next_cursor": next_cursor}
+
 @app.get("/items/")
-def list_items():
-    db: Session = SessionLocal()
-    items = db.query(Item).all()
-    result = []
-    for item in items:
-        # Get preview image (first image)
-        images = item.images
-        preview_url = None
-        if images:
-            preview_url = generate_presigned_url(images[0].s3_key)
-        result.append({
-            "item_id": item.id,
-            "item_name": item.name,
-            "preview_image": preview_url,
-            "meta_text": getattr(item, "meta_text", None),
-            "ctime": item.created_at.timestamp() if item.created_at else 0
-        })
-    db.close()
-    result.sort(key=lambda x: x["ctime"])
-    return {"items": result}
+def list_items(limit: int = Query(None, ge=1, le=ITEMS_PAGE_MAX), cursor: str = Query(None),
+               db: Session = Depends(get_db)):
+    """Items oldest first. Pass limit (and next_cursor from the previous page) to paginate."""
+    try:
+        return _item_page(db, newest_first=False, limit=limit, cursor=cursor)
+    except (ValueError, TypeError):
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
 
 @app.get("/items/recent")
-def get_recent_items(limit: int = Query(3, ge=1)):
-    db: Session = SessionLocal()
-    items = db.query(Item).order_by(Item.created_at.desc()).limit(limit).all()
-    result = []
-    for item in items:
-        images = item.images
-        preview_url = None
-        if images:
-            preview_url = generate_presigned_url(images[0].s3_key)
-        result.append({
-            "item_id": item.id,
-            "item_name": item.name,
-            "preview_image": preview_url,
-            "meta_text": getattr(item, "meta_text", None),
-            "ctime": item.created_at.timestamp() if item.created_at else 0
-        })
-    db.close()
-    return {"items": result}
+def get_recent_items(limit: int = Query(3, ge=1, le=ITEMS_PAGE_MAX), cursor: str = Query(None),
+                     db: Session = Depends(get_db)):
+    """Items newest first, paginated with next_cursor."""
+    try:
+        return _item_page(db, newest_first=True, limit=limit, cursor=cursor)
+    except (ValueError, TypeError):
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
 
 @app.get("/item_image/{item_id}/{filename}")
-def serve_item_image(item_id: str = Path(...), filename: str = Path(...)):
-    db: Session = SessionLocal()
+def serve_item_image(item_id: str = Path(...), filename: str = Path(...), db: Session = Depends(get_db)):
     image = db.query(Image).filter(Image.item_id == item_id, Image.filename == filename).first()
     if image:
-        url = generate_presigned_url(image.s3_key)
-        db.close()
-        return {"url": url}
-    db.close()
+        return {"url": generate_presigned_url(image.s3_key)}
     return {"error": "Image not found"}
 
 
 @app.get("/item_images/{item_id}")
-def list_item_images(item_id: str):
-    db: Session = SessionLocal()
-    images = db.query(Image).filter(Image.item_id == item_id).all()
-    urls = [generate_presigned_url(img.s3_key) for img in images]
-    db.close()
-    return {"images": urls}
+def list_item_images(item_id: str, db: Session = Depends(get_db)):
+    s3_keys = db.query(Image.s3_key).filter(Image.item_id == item_id).order_by(Image.id).all()
+    return {"images": [generate_presigned_url(row.s3_key) for row in s3_keys]}
@@ -0,0 +1,207 @@
+"""
+Metadata filters for /query/: an in-memory inverted index of item attributes.
+
+Attributes come from Item.meta_text, either a JSON object
+    {"category": "shoes", "colors": ["red", "white"]}
+or "key: value" (or "key=value") pairs, one per line or separated by ";".
+Keys and values are matched case-insensitively; other text is ignored.
+
+A filter maps keys to allowed values, e.g. {"category": "shoes",
+"brand": ["acme", "zenith"]}. Values of one key are OR-ed and keys are AND-ed.
+The key "item_id" restricts results to specific items. The index resolves a
+filter to the Image.ids it permits and hands FAISS an IDSelectorBitmap over
+them, so the search only scores the permitted subset. Bitmaps of recent
+filters are kept in an LRU cache; a write drops only the bitmaps it can
+change: those covering an item whose images or attributes changed, and those
+matching an attribute value an item gained.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+# Filter bitmaps kept in the LRU cache; each takes (largest Image.id)/8 bytes
+FILTER_CACHE_SIZE = int(os.getenv("FILTER_CACHE_SIZE", "64"))
+# Filters permitting at most this many images are scored directly against the
+# exact vectors (see vector_store.py) instead of searching the index
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "4096"))
+
+ITEM_ID_KEY = "item_id"
+
+
+def _norm(value):
+    return str(value).strip().lower()
+
+
+def parse_attributes(meta_text):
+    """The set of (key, value) attribute pairs described by an item's meta_text."""
+    if not meta_text:
+        return set()
+    try:
+        data = json.loads(meta_text)
+    except ValueError:
+        data = None
+    pairs = set()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            for v in value if isinstance(value, list) else [value]:
+                if v is not None and not isinstance(v, (dict, list)):
+                    pairs.add((_norm(key), _norm(v)))
+        return pairs
+    for part in meta_text.replace(";", "\n").splitlines():
+        for sep in (":", "="):
+            key, found, value = part.partition(sep)
+            if found and key.strip() and value.strip():
+                pairs.add((_norm(key), _norm(value)))
+                break
+    return pairs
+
+
+def parse_filters(filters=None, item_ids=None):
+    """
+    Build a filter from /query/ form fields: filters as a JSON object of
+    key -> value or list of values, item_ids as comma-separated ids.
+    Returns None for no filter. Raises ValueError on malformed input.
+    """
+    spec = {}
+    if filters:
+        try:
+            data = json.loads(filters)
+        except ValueError:
+            raise ValueError("filters must be a JSON object")
+        if not isinstance(data, dict):
+            raise ValueError("filters must be a JSON object")
+        for key, value in data.items():
+            values = value if isinstance(value, list) else [value]
+            if not values or any(isinstance(v, (dict, list)) or v is None for v in values):
+                raise ValueError(f"filter {key!r} must be a value or a non-empty list of values")
+            key = _norm(key)
+            # item ids are matched exactly, attributes case-insensitively
+            spec[key] = sorted({str(v) if key == ITEM_ID_KEY else _norm(v) for v in values})
+    if item_ids:
+        ids = {i.strip() for i in item_ids.split(",") if i.strip()}
+        if ITEM_ID_KEY in spec:
+            ids &= set(spec[ITEM_ID_KEY])
+        spec[ITEM_ID_KEY] = sorted(ids)
+    return spec or None
+
+
+class FilterSelection:
+    """The images a filter permits: sorted Image.ids and a FAISS selector over them."""
+
+    def __init__(self, ids):
+        import faiss  # kept out of module import so app.py can use parse_filters without loading FAISS
+        self.ids = ids
+        mask = np.zeros(int(ids[-1]) + 1 if len(ids) else 0, dtype=bool)
+        mask[ids] = True
+        # faiss.IDSelectorBitmap tests bit (id & 7) of byte id >> 3
+        self.bitmap = np.packbits(mask, bitorder="little")
+        self.selector = faiss.IDSelectorBitmap(self.bitmap)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class AttributeIndex:
+    """
+    Inverted index from item attributes to items. The Image.ids of those items
+    come from the index's ImageTable, passed to select(). Callers serialize
+    writes (FaissIndexManager holds its write lock); the bitmap cache has its own lock.
+    """
+
+    def __init__(self, cache_size=FILTER_CACHE_SIZE):
+        self.item_attributes = {}  # item_id -> {(key, value), ...}
+        self.postings = defaultdict(set)  # (key, value) -> item_ids
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # canonical filter -> (spec, item_ids it permits, FilterSelection)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def set_items(self, meta_texts):
+        """Set the attributes of several items from {item_id: meta_text}."""
+        gained = set()
+        for item_id, meta_text in meta_texts.items():
+            old = self.item_attributes.pop(item_id, set())
+            for pair in old:
+                self.postings[pair].discard(item_id)
+                if not self.postings[pair]:
+                    del self.postings[pair]
+            pairs = parse_attributes(meta_text)
+            if pairs:
+                self.item_attributes[item_id] = pairs
+            for pair in pairs:
+                self.postings[pair].add(item_id)
+            gained |= pairs - old
+        # A filter can lose an item that covered it, or gain one through a new value
+        self._drop(lambda spec, items: not items.isdisjoint(meta_texts) or any(
+            (key, value) in gained for key, values in spec.items() for value in values))
+
+    def invalidate(self, item_ids=None):
+        """
+        Drop the cached bitmaps covering any of item_ids after images of those
+        items were added to or removed from the index, or every bitmap if None.
+        """
+        if item_ids is None:
+            with self.lock:
+                self.cache.clear()
+            return
+        item_ids = set(item_ids)
+        self._drop(lambda spec, items: not items.isdisjoint(item_ids))
+
+    def _drop(self, stale):
+        """Drop the cache entries for which stale(spec, item_ids) is true."""
+        with self.lock:
+            for key in [key for key, (spec, items, _) in self.cache.items() if stale(spec, items)]:
+                del self.cache[key]
+
+    def _items(self, spec):
+        """The item ids a filter permits."""
+        items = None
+        for key, values in spec.items():
+            if key == ITEM_ID_KEY:
+                matched = set(values)
+            else:
+                matched = set().union(*(self.postings.get((key, v), ()) for v in values))
+            items = matched if items is None else items & matched
+            if not items:
+                break
+        return items or set()
+
+    def select(self, spec, image_ids_of):
+        """
+        The FilterSelection for a filter built by parse_filters(), cached.
+        image_ids_of(item_ids) returns the sorted Image.ids of those items.
+        Callers must not write to the index while this runs.
+        """
+        key = json.dumps(spec, sort_keys=True)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+        items = self._items(spec)
+        selection = FilterSelection(image_ids_of(items))
+        if self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = (spec, frozenset(items), selection)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return selection
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "items_with_attributes": len(self.item_attributes),
+                "attribute_values": len(self.postings),
+                "cached_filters": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
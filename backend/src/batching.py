@@ -0,0 +1,187 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from .metrics import LatencyStats, STAGE_SECONDS, EXTRACT_BATCH_SIZE
+
+MAX_BATCH_SIZE = int(os.getenv("EXTRACT_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("EXTRACT_MAX_WAIT_MS", "10"))
+MAX_QUEUE_SIZE = int(os.getenv("EXTRACT_MAX_QUEUE_SIZE", "256"))
+
+
+def _waiter(shared):
+    """
+    A Future that resolves with shared's outcome. Cancelling it (a client went
+    away) leaves shared running for everyone else waiting on it.
+    """
+    future = Future()
+
+    def relay(done):
+        if not future.set_running_or_notify_cancel():
+            return
+        if done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
+
+    shared.add_done_callback(relay)
+    return future
+
+
+class BatchScheduler:
+    """
+    Micro-batching front end for a FeatureExtractor.
+
+    Callers submit images and get a future back. A background worker collects
+    pending requests for up to max_wait_ms (or until max_batch_size images are
+    waiting), runs a single batched forward pass and resolves every future.
+    When decode_executor is given, the images of a batch are decoded in parallel on it.
+    When cache (an EmbeddingCache) is given, images submitted with a key are
+    answered from it, and identical keys already in flight share one extraction.
+    """
+
+    def __init__(self, extractor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 max_queue_size=MAX_QUEUE_SIZE, decode_executor=None, cache=None):
+        self.extractor = extractor
+        self.decode_executor = decode_executor
+        self.cache = cache
+        self._inflight = {}  # key -> Future of a queued extraction
+        self.coalesced = 0
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.queue_wait = LatencyStats()
+        self.inference = LatencyStats()
+        self.batches = 0
+        self.batched_images = 0
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="extract-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, source, key=None):
+        """
+        Queue an image (path, bytes or stream) for extraction and return a concurrent Future.
+        key (usually the content hash of the bytes) lets the cache answer it.
+        Raises queue.Full when the queue is at capacity.
+        """
+        if self.cache is None or key is None:
+            future = Future()
+            self.queue.put_nowait((source, future, time.monotonic()))
+            return future
+        feat = self.cache.get(key)
+        if feat is not None:
+            future = Future()
+            future.set_result(feat)
+            return future
+        with self._stats_lock:
+            shared = self._inflight.get(key)
+            if shared is not None:
+                self.coalesced += 1
+                return _waiter(shared)
+            shared = Future()
+            self.queue.put_nowait((source, shared, time.monotonic()))
+            self._inflight[key] = shared
+        shared.add_done_callback(lambda f: self._extracted(key, f))
+        return _waiter(shared)
+
+    def _extracted(self, key, future):
+        with self._stats_lock:
+            self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    async def extract(self, source, key=None):
+        """Awaitable form of submit() for use inside async endpoints."""
+        return await asyncio.wrap_future(self.submit(source, key))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "backend": getattr(self.extractor, "backend", None),
+                "queue_depth": self.queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "queue_wait": self.queue_wait.as_dict(),
+                "inference": self.inference.as_dict(),
+                "batches": self.batches,
+                "avg_batch_size": (self.batched_images / self.batches) if self.batches else 0.0,
+                "coalesced": self.coalesced,
+            }
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            stopping = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._process(batch)
+            if stopping:
+                return
+
+    def _preprocess(self, source):
+        try:
+            return self.extractor.preprocess(source), None
+        except Exception as e:
+            return None, e
+
+    def _process(self, batch):
+        started = time.monotonic()
+        with self._stats_lock:
+            for _, _, enqueued in batch:
+                self.queue_wait.record(started - enqueued)
+                STAGE_SECONDS.observe(started - enqueued, stage="queue_wait")
+        batch = [(source, future) for source, future, _ in batch if future.set_running_or_notify_cancel()]
+        sources = [source for source, _ in batch]
+        if self.decode_executor is not None and len(sources) > 1:
+            decoded = list(self.decode_executor.map(self._preprocess, sources))
+        else:
+            decoded = [self._preprocess(source) for source in sources]
+        tensors, futures = [], []
+        for (_, future), (tensor, error) in zip(batch, decoded):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                tensors.append(tensor)
+                futures.append(future)
+        if not futures:
+            return
+        try:
+            features = self.extractor.extract_batch(tensors)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        with self._stats_lock:
+            self.inference.record(time.monotonic() - started)
+            self.batches += 1
+            self.batched_images += len(futures)
+        EXTRACT_BATCH_SIZE.observe(len(futures))
+        for future, feat in zip(futures, features):
+            future.set_result(feat)
@@ -0,0 +1,247 @@
+"""
+Load a folder of catalog images straight into S3, the database and the index.
+
+Each subfolder of the root is an item_id, as with batch_upload_items.py, but
+nothing goes through the API: images are decoded by a process pool, features
+are extracted in large batches, originals are uploaded to S3 by a thread pool,
+and rows are bulk inserted one chunk per transaction. The index is caught up
+once at the end: through the index service if INDEX_SERVICE_SOCKET is set,
+otherwise in the snapshot, which a running server picks up when it next starts.
+
+Progress is checkpointed after every chunk, so an interrupted run can simply be
+started again. Images already in the database are skipped either way.
+
+Usage: python -m src.bulk_ingest data/images [--chunk-size 1024] [--batch-size 64]
+"""
+import argparse
+import functools
+import io
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+from sqlalchemy import insert
+
+from .db import Image, Item, ensure_schema, session_scope
+from .embedding import EmbeddingPipeline
+from .embedding_cache import content_hash
+from .feature_extractor import FeatureExtractor, preprocess_image
+from .storage import upload_fileobj_to_s3
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CHECKPOINT_PATH = "data/ingest-checkpoint.json"
+
+
+def scan(root):
+    """Return sorted (item_id, filename, path) for every image under root."""
+    entries = []
+    for item_id in sorted(os.listdir(root)):
+        item_path = os.path.join(root, item_id)
+        if not os.path.isdir(item_path):
+            continue
+        for fname in sorted(os.listdir(item_path)):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                entries.append((item_id, fname, os.path.join(item_path, fname)))
+    return entries
+
+
+def _init_decode_worker():
+    # One torch thread per worker; the pool itself provides the parallelism
+    torch.set_num_threads(1)
+
+
+def _decode(path, views=("full",)):
+    """Decode and preprocess one image in a worker process. Returns (array, error)."""
+    try:
+        return preprocess_image(path, views).numpy(), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _upload(item_id, fname, path):
+    """Upload one original to S3 and return its content hash."""
+    with open(path, "rb") as f:
+        data = f.read()
+    upload_fileobj_to_s3(io.BytesIO(data), f"{item_id}/{fname}", content_type=mimetypes.guess_type(fname)[0])
+    return content_hash(data)
+
+
+def load_checkpoint(path, root):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("root") == os.path.abspath(root):
+            return checkpoint["done"]
+        print(f"Ignoring checkpoint {path}: it was written for {checkpoint.get('root')}")
+    return 0
+
+
+def save_checkpoint(path, root, done):
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"root": os.path.abspath(root), "done": done, "saved_at": time.time()}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _existing(db, entries):
+    """(item_id, filename) pairs of entries that already have an Image row."""
+    item_ids = {item_id for item_id, _, _ in entries}
+    rows = db.query(Image.item_id, Image.filename).filter(Image.item_id.in_(item_ids)).all()
+    return {(row.item_id, row.filename) for row in rows}
+
+
+def _insert_rows(db, rows):
+    """Bulk insert any missing Items, then the Image rows, in one transaction."""
+    item_ids = {row["item_id"] for row in rows}
+    known = {row.id for row in db.query(Item.id).filter(Item.id.in_(item_ids))}
+    new_items = [{"id": item_id, "name": item_id} for item_id in sorted(item_ids - known)]
+    if new_items:
+        db.execute(insert(Item), new_items)
+    db.execute(insert(Image), rows)
+    db.commit()
+    return len(new_items)
+
+
+class BulkIngester:
+    def __init__(self, extractor=None, pipeline=None, batch_size=64, decode_workers=None, s3_workers=16):
+        self.extractor = extractor or FeatureExtractor()
+        self.pipeline = pipeline or EmbeddingPipeline()
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers or os.cpu_count() or 1
+        self.decode_pool = ProcessPoolExecutor(max_workers=self.decode_workers, initializer=_init_decode_worker)
+        self.s3_pool = ThreadPoolExecutor(max_workers=s3_workers, thread_name_prefix="s3")
+        self.stats = {"ingested": 0, "skipped": 0, "failed": 0, "items_created": 0}
+
+    def close(self):
+        self.decode_pool.shutdown()
+        self.s3_pool.shutdown()
+
+    def _decode_chunk(self, entries):
+        """Start decoding entries; the returned iterator yields results in order."""
+        chunksize = max(1, len(entries) // (4 * self.decode_workers))
+        return self.decode_pool.map(functools.partial(_decode, views=self.extractor.views),
+                                    [path for _, _, path in entries], chunksize=chunksize)
+
+    def ingest_chunk(self, entries, decoded):
+        """
+        Extract, upload and insert one chunk. decoded yields _decode results for
+        entries in order. Returns the number of images written.
+        """
+        with session_scope() as db:
+            existing = _existing(db, entries)
+        rows, uploads, batch = [], [], []
+
+        def flush():
+            features = self.extractor.extract_batch([torch.from_numpy(t) for _, t in batch])
+            blobs, version, _ = self.pipeline.encode_for_storage(features)
+            for (entry, _), blob in zip(batch, blobs):
+                item_id, fname, _ = entry
+                rows.append({"item_id": item_id, "filename": fname, "s3_key": f"{item_id}/{fname}",
+                             "vector": blob, "embedding_version": version})
+            batch.clear()
+
+        for entry, (tensor, error) in zip(entries, decoded):
+            item_id, fname, path = entry
+            if (item_id, fname) in existing:
+                self.stats["skipped"] += 1
+                continue
+            if error is not None:
+                print(f"  failed to decode {path}: {error}")
+                self.stats["failed"] += 1
+                continue
+            uploads.append((entry, self.s3_pool.submit(_upload, *entry)))
+            batch.append((entry, tensor))
+            if len(batch) >= self.batch_size:
+                flush()
+        if batch:
+            flush()
+
+        digests = {}
+        for (item_id, fname, path), future in uploads:
+            try:
+                digests[(item_id, fname)] = future.result()
+            except Exception as e:
+                print(f"  failed to upload {path}: {e}")
+                self.stats["failed"] += 1
+        rows = [dict(row, content_hash=digests[(row["item_id"], row["filename"])])
+                for row in rows if (row["item_id"], row["filename"]) in digests]
+        if rows:
+            with session_scope() as db:
+                self.stats["items_created"] += _insert_rows(db, rows)
+        self.stats["ingested"] += len(rows)
+        return len(rows)
+
+    def run(self, root, chunk_size=1024, checkpoint_path=CHECKPOINT_PATH):
+        entries = scan(root)
+        done = load_checkpoint(checkpoint_path, root)
+        total = len(entries)
+        print(f"Found {total} images under {root}" + (f", resuming after {done}" if done else ""))
+        chunks = [entries[i:i + chunk_size] for i in range(done, total, chunk_size)]
+        start = time.perf_counter()
+        written = 0
+        # Decode the next chunk in the worker processes while this one is extracted
+        pending = self._decode_chunk(chunks[0]) if chunks else None
+        for n, chunk in enumerate(chunks):
+            decoded = pending
+            pending = self._decode_chunk(chunks[n + 1]) if n + 1 < len(chunks) else None
+            written += self.ingest_chunk(chunk, decoded)
+            done += len(chunk)
+            save_checkpoint(checkpoint_path, root, done)
+            elapsed = time.perf_counter() - start
+            rate = written / elapsed if elapsed else 0.0
+            eta = f", ~{(total - done) / rate / 60:.0f} min left" if rate and done < total else ""
+            print(f"  {done}/{total} images, {written} written this run, {rate:.1f} images/s, "
+                  f"{self.stats['skipped']} skipped, {self.stats['failed']} failed{eta}")
+        return self.stats
+
+
+def update_index(pipeline):
+    """
+    Catch the index up with the new rows: through the index service when one
+    is running, otherwise by updating (or building) the snapshot on disk.
+    """
+    from .index_service import IndexClient, INDEX_SERVICE_SOCKET
+    if INDEX_SERVICE_SOCKET:
+        added, removed = IndexClient(INDEX_SERVICE_SOCKET).catch_up()
+        print(f"Index service caught up: {added} added, {removed} removed")
+        return
+    from .index_manager import FaissIndexManager
+    manager = FaissIndexManager(pipeline)
+    start = time.perf_counter()
+    how = manager.warm_start()
+    print(f"Index {'caught up from snapshot' if how == 'snapshot' else 'built'}: "
+          f"{len(manager)} vectors in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load a folder of item images (one subfolder per item_id).")
+    parser.add_argument("root", help="Folder whose subfolders are item_ids")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Images per DB transaction and checkpoint")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per feature extraction forward pass")
+    parser.add_argument("--decode-workers", type=int, default=None, help="Decode processes (default: CPU count)")
+    parser.add_argument("--s3-workers", type=int, default=16, help="Concurrent S3 uploads")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="Checkpoint file; empty disables it")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and rescan from the start")
+    parser.add_argument("--no-index", action="store_true", help="Skip updating the index snapshot at the end")
+    args = parser.parse_args()
+
+    ensure_schema()
+    if args.restart and args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    ingester = BulkIngester(batch_size=args.batch_size, decode_workers=args.decode_workers,
+                            s3_workers=args.s3_workers)
+    start = time.perf_counter()
+    try:
+        stats = ingester.run(args.root, args.chunk_size, args.checkpoint)
+    finally:
+        ingester.close()
+    elapsed = time.perf_counter() - start
+    print(f"Done in {elapsed:.1f}s: {stats['ingested']} images ({stats['ingested'] / max(elapsed, 1e-9):.1f}/s), "
+          f"{stats['items_created']} new items, {stats['skipped']} skipped, {stats['failed']} failed")
+    if not args.no_index and stats["ingested"]:
+        update_index(ingester.pipeline)
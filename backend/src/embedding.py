@@ -0,0 +1,187 @@
+import hashlib
+import os
+
+import numpy as np
+
+# "l2" searches raw ResNet-50 features with L2 distance (the original behaviour);
+# "cosine" L2-normalizes vectors and searches with inner product.
+EMBEDDING_METRIC = os.getenv("EMBEDDING_METRIC", "l2")
+# Project vectors down to this many dims with PCA (0 keeps all 2048)
+EMBEDDING_PCA_DIM = int(os.getenv("EMBEDDING_PCA_DIM", "0"))
+EMBEDDING_PCA_PATH = os.getenv("EMBEDDING_PCA_PATH", "data/pca.npz")
+# Storage dtype for Image.vector and the FAISS index: "float32" or "float16"
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
+# Views of each image the extractor embeds and averages, comma separated:
+# "full" (the whole image squashed to 224x224, the original behaviour), "center"
+# (center crop), "corners" (four corner crops) and "flip" (mirrored full view)
+EMBEDDING_VIEWS = os.getenv("EMBEDDING_VIEWS", "full")
+VIEWS = ("full", "center", "corners", "flip")
+
+RAW_VERSION = "raw"  # raw float32 ResNet-50 features, what rows without a version hold
+RAW_DTYPE = np.float32
+
+
+def parse_views(views):
+    """Normalize a views setting ("full,flip" or a sequence) to a tuple in canonical order."""
+    if isinstance(views, str):
+        views = [v.strip() for v in views.split(",") if v.strip()]
+    unknown = set(views) - set(VIEWS)
+    if unknown or not views:
+        raise ValueError(f"Unknown embedding views: {', '.join(sorted(unknown)) or '(none)'} "
+                         f"(expected some of {', '.join(VIEWS)})")
+    return tuple(v for v in VIEWS if v in views)
+
+
+class EmbeddingPipeline:
+    """
+    Turns raw extractor features into the vectors that are stored and searched.
+
+    Stages, in order: optional PCA projection, optional L2 normalization
+    (cosine metric), then encoding to the storage dtype. The version string
+    identifies the stored format, including which views the raw features
+    average over, so rows written under another configuration can be found
+    and backfilled.
+    """
+
+    def __init__(self, metric=EMBEDDING_METRIC, pca_dim=EMBEDDING_PCA_DIM,
+                 pca_path=EMBEDDING_PCA_PATH, dtype=EMBEDDING_DTYPE, views=EMBEDDING_VIEWS):
+        if metric not in ("l2", "cosine"):
+            raise ValueError(f"Unknown embedding metric: {metric}")
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unknown embedding dtype: {dtype}")
+        self.metric = metric
+        self.pca_dim = pca_dim
+        self.pca_path = pca_path
+        self.dtype = np.dtype(dtype)
+        self.views = parse_views(views)
+        self.pca_mean = None
+        self.pca_components = None  # shape: (pca_dim, raw_dim)
+        if pca_dim and os.path.exists(pca_path):
+            self.load_pca(pca_path)
+
+    @property
+    def is_raw(self):
+        return self.metric == "l2" and not self.pca_dim and self.dtype == RAW_DTYPE
+
+    @property
+    def raw_version(self):
+        """Version of raw float32 features extracted with this pipeline's views"""
+        if self.views == ("full",):
+            return RAW_VERSION
+        return f"{RAW_VERSION}:{'+'.join(self.views)}"
+
+    @property
+    def needs_pca(self):
+        return bool(self.pca_dim) and self.pca_components is None
+
+    @property
+    def version(self):
+        if self.is_raw:
+            return self.raw_version
+        parts = [self.metric, f"pca{self.pca_dim}" if self.pca_dim else "full", self.dtype.name]
+        if self.views != ("full",):
+            parts.append("+".join(self.views))
+        if self.pca_components is not None:
+            digest = hashlib.blake2b(self.pca_components.tobytes(), digest_size=4).hexdigest()
+            parts.append(digest)
+        return ":".join(parts)
+
+    @property
+    def storage_version(self):
+        """embedding_version of what encode_for_storage() writes: raw features until PCA is trained."""
+        return self.raw_version if self.needs_pca else self.version
+
+    @property
+    def faiss_metric(self):
+        import faiss
+        return faiss.METRIC_INNER_PRODUCT if self.metric == "cosine" else faiss.METRIC_L2
+
+    def new_index(self, dim):
+        """Create an empty flat index for this pipeline's metric and dtype."""
+        import faiss
+        if self.dtype == np.float16:
+            return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, self.faiss_metric)
+        if self.metric == "cosine":
+            return faiss.IndexFlatIP(dim)
+        return faiss.IndexFlatL2(dim)
+
+    def to_distance(self, score):
+        """Map a FAISS score to a distance where lower is better."""
+        return 1.0 - score if self.metric == "cosine" else score
+
+    def exact_distances(self, query, vectors):
+        """Distances from one transformed query to rows of transformed float32 vectors, as to_distance() reports them."""
+        if self.metric == "cosine":
+            return 1.0 - vectors @ query
+        diff = vectors - query
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def train_pca(self, raw_vectors):
+        """Fit the PCA projection on raw float32 features and save it to pca_path."""
+        raw_vectors = np.asarray(raw_vectors, dtype=np.float32)
+        if len(raw_vectors) < self.pca_dim:
+            raise ValueError(f"Need at least {self.pca_dim} vectors to train PCA, got {len(raw_vectors)}")
+        mean = raw_vectors.mean(axis=0)
+        centered = raw_vectors - mean
+        # Eigen-decompose the (dim, dim) covariance rather than SVD the whole sample
+        eigvals, eigvecs = np.linalg.eigh(centered.T @ centered)
+        top = np.argsort(eigvals)[::-1][:self.pca_dim]
+        self.pca_mean = mean.astype(np.float32)
+        self.pca_components = np.ascontiguousarray(eigvecs[:, top].T, dtype=np.float32)
+        os.makedirs(os.path.dirname(self.pca_path) or ".", exist_ok=True)
+        np.savez(self.pca_path, mean=self.pca_mean, components=self.pca_components)
+
+    def load_pca(self, path):
+        data = np.load(path)
+        self.pca_mean = data["mean"]
+        self.pca_components = data["components"]
+        if self.pca_components.shape[0] != self.pca_dim:
+            raise ValueError(f"PCA file {path} has {self.pca_components.shape[0]} dims, expected {self.pca_dim}")
+
+    def transform(self, raw_vectors):
+        """Map raw (n, 2048) or (2048,) features to search vectors, as float32."""
+        vectors = np.asarray(raw_vectors, dtype=np.float32)
+        single = vectors.ndim == 1
+        vectors = vectors.reshape(-1, vectors.shape[-1])
+        if self.pca_dim:
+            if self.pca_components is None:
+                raise RuntimeError("PCA is enabled but not trained; run src.migrate_vectors first")
+            vectors = (vectors - self.pca_mean) @ self.pca_components.T
+        if self.metric == "cosine":
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        return vectors[0] if single else vectors
+
+    def encode(self, vector):
+        """Serialize a transformed vector for Image.vector."""
+        return np.asarray(vector, dtype=self.dtype).tobytes()
+
+    def encode_for_storage(self, raw_features):
+        """
+        Encode raw (n, 2048) or (2048,) features for Image.vector. Returns
+        (data, storage_version, vectors): data is the bytes per row (or one
+        bytes for a single vector) and vectors the transformed search vectors.
+        While PCA isn't trained yet the raw features are stored for
+        src.migrate_vectors to convert, and vectors is None.
+        """
+        raw = np.asarray(raw_features, dtype=np.float32)
+        single = raw.ndim == 1
+        raw = raw.reshape(-1, raw.shape[-1])
+        if self.needs_pca:
+            data, vectors = [row.tobytes() for row in raw], None
+        else:
+            vectors = self.transform(raw)
+            data = [self.encode(v) for v in vectors]
+        if single:
+            return data[0], self.storage_version, (vectors[0] if vectors is not None else None)
+        return data, self.storage_version, vectors
+
+    def decode(self, data):
+        """Deserialize Image.vector bytes written by encode() back to float32."""
+        return np.frombuffer(data, dtype=self.dtype).astype(np.float32)
+
+
+def decode_raw(data):
+    """Deserialize raw float32 features, as stored in rows without a version."""
+    return np.frombuffer(data, dtype=RAW_DTYPE)
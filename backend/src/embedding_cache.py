@@ -0,0 +1,64 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Raw extractor features kept in memory, keyed by the content hash of the image bytes
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+
+
+def content_hasher():
+    """Incremental form of content_hash(): update() it with chunks, then hexdigest()."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_hash(data):
+    """BLAKE2b-128 hex digest of image bytes, as stored in Image.content_hash."""
+    hasher = content_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of raw extractor features keyed by content hash, so
+    repeated identical images skip decode and inference.
+    """
+    def __init__(self, max_size=EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # content hash -> read-only (2048,) feature array
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            feat = self.entries.get(key)
+            if feat is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return feat
+            self.misses += 1
+            return None
+
+    def put(self, key, feat):
+        if self.max_size <= 0:
+            return
+        feat = feat.copy()
+        feat.setflags(write=False)
+        with self.lock:
+            self.entries[key] = feat
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
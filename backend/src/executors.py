@@ -0,0 +1,42 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Blocking I/O (SQLAlchemy sessions, S3 calls, URL signing)
+IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+# CPU-bound work (image decode, FAISS search). torch and FAISS release the GIL
+# for their heavy kernels, so a thread pool avoids copying the model per process.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+# torch intra-op / inter-op threads; unset leaves torch's defaults
+TORCH_NUM_THREADS = os.getenv("TORCH_NUM_THREADS")
+TORCH_INTEROP_THREADS = os.getenv("TORCH_INTEROP_THREADS")
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+
+
+def configure_torch_threads():
+    """Apply TORCH_NUM_THREADS / TORCH_INTEROP_THREADS. Call before the model runs."""
+    import torch
+    if TORCH_NUM_THREADS:
+        torch.set_num_threads(int(TORCH_NUM_THREADS))
+    if TORCH_INTEROP_THREADS:
+        torch.set_num_interop_threads(int(TORCH_INTEROP_THREADS))
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking I/O call on the I/O pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu(func, *args, **kwargs):
+    """Run a CPU-bound call on the CPU pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    io_executor.shutdown(wait=False)
+    cpu_executor.shutdown(wait=False)
@@ -1,29 +1,170 @@
 import torch
 import torchvision.models as models
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 from PIL import Image
 import numpy as np
+import copy
+import hashlib
+import io
 import os
+import tempfile
+
+from .embedding import EMBEDDING_VIEWS, parse_views
+from .inference_backends import EXTRACT_BACKEND, build_backend
+from .metrics import STAGE_SECONDS
+
+INPUT_SIZE = (224, 224)
+# Short side the image is scaled to before the center and corner crops are cut
+CROP_RESIZE = 256
+# Local copy of the ImageNet ResNet-50 weights. Downloaded once if missing, then
+# loaded from disk with no hub lookup. Set the SHA-256 to pin the exact file.
+EXTRACT_WEIGHTS_PATH = os.getenv("EXTRACT_WEIGHTS_PATH", "data/models/resnet50-imagenet1k-v1.pth")
+EXTRACT_WEIGHTS_SHA256 = os.getenv("EXTRACT_WEIGHTS_SHA256", "")
+# Resize and normalize a decoded image into the model's (3, 224, 224) input
+PREPROCESS = transforms.Compose([
+    transforms.Resize(INPUT_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+])
+NORMALIZE = PREPROCESS.transforms[-1]
+
+
+def view_transform(views):
+    """
+    Preprocessing for the given views (see embedding.parse_views). A single
+    "full" view is PREPROCESS; otherwise the callable returns a (views, 3, 224, 224)
+    tensor holding every view of the image.
+    """
+    views = parse_views(views)
+    if views == ("full",):
+        return PREPROCESS
+
+    def transform(image):
+        if "full" in views or "flip" in views:
+            full = NORMALIZE(TF.to_tensor(TF.resize(image, list(INPUT_SIZE))))
+        if "center" in views or "corners" in views:
+            scaled = NORMALIZE(TF.to_tensor(TF.resize(image, CROP_RESIZE)))
+            top_left, top_right, bottom_left, bottom_right, center = TF.five_crop(scaled, list(INPUT_SIZE))
+        tensors = []
+        for view in views:
+            if view == "full":
+                tensors.append(full)
+            elif view == "center":
+                tensors.append(center)
+            elif view == "corners":
+                tensors.extend([top_left, top_right, bottom_left, bottom_right])
+            elif view == "flip":
+                tensors.append(TF.hflip(full))
+        return torch.stack(tensors)
+    return transform
+
+
+def draft_size(views):
+    """Smallest size JPEG draft decoding may scale to without losing detail the views need"""
+    if "center" in views or "corners" in views:
+        return (CROP_RESIZE, CROP_RESIZE)
+    return INPUT_SIZE
+
+
+def preprocess_image(source, views=("full",)):
+    """Load and preprocess one image for views, outside a FeatureExtractor (e.g. in a worker process)."""
+    views = parse_views(views)
+    return view_transform(views)(FeatureExtractor.load_image(source, draft_size(views)))
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_resnet50(weights_path=EXTRACT_WEIGHTS_PATH, sha256=EXTRACT_WEIGHTS_SHA256):
+    """ResNet-50 with ImageNet weights, from weights_path when it exists."""
+    if weights_path and os.path.exists(weights_path):
+        if sha256 and _sha256(weights_path) != sha256:
+            raise RuntimeError(f"{weights_path} does not match EXTRACT_WEIGHTS_SHA256")
+        model = models.resnet50(weights=None)
+        model.load_state_dict(torch.load(weights_path, map_location="cpu", weights_only=True))
+        return model
+    model = models.resnet50(pretrained=True)
+    if weights_path:
+        os.makedirs(os.path.dirname(weights_path) or ".", exist_ok=True)
+        # A unique temp name: workers starting together may all download the weights
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(weights_path) or ".",
+                                   prefix=os.path.basename(weights_path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(model.state_dict(), f)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, weights_path)
+    return model
+
 
 class FeatureExtractor:
-    def __init__(self, device=None):
+    def __init__(self, device=None, backend=EXTRACT_BACKEND, views=EMBEDDING_VIEWS):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = models.resnet50(pretrained=True)
+        self.model = load_resnet50()
         self.model = torch.nn.Sequential(*list(self.model.children())[:-1])  # Remove final classification layer
         self.model.eval()
         self.model.to(self.device)
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-
-    def extract(self, image_path):
-        image = Image.open(image_path).convert('RGB')
-        img_t = self.transform(image).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            features = self.model(img_t).cpu().numpy().flatten()
-        return features
+        # Each image is embedded as the mean of these views, all run in the same forward pass
+        self.views = parse_views(views)
+        self.transform = view_transform(self.views)
+        # Runtime the model runs on (see inference_backends.py)
+        self.backend = backend
+        self.forward = build_backend(backend, self.model, self.device)
+
+    @staticmethod
+    def load_image(source, min_size=INPUT_SIZE):
+        """
+        Open an image from a path, raw bytes or a file-like object.
+        JPEGs (and phone MPO files) are decoded in draft mode, so large photos
+        are scaled down by the decoder itself, never below min_size.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        image = Image.open(source)
+        if image.format in ("JPEG", "MPO"):
+            image.draft("RGB", min_size)
+        return image.convert('RGB')
+
+    def with_views(self, views):
+        """A copy sharing this extractor's model and backend that embeds with other views."""
+        other = copy.copy(self)
+        other.views = parse_views(views)
+        other.transform = view_transform(other.views)
+        return other
+
+    def preprocess(self, source):
+        """
+        Load an image (path, bytes or stream) and return its normalized
+        (3, 224, 224) tensor, or (views, 3, 224, 224) with several views.
+        """
+        with STAGE_SECONDS.time(stage="decode"):
+            image = self.load_image(source, draft_size(self.views))
+        with STAGE_SECONDS.time(stage="preprocess"):
+            return self.transform(image)
+
+    def extract_batch(self, tensors):
+        """
+        Run one forward pass over preprocessed tensors, returning an (n, 2048)
+        array. Multi-view tensors are flattened into the same pass and each
+        image's views are averaged.
+        """
+        with STAGE_SECONDS.time(stage="inference"):
+            batch = torch.stack(tensors).to(self.device)
+            if batch.dim() == 4:
+                return self.forward(batch)
+            n, views = batch.shape[:2]
+            features = self.forward(batch.reshape(n * views, *batch.shape[2:]))
+            return features.reshape(n, views, -1).mean(axis=1)
+
+    def extract(self, source):
+        return self.extract_batch([self.preprocess(source)])[0]
 
 def extract_features_from_folder(folder_path, output_path):
     extractor = FeatureExtractor()
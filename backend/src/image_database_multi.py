@@ -1,13 +1,54 @@
 import numpy as np
-import faiss
 import os
 
+AGGREGATE_MODES = ("min", "mean_top", "count")
+# Candidates fetched per requested item before aggregating, and the most ever fetched
+ITEM_FETCH_FACTOR = 4
+ITEM_MAX_CANDIDATES = 4096
+
+
+def aggregate_by_item(item_index, distances, mode="min", top_m=3):
+    """
+    Aggregate per-image hits into per-item scores, lower is better.
+
+    item_index: integer item index of each hit (negative entries are ignored)
+    distances: distance of each hit
+    mode: "min" (best image), "mean_top" (mean of the item's best top_m images)
+          or "count" (best distance discounted by 1 + log(number of hits))
+    Returns (items, scores) sorted by score.
+    """
+    if mode not in AGGREGATE_MODES:
+        raise ValueError(f"Unknown aggregate mode: {mode}")
+    item_index = np.asarray(item_index).ravel()
+    distances = np.asarray(distances, dtype=np.float64).ravel()
+    valid = item_index >= 0
+    item_index, distances = item_index[valid], distances[valid]
+    if not len(item_index):
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    # Group hits by item, best distance first within each group
+    order = np.lexsort((distances, item_index))
+    item_index, distances = item_index[order], distances[order]
+    items, starts, counts = np.unique(item_index, return_index=True, return_counts=True)
+    best = distances[starts]
+    if mode == "min":
+        scores = best
+    elif mode == "mean_top":
+        group = np.repeat(np.arange(len(items)), counts)
+        rank = np.arange(len(distances)) - starts[group]
+        keep = rank < top_m
+        scores = np.bincount(group[keep], weights=distances[keep], minlength=len(items)) / np.minimum(counts, top_m)
+    else:
+        scores = best / (1.0 + np.log(counts))
+    ranked = np.argsort(scores, kind="stable")
+    return items[ranked], scores[ranked]
+
+
 class ImageDatabaseMulti:
     def __init__(self, features_path):
         self.features_path = features_path
         self.item_ids = []
         self.features = None  # shape: (total_images, feature_dim)
-        self.item_image_map = []  # list of (item_id, image_idx)
+        self.item_index = None  # shape: (total_images,), index into item_ids for each image
         self.index = None
         self._load_features()
         self._build_index()
@@ -15,32 +56,38 @@ class ImageDatabaseMulti:
     def _load_features(self):
         data = np.load(self.features_path, allow_pickle=True).item()
         all_features = []
+        item_index = []
         self.item_ids = list(data.keys())
-        self.item_image_map = []
-        for item_id in self.item_ids:
+        for idx, item_id in enumerate(self.item_ids):
             feats = data[item_id]
             for f in feats:
                 all_features.append(f)
-                self.item_image_map.append(item_id)
+                item_index.append(idx)
         self.features = np.stack(all_features).astype('float32')
+        self.item_index = np.array(item_index, dtype=np.int64)
 
     def _build_index(self):
+        import faiss  # kept out of module import so AGGREGATE_MODES stays cheap to import
         dim = self.features.shape[1]
         self.index = faiss.IndexFlatL2(dim)
         self.index.add(self.features)
 
-    def search(self, query_feature, top_k=5):
+    def search(self, query_feature, top_k=5, mode="min", top_m=3):
+        """
+        Return the top_k (item_id, score) pairs. Over-fetches a bounded set of
+        image hits and widens it only while too few distinct items come back.
+        """
         query_feature = np.array(query_feature).astype('float32').reshape(1, -1)
-        D, I = self.index.search(query_feature, len(self.features))
-        # Aggregate by item: take the best (min) distance for each item
-        item_best = {}
-        for idx, dist in zip(I[0], D[0]):
-            item_id = self.item_image_map[idx]
-            if item_id not in item_best or dist < item_best[item_id]:
-                item_best[item_id] = dist
-        # Sort by best distance and return top_k
-        sorted_items = sorted(item_best.items(), key=lambda x: x[1])[:top_k]
-        return sorted_items
+        total = len(self.features)
+        k = min(top_k * ITEM_FETCH_FACTOR, total)
+        while True:
+            D, I = self.index.search(query_feature, k)
+            hit_items = np.where(I[0] >= 0, self.item_index[I[0]], -1)
+            items, scores = aggregate_by_item(hit_items, D[0], mode, top_m)
+            if len(items) >= top_k or k >= min(total, ITEM_MAX_CANDIDATES):
+                break
+            k = min(k * 2, total, ITEM_MAX_CANDIDATES)
+        return [(self.item_ids[i], float(s)) for i, s in zip(items[:top_k], scores[:top_k])]
 
 if __name__ == "__main__":
     import argparse
@@ -48,13 +95,14 @@ if __name__ == "__main__":
     parser.add_argument("--features", required=True, help="Path to .npy features file")
     parser.add_argument("--query", required=True, help="Path to query image")
     parser.add_argument("--topk", type=int, default=5, help="Number of top matches to return")
+    parser.add_argument("--mode", default="min", choices=AGGREGATE_MODES, help="How image hits are scored per item")
     args = parser.parse_args()
 
     from .feature_extractor import FeatureExtractor
     extractor = FeatureExtractor()
     query_feat = extractor.extract(args.query)
     db = ImageDatabaseMulti(args.features)
-    results = db.search(query_feat, top_k=args.topk)
+    results = db.search(query_feat, top_k=args.topk, mode=args.mode)
     print("Top matches:")
     for item_id, dist in results:
         print(f"{item_id}\tDistance: {dist:.4f}")
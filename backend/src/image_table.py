@@ -0,0 +1,174 @@
+"""
+Compact, column-oriented result metadata for the vector index.
+
+FaissIndexManager needs the item_id, filename and s3_key of every indexed
+image to turn FAISS hits into results. A dict (or an ORM Image) per image
+costs hundreds of bytes of Python objects each, so ImageTable keeps NumPy
+columns indexed by Image.id instead:
+- item: index into an interned list of item ids, -1 where the id is absent
+- s3_key and filename: offset and length into one UTF-8 byte buffer
+A metadata dict is only built for the hits a search returns.
+"""
+import numpy as np
+
+_MIN_CAPACITY = 1024
+
+
+class ImageTable:
+    """Image.id -> (item_id, filename, s3_key), stored as columns."""
+
+    def __init__(self):
+        self.items = []  # interned item ids
+        self.item_codes = {}  # item_id -> index in items
+        self.item = np.full(0, -1, dtype=np.int32)
+        self.key_offset = np.zeros(0, dtype=np.int64)
+        self.key_length = np.zeros(0, dtype=np.int32)
+        self.name_offset = np.zeros(0, dtype=np.int64)
+        self.name_length = np.zeros(0, dtype=np.int32)
+        self.strings = bytearray()
+        self.garbage = 0  # bytes of strings no longer referenced
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, image_id):
+        return 0 <= image_id < len(self.item) and self.item[image_id] >= 0
+
+    def present(self, ids):
+        """Boolean mask of which ids are in the table."""
+        ids = np.asarray(ids, dtype=np.int64)
+        found = np.zeros(len(ids), dtype=bool)
+        inside = (ids >= 0) & (ids < len(self.item))
+        found[inside] = self.item[ids[inside]] >= 0
+        return found
+
+    def ids(self):
+        """Every Image.id in the table, ascending."""
+        return np.flatnonzero(self.item >= 0)
+
+    def _reserve(self, max_id):
+        if max_id < len(self.item):
+            return
+        capacity = max(max_id + 1, 2 * len(self.item), _MIN_CAPACITY)
+        grow = capacity - len(self.item)
+        self.item = np.concatenate([self.item, np.full(grow, -1, dtype=np.int32)])
+        for name in ("key_offset", "key_length", "name_offset", "name_length"):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.zeros(grow, dtype=column.dtype)]))
+
+    def _intern(self, item_id):
+        code = self.item_codes.get(item_id)
+        if code is None:
+            code = self.item_codes[item_id] = len(self.items)
+            self.items.append(item_id)
+        return code
+
+    def _append(self, values):
+        offsets = np.empty(len(values), dtype=np.int64)
+        lengths = np.empty(len(values), dtype=np.int32)
+        for n, value in enumerate(values):
+            data = value.encode()
+            offsets[n], lengths[n] = len(self.strings), len(data)
+            self.strings += data
+        return offsets, lengths
+
+    def add(self, ids, item_ids, filenames, s3_keys):
+        """Add (or replace) rows given as parallel sequences."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        self._reserve(int(ids.max()))
+        replaced = self.present(ids)
+        self.garbage += int(self.key_length[ids[replaced]].sum() + self.name_length[ids[replaced]].sum())
+        self.item[ids] = np.fromiter((self._intern(i) for i in item_ids), dtype=np.int32, count=len(ids))
+        self.key_offset[ids], self.key_length[ids] = self._append(s3_keys)
+        self.name_offset[ids], self.name_length[ids] = self._append(filenames)
+        # An id repeated within ids counts once
+        self.count += len(np.unique(ids[~replaced]))
+
+    def remove(self, ids):
+        """Drop ids from the table; returns the ids that were present."""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[self.present(ids)]
+        self.garbage += int(self.key_length[ids].sum() + self.name_length[ids].sum())
+        self.item[ids] = -1
+        self.count -= len(ids)
+        if self.garbage > _MIN_CAPACITY and self.garbage * 2 > len(self.strings):
+            self._compact()
+        return ids
+
+    def merge(self, other):
+        """Add every row of another ImageTable."""
+        ids = other.ids()
+        self.add(ids, other.item_ids(ids), [other._string(other.name_offset[i], other.name_length[i]) for i in ids],
+                 [other._string(other.key_offset[i], other.key_length[i]) for i in ids])
+
+    def _compact(self):
+        columns = self.columns()
+        self.__init__()
+        self._load(columns)
+
+    def _string(self, offset, length):
+        return self.strings[offset:offset + length].decode()
+
+    def item_ids(self, ids):
+        """The item_id of each of ids, which must be present."""
+        return [self.items[code] for code in self.item[np.asarray(ids, dtype=np.int64)]]
+
+    def ids_of_items(self, item_ids):
+        """Every Image.id belonging to any of item_ids, ascending."""
+        codes = [self.item_codes[i] for i in item_ids if i in self.item_codes]
+        if not codes:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.isin(self.item, codes))
+
+    def get(self, image_id):
+        """The {"item_id", "filename", "s3_key"} dict of an image, or None."""
+        if image_id not in self:
+            return None
+        return {
+            "item_id": self.items[self.item[image_id]],
+            "filename": self._string(self.name_offset[image_id], self.name_length[image_id]),
+            "s3_key": self._string(self.key_offset[image_id], self.key_length[image_id]),
+        }
+
+    def columns(self):
+        """The live rows as NumPy arrays, with a compacted string buffer, for snapshots."""
+        ids = self.ids()
+        codes, items = np.unique(self.item[ids], return_inverse=True)
+        parts, offsets, lengths = [], {}, {}
+        position = 0
+        for column in ("key", "name"):
+            start, length = getattr(self, f"{column}_offset")[ids], getattr(self, f"{column}_length")[ids]
+            parts.extend(self.strings[s:s + n] for s, n in zip(start, length))
+            offsets[column] = position + np.cumsum(length, dtype=np.int64) - length
+            lengths[column] = length
+            position += int(length.sum())
+        return {
+            "ids": ids,
+            "items": np.array([self.items[c] for c in codes], dtype=str),
+            "item": items.astype(np.int32),
+            "strings": np.frombuffer(b"".join(parts), dtype=np.uint8),
+            "key_offset": offsets["key"], "key_length": lengths["key"],
+            "name_offset": offsets["name"], "name_length": lengths["name"],
+        }
+
+    def _load(self, columns):
+        ids = np.asarray(columns["ids"], dtype=np.int64)
+        self.items = [str(i) for i in columns["items"]]
+        self.item_codes = {item_id: code for code, item_id in enumerate(self.items)}
+        self.strings = bytearray(np.asarray(columns["strings"], dtype=np.uint8).tobytes())
+        if len(ids):
+            self._reserve(int(ids.max()))
+            self.item[ids] = columns["item"]
+            for name in ("key_offset", "key_length", "name_offset", "name_length"):
+                getattr(self, name)[ids] = columns[name]
+        self.count = len(ids)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Rebuild a table from columns() output (or an npz file holding it)."""
+        table = cls()
+        table._load(columns)
+        return table
@@ -0,0 +1,197 @@
+"""
+Choose, build and tune the FAISS index structure behind FaissIndexManager.
+
+INDEX_TYPE selects the structure:
+- "flat" (default): exact search, one linear scan per query
+- "auto": pick Flat, HNSW, IVF-Flat or IVF-PQ from the number of vectors
+- anything else is passed to faiss.index_factory, e.g. "HNSW32" or "IVF4096,PQ64"
+
+Run as a module to measure recall@k of a configuration against exact search:
+    python -m src.index_factory --index-type "IVF1024,Flat" --nprobe 8 16 32
+and how much exact re-ranking of topk*r candidates (see vector_store.py) recovers:
+    python -m src.index_factory --index-type "IVF4096,PQ64" --nprobe 16 --rerank 4 10
+"""
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+# Max vectors used to train IVF/PQ indexes
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "100000"))
+# Default search-time settings; /query/ can override both per request
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+
+# Catalog sizes at which "auto" moves to the next tier
+AUTO_HNSW_MIN = 50_000
+AUTO_IVF_MIN = 1_000_000
+AUTO_IVFPQ_MIN = 5_000_000
+
+
+def _nlist(n):
+    """IVF list count: about 4*sqrt(n), rounded to a power of two."""
+    return 2 ** max(4, round(math.log2(4 * math.sqrt(max(n, 1)))))
+
+
+def _pq_m(dim):
+    return next(m for m in (64, 32, 16, 8, 4, 2, 1) if dim % m == 0)
+
+
+def choose_index_type(n, dim, dtype=np.float32):
+    """Return the factory string "auto" uses for n vectors of the given dim."""
+    storage = "SQfp16" if np.dtype(dtype) == np.float16 else "Flat"
+    if n < AUTO_HNSW_MIN:
+        return "Flat"
+    if n < AUTO_IVF_MIN:
+        return "HNSW32" if storage == "Flat" else f"HNSW32,{storage}"
+    if n < AUTO_IVFPQ_MIN:
+        return f"IVF{_nlist(n)},{storage}"
+    return f"IVF{_nlist(n)},PQ{_pq_m(dim)}"
+
+
+def resolve_index_type(index_type, n, dim, dtype=np.float32):
+    if index_type.lower() == "flat":
+        return "Flat"
+    if index_type.lower() == "auto":
+        return choose_index_type(n, dim, dtype)
+    return index_type
+
+
+def create_index(factory_string, dim, pipeline, train_vectors=None):
+    """
+    Build an empty index for factory_string, trained on train_vectors if the
+    structure needs it. "Flat" defers to the pipeline's exact index so float16
+    storage is kept. Returns None if training is needed and no vectors were given.
+    """
+    if factory_string == "Flat":
+        return pipeline.new_index(dim)
+    index = faiss.index_factory(dim, factory_string, pipeline.faiss_metric)
+    if not index.is_trained:
+        if train_vectors is None or len(train_vectors) == 0:
+            return None
+        index.train(sample_rows(train_vectors, INDEX_TRAIN_SAMPLE))
+    return index
+
+
+def sample_rows(vectors, limit, seed=0):
+    if len(vectors) <= limit:
+        return vectors
+    rng = np.random.default_rng(seed)
+    return vectors[np.sort(rng.choice(len(vectors), limit, replace=False))]
+
+
+def _inner(index):
+    return faiss.downcast_index(index.index if isinstance(index, faiss.IndexIDMap) else index)
+
+
+def supports_remove(index):
+    """HNSW graphs can't remove vectors; everything else used here can."""
+    return not isinstance(_inner(index), faiss.IndexHNSW)
+
+
+def search_params(index, nprobe=None, ef_search=None, selector=None):
+    """
+    Per-request search parameters for the index's structure, or None for
+    unfiltered exact indexes. selector (a faiss.IDSelector) restricts the
+    search to the ids it accepts.
+    """
+    inner = _inner(index)
+    extra = {"sel": selector} if selector is not None else {}
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe or INDEX_NPROBE, **extra)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or INDEX_EF_SEARCH, **extra)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def recall_at_k(exact_ids, approx_ids, k):
+    """Fraction of the exact top-k neighbours that the approximate search also returned."""
+    hits = sum(len(set(e[:k]) & set(a[:k]) - {-1}) for e, a in zip(exact_ids, approx_ids))
+    return hits / float(len(exact_ids) * k)
+
+
+def rerank(queries, base, ids, pipeline, k):
+    """Re-score each row of candidate ids exactly against base and keep the best k."""
+    reranked = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, candidates) in enumerate(zip(queries, ids)):
+        candidates = candidates[candidates >= 0]
+        order = np.argsort(pipeline.exact_distances(query, base[candidates]), kind="stable")[:k]
+        reranked[row, :len(order)] = candidates[order]
+    return reranked
+
+
+def evaluate(vectors, factory_string, pipeline, k=10, n_queries=1000, nprobes=(), ef_searches=(), reranks=()):
+    """
+    Compare factory_string against exact search on held-out rows of vectors.
+    Returns a list of dicts with recall@k and mean query latency per setting,
+    and per re-rank factor in reranks.
+    """
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(vectors))
+    queries = vectors[order[:n_queries]]
+    base = vectors[order[n_queries:]]
+    dim = vectors.shape[1]
+
+    exact = pipeline.new_index(dim)
+    exact.add(base)
+    start = time.perf_counter()
+    _, exact_ids = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    index = create_index(factory_string, dim, pipeline, base)
+    index.add(base)
+    build_s = time.perf_counter() - start
+
+    settings = [{"nprobe": p} for p in nprobes] + [{"ef_search": e} for e in ef_searches] or [{}]
+    results = []
+    for setting in settings:
+        params = search_params(index, **setting)
+        for factor in [0] + [r for r in reranks if r > 0]:
+            fetch = k * max(factor, 1)
+            start = time.perf_counter()
+            _, ids = index.search(queries, fetch, params=params) if params else index.search(queries, fetch)
+            if factor:
+                ids = rerank(queries, base, ids, pipeline, k)
+            query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            results.append({
+                "index_type": factory_string,
+                **setting,
+                **({"rerank": factor} if factor else {}),
+                f"recall@{k}": recall_at_k(exact_ids, ids, k),
+                "query_ms": query_ms,
+                "exact_query_ms": exact_ms,
+                "build_s": build_s,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Measure recall@k of an index type against exact search.")
+    parser.add_argument("--index-type", default=INDEX_TYPE, help='FAISS factory string, "flat" or "auto"')
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000, help="Stored vectors held out as queries")
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[], help="IVF nprobe values to try")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[], help="HNSW efSearch values to try")
+    parser.add_argument("--rerank", type=int, nargs="*", default=[],
+                        help="Re-rank factors to try: fetch k*r candidates and re-score them exactly")
+    args = parser.parse_args()
+
+    from .index_manager import FaissIndexManager
+    manager = FaissIndexManager()
+    pipeline = manager.pipeline
+    _, _, vectors = manager.load_vectors()
+    if vectors is None:
+        raise SystemExit("No vectors stored in the configured embedding format")
+    factory_string = resolve_index_type(args.index_type, len(vectors), vectors.shape[1], pipeline.dtype)
+    for row in evaluate(vectors, factory_string, pipeline, args.k, args.queries, args.nprobe, args.ef_search,
+                        args.rerank):
+        print(json.dumps(row))
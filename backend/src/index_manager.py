@@ -0,0 +1,689 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import faiss
+import numpy as np
+from sqlalchemy.orm import Session
+
+from .attribute_index import AttributeIndex, FilterSelection, FILTER_EXACT_MAX
+from .db import SessionLocal, Image, Item
+from .embedding import EmbeddingPipeline, RAW_VERSION
+from .index_factory import INDEX_TYPE, resolve_index_type, create_index, supports_remove, search_params
+from .image_database_multi import aggregate_by_item, ITEM_FETCH_FACTOR, ITEM_MAX_CANDIDATES
+from .image_table import ImageTable
+from .metrics import INDEX_BUILD_SECONDS, STAGE_SECONDS
+from .rwlock import ReadWriteLock
+from .vector_store import ExactVectorStore, RERANK_VECTORS_PATH, rerank_factor
+
+# Rebuild an index that can't remove vectors (HNSW) once this share of it is deleted
+TOMBSTONE_REBUILD_RATIO = 0.2
+
+# Snapshot of the built index; empty disables snapshots. Bump SNAPSHOT_FORMAT
+# whenever the snapshot layout changes so old files are ignored.
+SNAPSHOT_FORMAT = 2
+INDEX_SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT_PATH", f"data/index/index-v{SNAPSHOT_FORMAT}.faiss")
+INDEX_SNAPSHOT_MMAP = os.getenv("INDEX_SNAPSHOT_MMAP", "true").lower() in ("1", "true", "yes")
+# Rows fetched per round trip of the server-side cursor that loads vectors
+INDEX_LOAD_CHUNK = int(os.getenv("INDEX_LOAD_CHUNK", "1000"))
+
+
+def _temp_path(path):
+    """A new temp file beside path, unique to this call, to write before os.replace() onto path."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+def _grow(array, size):
+    """array with room for at least size rows (the new rows are uninitialized)."""
+    if size <= len(array):
+        return array
+    grown = np.empty((max(size, 2 * len(array), INDEX_LOAD_CHUNK),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class FaissIndexManager:
+    """
+    Keeps a FAISS index in step with the images table.
+
+    Vectors are stored in an IndexIDMap keyed by Image.id, so single-image
+    writes are applied with add_with_ids/remove_ids instead of rebuilding
+    the whole index from the database. Vectors added and searched must already
+    be transformed by the manager's EmbeddingPipeline. The index structure
+    comes from index_type (see index_factory.py) and is re-chosen on build().
+    Unless vectors_path is empty, float32 copies of the vectors are kept in an
+    ExactVectorStore so searches can re-rank their candidates exactly.
+    Searches can be restricted by item metadata through an AttributeIndex
+    (see attribute_index.py).
+
+    build() reads the database without holding the lock. Writes that land
+    meanwhile are applied to the current index and also logged, and the log is
+    replayed onto the new index before it is swapped in, so none is lost.
+    Rebuilds triggered by tombstones run on a background thread for the same
+    reason: the write that crosses TOMBSTONE_REBUILD_RATIO returns at once.
+    """
+
+    def __init__(self, pipeline=None, index_type=INDEX_TYPE, vectors_path=RERANK_VECTORS_PATH):
+        self.pipeline = pipeline or EmbeddingPipeline()
+        self.index_type = index_type
+        self.factory_string = None
+        self.index = None
+        self.dim = None
+        self.metadata = ImageTable()  # Image.id -> item_id, filename, s3_key
+        self.tombstones = 0  # deleted vectors still inside an index that can't remove them
+        self.live_selection = None  # FilterSelection of self.metadata's ids, built while there are tombstones
+        self.builds = 0  # full builds since startup, including tombstone-triggered rebuilds
+        self.last_build_seconds = None
+        self.exact = ExactVectorStore(vectors_path) if vectors_path else None
+        self.attributes = AttributeIndex()
+        self.lock = ReadWriteLock()  # searches share it; writes and swaps take it alone
+        self.build_lock = threading.Lock()  # one build at a time
+        self.build_log = None  # writes made while a build loads, replayed onto the new index
+        self.compaction = None  # thread rebuilding the index after tombstones piled up
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def stats(self):
+        with self.lock.read():
+            return {
+                "size": len(self.metadata),
+                "index_type": self.index_type,
+                "structure": self.factory_string,
+                "tombstones": self.tombstones,
+                "builds": self.builds,
+                "last_build_seconds": self.last_build_seconds,
+                "embedding_version": self.pipeline.version,
+                "rerank_factor": rerank_factor(),
+                "exact_vectors": self.exact.stats() if self.exact is not None else None,
+                "filters": self.attributes.stats(),
+            }
+
+    def _version_filter(self):
+        version = self.pipeline.version
+        if version == RAW_VERSION:
+            return (Image.embedding_version == None) | (Image.embedding_version == RAW_VERSION)
+        return Image.embedding_version == version
+
+    def _read_rows(self, queries, count):
+        """
+        Stream (id, item_id, filename, s3_key, vector) rows from queries through
+        a server-side cursor, decoding each vector straight into one float32
+        array preallocated for count rows. No ORM objects are built and each
+        vector exists once in Python memory.
+        Returns (ids, ImageTable, vectors); vectors is None if there are none.
+        """
+        table = ImageTable()
+        ids = np.empty(count, dtype=np.int64)
+        vectors = None
+        n = 0
+        chunk = []
+        for query in queries:
+            for row in query.yield_per(INDEX_LOAD_CHUNK):
+                vector = np.frombuffer(row.vector, dtype=self.pipeline.dtype)
+                if vectors is None:
+                    vectors = np.empty((len(ids), len(vector)), dtype=np.float32)
+                if n == len(ids):
+                    # Rows were added after they were counted
+                    ids, vectors = _grow(ids, n + 1), _grow(vectors, n + 1)
+                ids[n] = row.id
+                vectors[n] = vector
+                n += 1
+                chunk.append(row)
+                if len(chunk) == INDEX_LOAD_CHUNK:
+                    table.add(*zip(*((r.id, r.item_id, r.filename, r.s3_key) for r in chunk)))
+                    chunk = []
+        if chunk:
+            table.add(*zip(*((r.id, r.item_id, r.filename, r.s3_key) for r in chunk)))
+        return ids[:n], table, (vectors[:n] if n else None)
+
+    @staticmethod
+    def _row_query(db):
+        return db.query(Image.id, Image.item_id, Image.filename, Image.s3_key, Image.vector)
+
+    def load_vectors(self):
+        """
+        Read every vector stored in the pipeline's current format.
+        Returns (ids, ImageTable, vectors); vectors is None if there are none.
+        """
+        db: Session = SessionLocal()
+        try:
+            query = self._row_query(db).filter(Image.vector != None, self._version_filter())
+            return self._read_rows([query], query.count())
+        finally:
+            db.close()
+
+    def build(self):
+        """
+        Load every stored vector from the database and build a fresh index.
+        Rows stored under a different embedding version are skipped until backfilled.
+        """
+        with self.build_lock:
+            start = time.perf_counter()
+            with self.lock.write():
+                self.build_log = []
+            try:
+                self._build()
+            finally:
+                with self.lock.write():
+                    self.build_log = None
+                elapsed = time.perf_counter() - start
+                INDEX_BUILD_SECONDS.observe(elapsed)
+                self.builds += 1
+                self.last_build_seconds = elapsed
+
+    def _load_attributes(self):
+        """Read every item's meta_text into the attribute index."""
+        db: Session = SessionLocal()
+        try:
+            meta_texts = dict(db.query(Item.id, Item.meta_text).filter(Item.meta_text != None).all())
+        finally:
+            db.close()
+        with self.lock.write():
+            self.attributes.set_items(meta_texts)
+
+    def _build(self):
+        self._load_attributes()
+        ids, metadata, vectors = self.load_vectors()
+        if vectors is None:
+            with self.lock.write():
+                self.index, self.dim, self.metadata, self.factory_string = None, None, ImageTable(), None
+                self.tombstones = 0
+                self.live_selection = None
+                self.attributes.invalidate()
+                self._replay_build_log()
+            return
+        dim = vectors.shape[1]
+        factory_string = resolve_index_type(self.index_type, len(vectors), dim, self.pipeline.dtype)
+        index = faiss.IndexIDMap(create_index(factory_string, dim, self.pipeline, vectors))
+        index.add_with_ids(vectors, ids)
+        with self.lock.write():
+            self.index, self.dim, self.metadata = index, dim, metadata
+            self.factory_string = factory_string
+            self.tombstones = 0
+            self.live_selection = None
+            self.attributes.invalidate()
+            if self.exact is not None:
+                self.exact.rebuild(ids, vectors, dim, self.pipeline.version)
+            self._replay_build_log()
+
+    def _replay_build_log(self):
+        """
+        Apply the writes logged since the build started to the new index; the
+        caller must hold the write lock. The load may already have seen some
+        of them, which replaying again leaves unchanged.
+        """
+        log, self.build_log = self.build_log, None
+        for method, args in log or ():
+            method(*args)
+
+    def _create_empty_index(self, dim, n):
+        """Start an empty index sized for a first write of n vectors; the caller must hold the write lock."""
+        self.dim = dim
+        self.factory_string = resolve_index_type(self.index_type, n, dim, self.pipeline.dtype)
+        inner = create_index(self.factory_string, dim, self.pipeline)
+        if inner is None:
+            # Nothing to train on yet; serve exact search until the next build()
+            self.factory_string = "Flat"
+            inner = self.pipeline.new_index(dim)
+        self.index = faiss.IndexIDMap(inner)
+
+    def _discard(self, ids):
+        """Drop ids from the index, or count them as tombstones if it can't remove."""
+        if supports_remove(self.index):
+            self.index.remove_ids(ids)
+        else:
+            self.tombstones += len(ids)
+
+    def _store_exact(self, ids, vectors):
+        """Keep float32 copies of vectors added to the index; the caller must hold the write lock."""
+        if self.exact is None:
+            return
+        if self.exact.dim != self.dim or self.exact.version != self.pipeline.version:
+            self.exact.open(self.dim, self.pipeline.version)
+        self.exact.put(ids, vectors)
+
+    def _needs_compaction(self):
+        return self.tombstones > TOMBSTONE_REBUILD_RATIO * max(self.index.ntotal, 1)
+
+    def _load_rows(self, image_ids):
+        """Read (ids, ImageTable, vectors) for specific Image.ids, in chunks."""
+        image_ids = [int(i) for i in image_ids]
+        db: Session = SessionLocal()
+        try:
+            queries = (self._row_query(db).filter(Image.id.in_(image_ids[start:start + INDEX_LOAD_CHUNK]),
+                                                  self._version_filter())
+                       for start in range(0, len(image_ids), INDEX_LOAD_CHUNK))
+            return self._read_rows(queries, len(image_ids))
+        finally:
+            db.close()
+
+    def _live_ids(self):
+        """Sorted ids of every row stored in the current format, streamed."""
+        db: Session = SessionLocal()
+        try:
+            query = db.query(Image.id).filter(Image.vector != None, self._version_filter())
+            ids = np.fromiter((row.id for row in query.yield_per(INDEX_LOAD_CHUNK * 10)), dtype=np.int64)
+        finally:
+            db.close()
+        return np.sort(ids)
+
+    def catch_up(self):
+        """
+        Bring a loaded snapshot up to date with the database: add rows that are
+        newer than the snapshot (or were backfilled since) and drop rows deleted
+        since. Only ids are scanned; vectors are read just for the new rows
+        (and for rows missing from the exact-vector store).
+        Returns (added, removed).
+        """
+        self._load_attributes()
+        live = self._live_ids()
+        with self.lock.read():
+            known = self.metadata.ids()
+        removed = np.setdiff1d(known, live, assume_unique=True)
+        if len(removed):
+            self.remove(removed)
+        ids, metadata, vectors = self._load_rows(np.setdiff1d(live, known, assume_unique=True))
+        if vectors is not None:
+            self._write(self._add_rows, ids, vectors, metadata)
+        if self.exact is not None:
+            # Rows the store lost (deleted file, crash, another process's rebuild) are refilled
+            with self.lock.read():
+                missing = self.exact.missing(self.metadata.ids()) if self.exact.dim == self.dim else []
+            if len(missing):
+                fill_ids, _, fill_vectors = self._load_rows(missing)
+                if fill_vectors is not None:
+                    with self.lock.write():
+                        self._store_exact(fill_ids, fill_vectors)
+        return len(ids), len(removed)
+
+    def save_snapshot(self, path=INDEX_SNAPSHOT_PATH):
+        """Write the index and its id->metadata map to path (atomically replaced)."""
+        if not path:
+            return False
+        with self.lock.read():
+            if self.index is None:
+                return False
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            columns = self.metadata.columns()
+            ids = columns["ids"]
+            header = {
+                "format": SNAPSHOT_FORMAT,
+                "embedding_version": self.pipeline.version,
+                "index_type": self.index_type,
+                "factory_string": self.factory_string,
+                "tombstones": self.tombstones,
+                "count": len(ids),
+                "max_id": int(ids.max()) if len(ids) else 0,
+                "saved_at": time.time(),
+            }
+            if self.exact is not None:
+                self.exact.flush()
+            # Unique temp names: several workers may save at once
+            index_tmp, meta_tmp = _temp_path(path), _temp_path(path + ".meta")
+            try:
+                faiss.write_index(self.index, index_tmp)
+                with open(meta_tmp, "wb") as f:
+                    np.savez(f, **columns, header=np.array(json.dumps(header)))
+            except BaseException:
+                os.remove(index_tmp)
+                os.remove(meta_tmp)
+                raise
+        os.replace(meta_tmp, path + ".meta")
+        os.replace(index_tmp, path)
+        return True
+
+    def load_snapshot(self, path=INDEX_SNAPSHOT_PATH, mmap=INDEX_SNAPSHOT_MMAP):
+        """
+        Load a snapshot written by save_snapshot(), memory-mapping the index so
+        workers share its pages through the OS page cache. Returns False if
+        there is no usable snapshot for the current configuration, including
+        when the files can't be read (truncated or corrupt).
+        """
+        if not path or not (os.path.exists(path) and os.path.exists(path + ".meta")):
+            return False
+        try:
+            snapshot = self._read_snapshot(path, mmap)
+        except Exception as e:
+            print(f"Ignoring snapshot {path}: {type(e).__name__}: {e}")
+            return False
+        if snapshot is None:
+            return False
+        header, metadata, index = snapshot
+        with self.lock.write():
+            self.index, self.dim, self.metadata = index, index.d, metadata
+            self.factory_string = header["factory_string"]
+            self.tombstones = header.get("tombstones", 0)
+            self.live_selection = None
+            self.attributes.invalidate()
+            if self.exact is not None:
+                self.exact.open(index.d, self.pipeline.version)
+        return True
+
+    def _read_snapshot(self, path, mmap):
+        """(header, ImageTable, index) from the snapshot files, or None if they don't fit this configuration."""
+        with np.load(path + ".meta") as data:
+            header = json.loads(str(data["header"]))
+            if (header.get("format") != SNAPSHOT_FORMAT
+                    or header.get("embedding_version") != self.pipeline.version
+                    or header.get("index_type") != self.index_type):
+                return None
+            metadata = ImageTable.from_columns(data)
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP) if mmap else faiss.read_index(path)
+        if index.ntotal != header["count"] + header.get("tombstones", 0):
+            return None  # index and metadata files come from different saves
+        if mmap and isinstance(faiss.downcast_index(index.index), faiss.IndexIVF):
+            # Memory-mapped IVF lists are read-only; load those into memory instead
+            index = faiss.read_index(path)
+        return header, metadata, index
+
+    def warm_start(self, path=INDEX_SNAPSHOT_PATH):
+        """
+        Start from the snapshot at path and catch up from the database, falling
+        back to a full build(). The snapshot is refreshed if anything changed.
+        """
+        if self.load_snapshot(path):
+            added, removed = self.catch_up()
+            if added or removed:
+                self.save_snapshot(path)
+            return "snapshot"
+        self.build()
+        self.save_snapshot(path)
+        return "build"
+
+    def add(self, image, vector):
+        """Add (or replace) a single image's vector."""
+        self.add_many([image], [vector])
+
+    def add_many(self, images, vectors):
+        """Add (or replace) several images' vectors with one add_with_ids call."""
+        if not len(images):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(images), -1)
+        ids = np.array([image.id for image in images], dtype=np.int64)
+        rows = ImageTable()
+        rows.add(ids, [image.item_id for image in images], [image.filename for image in images],
+                 [image.s3_key for image in images])
+        self._write(self._add_rows, ids, vectors, rows)
+
+    def remove(self, image_ids):
+        """Remove the given Image.ids from the index and the metadata map."""
+        return self._write(self._remove_ids, np.fromiter(image_ids, dtype=np.int64))
+
+    def set_item_attributes(self, item_id, meta_text):
+        """Update the attributes an item is filtered by after its meta_text changed."""
+        with self.lock.write():
+            self.attributes.set_items({item_id: meta_text})
+            if self.build_log is not None:
+                self.build_log.append((self.attributes.set_items, ({item_id: meta_text},)))
+
+    def _write(self, method, *args):
+        """
+        Apply a write under the lock, logging it while a build is loading, and
+        start a background rebuild once tombstones pile up. Returns what method returns.
+        """
+        with self.lock.write():
+            result = method(*args)
+            if self.build_log is not None:
+                self.build_log.append((method, args))
+            # A running build compacts anyway
+            if (self.build_log is None and self.compaction is None
+                    and self.index is not None and self._needs_compaction()):
+                self.compaction = threading.Thread(target=self._compact, name="index-compaction", daemon=True)
+                self.compaction.start()
+        return result
+
+    def _compact(self):
+        """Rebuild without tombstones; runs on the compaction thread."""
+        try:
+            self.build()
+        except Exception as e:
+            # The tombstones stay and the next write tries again
+            print(f"Index compaction failed: {type(e).__name__}: {e}")
+        finally:
+            with self.lock.write():
+                self.compaction = None
+
+    def _add_rows(self, ids, vectors, rows):
+        """Add (or replace) vectors whose metadata is in the ImageTable rows; the caller must hold the write lock."""
+        items = set(rows.items)
+        if self.index is None:
+            # Nothing built yet (empty database)
+            self._create_empty_index(vectors.shape[1], len(ids))
+        else:
+            replaced = ids[self.metadata.present(ids)]
+            if len(replaced):
+                # A replaced image may move to another item
+                items.update(self.metadata.item_ids(replaced))
+                self._discard(replaced)
+        self.index.add_with_ids(vectors, ids)
+        self._store_exact(ids, vectors)
+        self.metadata.merge(rows)
+        self.live_selection = None
+        self.attributes.invalidate(items)
+
+    def _remove_ids(self, ids):
+        """Remove ids from the index; returns how many were present. The caller must hold the write lock."""
+        ids = np.unique(ids)
+        ids = ids[self.metadata.present(ids)]
+        if not len(ids):
+            return 0
+        items = set(self.metadata.item_ids(ids))
+        self.metadata.remove(ids)
+        self._discard(ids)
+        if self.exact is not None and self.exact.dim is not None:
+            self.exact.discard(ids)
+        self.live_selection = None
+        self.attributes.invalidate(items)
+        return len(ids)
+
+    def _search(self, query_feat, k, nprobe=None, ef_search=None, selection=None):
+        """
+        Raw FAISS search for k neighbours, within selection if given; the
+        caller must hold the lock. Deleted vectors an index couldn't remove are
+        skipped by FAISS itself, through a selector over the live ids.
+        """
+        if selection is None and self.tombstones:
+            if self.live_selection is None:
+                # Concurrent searches may both build it; either copy is current
+                self.live_selection = FilterSelection(self.metadata.ids())
+            selection = self.live_selection
+        params = search_params(self.index, nprobe, ef_search, selection.selector if selection is not None else None)
+        if params is not None:
+            return self.index.search(query_feat, k, params=params)
+        return self.index.search(query_feat, k)
+
+    def _live_hits(self, distances, ids):
+        """Map one row of FAISS hits to (image_id, metadata, distance), dropping deleted and duplicate ids."""
+        results = []
+        seen = set()
+        for image_id, dist in zip(ids, distances):
+            image_id = int(image_id)
+            meta = self.metadata.get(image_id)
+            if meta is not None and image_id not in seen:
+                seen.add(image_id)
+                results.append((image_id, meta, float(self.pipeline.to_distance(dist))))
+        return results
+
+    def _exact_ready(self):
+        return self.exact is not None and self.exact.dim == self.dim
+
+    def _rerank_factor(self, rerank):
+        """The re-rank factor for a call; 0 when there are no exact vectors to re-rank against."""
+        if not self._exact_ready():
+            return 0
+        return rerank_factor(rerank)
+
+    def _rerank(self, query, hits):
+        """
+        Re-score hits exactly against the stored float32 vectors and sort them.
+        Hits without a stored vector keep the index's distance.
+        """
+        if not hits:
+            return hits
+        with STAGE_SECONDS.time(stage="rerank"):
+            ids = np.fromiter((image_id for image_id, _, _ in hits), dtype=np.int64, count=len(hits))
+            vectors, found = self.exact.get(ids)
+            distances = np.where(found, self.pipeline.exact_distances(query, vectors),
+                                 np.array([dist for _, _, dist in hits], dtype=np.float32))
+            order = np.argsort(distances, kind="stable")
+            return [(hits[i][0], hits[i][1], float(distances[i])) for i in order]
+
+    def _select(self, filters):
+        """The FilterSelection for filters, or None when unfiltered; the caller must hold the lock."""
+        return self.attributes.select(filters, self.metadata.ids_of_items) if filters else None
+
+    def _scan_selection(self, query, selection, k):
+        """
+        Score a selection of at most FILTER_EXACT_MAX images directly against
+        the exact vectors and return its k best hits. Returns None when the
+        index has to be searched instead. The caller must hold the lock.
+        """
+        if len(selection) > FILTER_EXACT_MAX or not self._exact_ready():
+            return None
+        vectors, found = self.exact.get(selection.ids)
+        if not found.all():
+            return None
+        distances = self.pipeline.exact_distances(query, vectors)
+        order = np.argsort(distances, kind="stable")[:k]
+        return [(int(selection.ids[i]), self.metadata.get(int(selection.ids[i])), float(distances[i]))
+                for i in order if int(selection.ids[i]) in self.metadata]
+
+    def _fetch_count(self, wanted, selection, limit=None):
+        """
+        How many neighbours to ask FAISS for: wanted, capped by what the index
+        (or the selection) can return. Deleted vectors are excluded by _search,
+        but a replaced image's old vector can still come back as a duplicate
+        hit, so up to wanted more are fetched while there are tombstones.
+        """
+        extra = min(self.tombstones, wanted)
+        limit = self.index.ntotal if limit is None else limit
+        if selection is not None:
+            limit = min(limit, len(selection) + min(self.tombstones, len(selection)))
+        return max(1, min(wanted + extra, limit))
+
+    def search(self, query_feat, topk=5, nprobe=None, ef_search=None, rerank=None, filters=None):
+        """
+        Return up to topk (image_id, metadata, distance) tuples.
+        Ids that are no longer in the metadata map are skipped, so a result
+        can never point at an image that has been deleted. nprobe/ef_search
+        override the IVF/HNSW search settings for this call. With a re-rank
+        factor r (rerank, default RERANK_FACTOR), topk*r candidates are fetched
+        and re-scored exactly before the top topk are returned. filters (see
+        attribute_index.parse_filters) restricts the search to matching items.
+        """
+        query_feat = np.asarray(query_feat, dtype=np.float32).reshape(1, -1)
+        with self.lock.read():
+            if self.index is None or not self.metadata:
+                return []
+            selection = self._select(filters)
+            if selection is not None:
+                if not len(selection):
+                    return []
+                hits = self._scan_selection(query_feat[0], selection, topk)
+                if hits is not None:
+                    return hits
+            factor = self._rerank_factor(rerank)
+            k = self._fetch_count(topk * max(factor, 1), selection)
+            D, I = self._search(query_feat, k, nprobe, ef_search, selection)
+            hits = self._live_hits(D[0], I[0])
+            if factor:
+                hits = self._rerank(query_feat[0], hits)
+            return hits[:topk]
+
+    def search_batch(self, query_feats, topk=5, nprobe=None, ef_search=None, rerank=None, filters=None):
+        """search() for many queries at once: one multi-row FAISS search, one result list per row."""
+        query_feats = np.asarray(query_feats, dtype=np.float32).reshape(len(query_feats), -1)
+        with self.lock.read():
+            if self.index is None or not self.metadata:
+                return [[] for _ in range(len(query_feats))]
+            selection = self._select(filters)
+            if selection is not None:
+                if not len(selection):
+                    return [[] for _ in range(len(query_feats))]
+                results = [self._scan_selection(query, selection, topk) for query in query_feats]
+                if all(hits is not None for hits in results):
+                    return results
+            factor = self._rerank_factor(rerank)
+            k = self._fetch_count(topk * max(factor, 1), selection)
+            D, I = self._search(query_feats, k, nprobe, ef_search, selection)
+            results = []
+            for query, d, i in zip(query_feats, D, I):
+                hits = self._live_hits(d, i)
+                if factor:
+                    hits = self._rerank(query, hits)
+                results.append(hits[:topk])
+            return results
+
+    def search_items(self, query_feat, topk=5, mode="min", top_m=3, nprobe=None, ef_search=None, rerank=None,
+                     filters=None):
+        """
+        Item-level search: return up to topk (item_id, score, best_hit, hit_count)
+        tuples, where best_hit is the item's closest (image_id, metadata, distance).
+        A bounded candidate set is over-fetched and aggregated per item with
+        aggregate_by_item; it is widened only while too few distinct items come back.
+        With re-ranking the candidates are re-scored exactly before aggregation.
+        """
+        query_feat = np.asarray(query_feat, dtype=np.float32).reshape(1, -1)
+        with self.lock.read():
+            if self.index is None or not self.metadata:
+                return []
+            selection = self._select(filters)
+            hits = None
+            if selection is not None:
+                if not len(selection):
+                    return []
+                hits = self._scan_selection(query_feat[0], selection, ITEM_MAX_CANDIDATES)
+            if hits is not None:
+                if not hits:
+                    return []
+                item_ids, hit_items = np.unique([meta["item_id"] for _, meta, _ in hits], return_inverse=True)
+                items, scores = aggregate_by_item(hit_items, [dist for _, _, dist in hits], mode, top_m)
+            else:
+                factor = self._rerank_factor(rerank)
+                limit = self._fetch_count(ITEM_MAX_CANDIDATES, selection)
+                k = self._fetch_count(topk * ITEM_FETCH_FACTOR * max(factor, 1), selection, limit)
+                while True:
+                    D, I = self._search(query_feat, k, nprobe, ef_search, selection)
+                    hits = self._live_hits(D[0], I[0])
+                    if factor:
+                        hits = self._rerank(query_feat[0], hits)
+                    item_ids, hit_items = np.unique([meta["item_id"] for _, meta, _ in hits], return_inverse=True)
+                    items, scores = aggregate_by_item(hit_items, [dist for _, _, dist in hits], mode, top_m)
+                    if len(items) >= topk or k >= limit:
+                        break
+                    k = min(k * 2, limit)
+        if not hits:
+            return []
+        hit_count = np.bincount(hit_items, minlength=len(item_ids))
+        # Hits are ordered best first, so the first hit of each item is its best
+        best_hit = {}
+        for hit, item in zip(hits, hit_items):
+            best_hit.setdefault(int(item), hit)
+        return [(str(item_ids[i]), float(score), best_hit[int(i)], int(hit_count[i]))
+                for i, score in zip(items[:topk], scores[:topk])]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the FAISS index from the database and write a snapshot.")
+    parser.add_argument("--path", default=INDEX_SNAPSHOT_PATH, help="Snapshot file to write")
+    parser.add_argument("--catch-up", action="store_true",
+                        help="Start from the existing snapshot and apply DB changes instead of a full build")
+    args = parser.parse_args()
+
+    manager = FaissIndexManager()
+    start = time.perf_counter()
+    if args.catch_up and manager.load_snapshot(args.path):
+        added, removed = manager.catch_up()
+        print(f"Caught up snapshot: {added} added, {removed} removed")
+    else:
+        manager.build()
+    if manager.save_snapshot(args.path):
+        print(f"Wrote {len(manager)} vectors ({manager.factory_string}) to {args.path} "
+              f"in {time.perf_counter() - start:.1f}s")
+    else:
+        print("No vectors to snapshot")
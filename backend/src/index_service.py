@@ -0,0 +1,239 @@
+"""
+Serve one FaissIndexManager to every API worker over a Unix socket.
+
+Without it each uvicorn worker holds a private copy of the index and only sees
+its own writes. With INDEX_SERVICE_SOCKET set, app.py talks to this process
+through IndexClient instead: writes are applied one at a time in arrival order,
+each bumps a generation number, and a write is acknowledged only once it is
+visible to every later search from any worker.
+
+Start the service before the API workers:
+    INDEX_SERVICE_SOCKET=data/index.sock python -m src.index_service
+    INDEX_SERVICE_SOCKET=data/index.sock uvicorn src.app:app --workers 4
+
+Calls are pickled, so only clients that know the service's authkey may
+connect: INDEX_SERVICE_AUTHKEY, or else a random key the service writes to
+"<socket>.key" (mode 0600) for clients running as the same user.
+"""
+import os
+import secrets
+import signal
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+# Unix socket the service listens on; empty keeps the index inside each API process
+INDEX_SERVICE_SOCKET = os.getenv("INDEX_SERVICE_SOCKET", "")
+# How long an API worker waits for the service to come up
+INDEX_SERVICE_CONNECT_TIMEOUT = float(os.getenv("INDEX_SERVICE_CONNECT_TIMEOUT", "30"))
+# Shared secret clients authenticate with; empty uses the key file beside the socket
+INDEX_SERVICE_AUTHKEY = os.getenv("INDEX_SERVICE_AUTHKEY", "")
+
+# The parts of an Image row the index keeps, sent instead of the ORM object
+ImageRef = namedtuple("ImageRef", ["id", "item_id", "filename", "s3_key"])
+
+READ_METHODS = {"search", "search_batch", "search_items", "stats"}
+WRITE_METHODS = {"add", "add_many", "remove", "build", "catch_up", "set_item_attributes"}
+ADMIN_METHODS = {"save_snapshot"}
+
+
+def read_authkey(address):
+    """The key clients of the service at address authenticate with. Raises FileNotFoundError before it starts."""
+    if INDEX_SERVICE_AUTHKEY:
+        return INDEX_SERVICE_AUTHKEY.encode()
+    with open(address + ".key", "rb") as f:
+        return f.read()
+
+
+def create_authkey(address):
+    """Return the service's key, first writing a random one readable only by this user if there is none."""
+    if INDEX_SERVICE_AUTHKEY:
+        return INDEX_SERVICE_AUTHKEY.encode()
+    path = address + ".key"
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Kept across restarts, so connected workers can reconnect
+        os.chmod(path, 0o600)
+        return read_authkey(address)
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+class IndexService:
+    """Owns the index and answers IndexClient calls, one thread per connection."""
+
+    def __init__(self, manager, address=INDEX_SERVICE_SOCKET):
+        self.manager = manager
+        self.address = address
+        self.generation = 0
+        self.write_lock = threading.Lock()
+
+    def stats(self):
+        return {**self.manager.stats(), "generation": self.generation}
+
+    def handle(self, method, args, kwargs):
+        """Run one call and return (result, generation)."""
+        if method in WRITE_METHODS:
+            with self.write_lock:
+                result = getattr(self.manager, method)(*args, **kwargs)
+                self.generation += 1
+                return result, self.generation
+        if method in READ_METHODS or method in ADMIN_METHODS:
+            # Searches see at least this generation; writes never interleave within one
+            generation = self.generation
+            target = self if method == "stats" else self.manager
+            return getattr(target, method)(*args, **kwargs), generation
+        raise ValueError(f"Unknown index service method: {method}")
+
+    def _accept(self, listener):
+        """The next authenticated connection; clients with the wrong key are dropped."""
+        while True:
+            try:
+                return listener.accept()
+            except (AuthenticationError, EOFError, OSError) as e:
+                print(f"Index service rejected a connection: {type(e).__name__}: {e}")
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result, generation = self.handle(method, args, kwargs)
+                    conn.send(("ok", result, generation))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {e}", self.generation))
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # left behind by a previous run
+        os.makedirs(os.path.dirname(self.address) or ".", exist_ok=True)
+        authkey = create_authkey(self.address)
+        with Listener(self.address, family="AF_UNIX", authkey=authkey) as listener:
+            os.chmod(self.address, 0o600)
+            while True:
+                conn = self._accept(listener)
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+
+class IndexClient:
+    """
+    Drop-in for FaissIndexManager in the API workers, forwarding calls to the
+    index service. Each thread keeps its own connection; a dropped connection
+    is reopened and the call retried once (every write is idempotent).
+    """
+
+    def __init__(self, address=INDEX_SERVICE_SOCKET, connect_timeout=INDEX_SERVICE_CONNECT_TIMEOUT):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.generation = 0  # newest generation any call has seen
+        self._local = threading.local()
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, family="AF_UNIX", authkey=read_authkey(self.address))
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Index service is not listening on {self.address}")
+                time.sleep(0.2)
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in (0, 1):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            try:
+                conn.send((method, args, kwargs))
+                status, result, generation = conn.recv()
+                break
+            except (EOFError, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        self.generation = max(self.generation, generation)
+        if status == "error":
+            raise RuntimeError(f"Index service {method} failed: {result}")
+        return result
+
+    def __len__(self):
+        return self.stats()["size"]
+
+    def stats(self):
+        return self._call("stats")
+
+    def add(self, image, vector):
+        ref = ImageRef(image.id, image.item_id, image.filename, image.s3_key)
+        return self._call("add", ref, np.asarray(vector, dtype=np.float32))
+
+    def add_many(self, images, vectors):
+        refs = [ImageRef(image.id, image.item_id, image.filename, image.s3_key) for image in images]
+        return self._call("add_many", refs, np.asarray(vectors, dtype=np.float32))
+
+    def remove(self, image_ids):
+        return self._call("remove", [int(i) for i in image_ids])
+
+    def set_item_attributes(self, item_id, meta_text):
+        return self._call("set_item_attributes", item_id, meta_text)
+
+    def build(self):
+        return self._call("build")
+
+    def catch_up(self):
+        return self._call("catch_up")
+
+    def search(self, query_feat, topk=5, nprobe=None, ef_search=None, rerank=None, filters=None):
+        return self._call("search", np.asarray(query_feat, dtype=np.float32), topk,
+                          nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=filters)
+
+    def search_batch(self, query_feats, topk=5, nprobe=None, ef_search=None, rerank=None, filters=None):
+        return self._call("search_batch", np.asarray(query_feats, dtype=np.float32), topk,
+                          nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=filters)
+
+    def search_items(self, query_feat, topk=5, mode="min", top_m=3, nprobe=None, ef_search=None, rerank=None,
+                     filters=None):
+        return self._call("search_items", np.asarray(query_feat, dtype=np.float32), topk, mode=mode, top_m=top_m,
+                          nprobe=nprobe, ef_search=ef_search, rerank=rerank, filters=filters)
+
+    def save_snapshot(self):
+        return self._call("save_snapshot")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .db import ensure_schema
+    from .index_manager import FaissIndexManager
+
+    parser = argparse.ArgumentParser(description="Serve the FAISS index to the API workers over a Unix socket.")
+    parser.add_argument("--socket", default=INDEX_SERVICE_SOCKET or "data/index.sock", help="Unix socket path")
+    args = parser.parse_args()
+
+    ensure_schema()  # the service may start before any API worker has created the tables
+    manager = FaissIndexManager()
+    start = time.perf_counter()
+    how = manager.warm_start()
+    print(f"Index ready from {how}: {len(manager)} vectors ({manager.factory_string}) "
+          f"in {time.perf_counter() - start:.1f}s, listening on {args.socket}")
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    # SIGTERM (docker stop, systemd) shuts down like Ctrl-C so the snapshot is saved
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        IndexService(manager, args.socket).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.save_snapshot()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,226 @@
+"""
+Runtimes the feature extractor can run ResNet-50 on.
+
+EXTRACT_BACKEND selects one at startup:
+- "eager" (default): plain PyTorch fp32
+- "torchscript": traced, frozen and optimized for inference
+- "compile": torch.compile (the first batches are slow while it compiles)
+- "onnx": exported once to ONNX and run with ONNX Runtime (needs `pip install onnxruntime onnx`)
+- "int8": static int8 quantization, calibrated on images from EXTRACT_CALIBRATION_DIR
+
+Every backend produces the same (n, 2048) features up to numerical error.
+Measure how close, and how fast, against the fp32 baseline on your own images:
+    python -m src.inference_backends --images data/images --backends torchscript onnx int8
+"""
+import copy
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+EXTRACT_BACKEND = os.getenv("EXTRACT_BACKEND", "eager")
+# NHWC activations for the torch backends; oneDNN convolutions run faster on them
+EXTRACT_CHANNELS_LAST = os.getenv("EXTRACT_CHANNELS_LAST", "true").lower() in ("1", "true", "yes")
+# Where exported ONNX and int8 models are kept between restarts
+EXTRACT_MODEL_DIR = os.getenv("EXTRACT_MODEL_DIR", "data/models")
+# Images used to calibrate int8 activation ranges; only needed until the int8 model is saved
+EXTRACT_CALIBRATION_DIR = os.getenv("EXTRACT_CALIBRATION_DIR", "")
+EXTRACT_CALIBRATION_IMAGES = int(os.getenv("EXTRACT_CALIBRATION_IMAGES", "256"))
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx", "int8")
+ONNX_FILENAME = "resnet50.onnx"
+INT8_FILENAME = "resnet50-int8.pt"
+CALIBRATION_BATCH_SIZE = 32
+
+
+def _example_input(device):
+    return torch.zeros(1, 3, 224, 224, device=device)
+
+
+def _to_numpy(features):
+    return features.detach().cpu().numpy().reshape(len(features), -1)
+
+
+def _torch_forward(module, channels_last):
+    def forward(batch):
+        if channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            return _to_numpy(module(batch))
+    return forward
+
+
+def _eager(model, device, channels_last, **kwargs):
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return _torch_forward(model, channels_last)
+
+
+def _torchscript(model, device, channels_last, **kwargs):
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    example = _example_input(device)
+    if channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(model, example)))
+    return _torch_forward(scripted, channels_last)
+
+
+def _compile(model, device, channels_last, **kwargs):
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return _torch_forward(torch.compile(model), channels_last)
+
+
+def _save_atomically(path, write):
+    """write() a file to a unique temp name beside path, then move it onto path; workers may export at once."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def _onnx(model, device, channels_last, model_dir=EXTRACT_MODEL_DIR, **kwargs):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("EXTRACT_BACKEND=onnx needs onnxruntime: pip install onnxruntime onnx")
+    path = os.path.join(model_dir, ONNX_FILENAME)
+    if not os.path.exists(path):
+        _save_atomically(path, lambda tmp: torch.onnx.export(
+            model.cpu(), _example_input("cpu"), tmp, input_names=["input"], output_names=["features"],
+            dynamic_axes={"input": {0: "batch"}, "features": {0: "batch"}}, dynamo=False))
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def forward(batch):
+        features = session.run(None, {"input": batch.cpu().numpy()})[0]
+        return features.reshape(len(features), -1)
+    return forward
+
+
+def calibration_batches(root, limit=EXTRACT_CALIBRATION_IMAGES, batch_size=CALIBRATION_BATCH_SIZE):
+    """Preprocessed (n, 3, 224, 224) batches from up to limit images found under root."""
+    from .feature_extractor import FeatureExtractor, PREPROCESS
+    paths = []
+    for dirpath, _, filenames in sorted(os.walk(root)):
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                     if f.lower().endswith((".jpg", ".jpeg", ".png")))
+    paths = paths[:limit]
+    for i in range(0, len(paths), batch_size):
+        yield torch.stack([PREPROCESS(FeatureExtractor.load_image(p)) for p in paths[i:i + batch_size]])
+
+
+def quantize_int8(model, batches):
+    """Static int8 post-training quantization (FX graph mode), calibrated on batches."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+    prepared = prepare_fx(copy.deepcopy(model).cpu(), get_default_qconfig_mapping(torch.backends.quantized.engine),
+                          (_example_input("cpu"),))
+    calibrated = 0
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch)
+            calibrated += len(batch)
+    if not calibrated:
+        raise RuntimeError("No calibration images found for the int8 backend; set EXTRACT_CALIBRATION_DIR")
+    return convert_fx(prepared)
+
+
+def _int8(model, device, channels_last, model_dir=EXTRACT_MODEL_DIR,
+          calibration_dir=EXTRACT_CALIBRATION_DIR, **kwargs):
+    if str(device) != "cpu":
+        raise ValueError("The int8 backend runs on CPU only")
+    path = os.path.join(model_dir, INT8_FILENAME)
+    if not os.path.exists(path):
+        if not calibration_dir:
+            raise RuntimeError(f"No int8 model at {path}; set EXTRACT_CALIBRATION_DIR to calibrate one")
+        quantized = quantize_int8(model, calibration_batches(calibration_dir))
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(quantized, _example_input("cpu")))
+        _save_atomically(path, lambda tmp: torch.jit.save(scripted, tmp))
+    return _torch_forward(torch.jit.load(path), False)
+
+
+_BUILDERS = {
+    "eager": _eager,
+    "torchscript": _torchscript,
+    "compile": _compile,
+    "onnx": _onnx,
+    "int8": _int8,
+}
+
+
+def build_backend(name, model, device, channels_last=EXTRACT_CHANNELS_LAST, **kwargs):
+    """
+    Wrap an eval-mode model in the named runtime. Returns forward(batch), which
+    maps a (n, 3, 224, 224) tensor to an (n, 2048) float32 array.
+    """
+    if name not in _BUILDERS:
+        raise ValueError(f"Unknown extract backend: {name} (expected one of {', '.join(BACKENDS)})")
+    channels_last = channels_last and str(device) == "cpu"
+    return _BUILDERS[name](model, device, channels_last, **kwargs)
+
+
+def cosine_parity(reference, candidate):
+    """Per-row cosine similarity between two (n, d) feature arrays."""
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return (reference * candidate).sum(axis=1) / np.maximum(norms, 1e-12)
+
+
+def compare(model, batches, backends, device="cpu", **kwargs):
+    """
+    Run every backend over batches and compare it with eager fp32 (without
+    channels-last). Returns one dict per backend with cosine parity and
+    mean milliseconds per batch.
+    """
+    batches = list(batches)
+    reference_forward = _eager(model, device, False)
+    reference = np.concatenate([reference_forward(b.to(device)) for b in batches])
+    results = []
+    for name in backends:
+        forward = build_backend(name, model, device, **kwargs)
+        forward(batches[0].to(device))  # warm-up (and compile, for "compile")
+        start = time.perf_counter()
+        features = np.concatenate([forward(b.to(device)) for b in batches])
+        elapsed = time.perf_counter() - start
+        parity = cosine_parity(reference, features)
+        results.append({
+            "backend": name,
+            "images": len(features),
+            "cosine_mean": float(parity.mean()),
+            "cosine_min": float(parity.min()),
+            "ms_per_batch": elapsed * 1000 / len(batches),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from .feature_extractor import FeatureExtractor
+
+    parser = argparse.ArgumentParser(description="Check extractor backends against the fp32 baseline.")
+    parser.add_argument("--images", required=True, help="Folder of images to compare on (searched recursively)")
+    parser.add_argument("--limit", type=int, default=64, help="Most images to compare on")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--calibration", default=EXTRACT_CALIBRATION_DIR,
+                        help="Images to calibrate int8 on, if no int8 model is saved yet (default: --images)")
+    args = parser.parse_args()
+
+    extractor = FeatureExtractor(device="cpu", backend="eager")
+    batches = calibration_batches(args.images, args.limit, args.batch_size)
+    for row in compare(extractor.model, batches, args.backends,
+                       calibration_dir=args.calibration or args.images):
+        print(json.dumps(row))
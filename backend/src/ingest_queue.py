@@ -0,0 +1,241 @@
+"""
+Asynchronous ingestion: /upload/ returns before the image is embedded.
+
+With INGEST_MODE=async, /upload/ stores the original in S3, inserts its Image
+row with ingest_status "pending" and no vector, and answers 202 at once. The
+images table is the queue. Workers claim pending rows in batches, extract them
+through a BatchScheduler, store the vectors in one transaction per batch, and
+add each batch to the index with a single add_many() call.
+GET /images/{image_id}/status reports where an upload is.
+
+Workers run inside the API process (INGEST_WORKERS threads), or separately
+next to an index service, with INGEST_WORKERS=0 on the API:
+    INDEX_SERVICE_SOCKET=data/index.sock python -m src.ingest_queue
+"""
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .db import Image, session_scope
+from .executors import io_executor
+from .index_service import ImageRef
+from .storage import download_bytes_from_s3
+from .uploads import DECODE_ERRORS, NOT_AN_IMAGE, EXTRACTION_FAILED
+
+# "sync" embeds during /upload/; "async" queues the image and returns 202
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+# Worker threads started inside the API process in async mode; 0 leaves it to src.ingest_queue
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+# Rows claimed, embedded and indexed together
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+# How long an idle worker sleeps before looking for new rows
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "1"))
+# /upload/ answers 503 while this many images are waiting to be embedded
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "1000"))
+# A claim older than this belongs to a worker that died; the rows are claimed again
+INGEST_CLAIM_TIMEOUT = float(os.getenv("INGEST_CLAIM_TIMEOUT", "600"))
+
+PENDING, PROCESSING, FAILED = "pending", "processing", "failed"
+# Stored in Image.ingest_error when the original can't be fetched from S3
+DOWNLOAD_FAILED = "The uploaded file could not be read back from storage"
+
+
+def backlog(db):
+    """Images queued or being embedded"""
+    return db.query(Image).filter(Image.ingest_status.in_((PENDING, PROCESSING))).count()
+
+
+def job_status(image):
+    """The ingestion state of an Image row as reported to clients"""
+    return {
+        "image_id": image.id,
+        "item_id": image.item_id,
+        "filename": image.filename,
+        "status": image.ingest_status or "done",
+        "error": image.ingest_error,
+    }
+
+
+def claim(db, limit=INGEST_BATCH_SIZE, claim_timeout=INGEST_CLAIM_TIMEOUT):
+    """
+    Mark up to limit pending rows (and rows whose claim has expired) as
+    processing and return them. Each row is claimed with a conditional
+    UPDATE, so concurrent workers never embed the same row.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=claim_timeout)
+    candidates = (db.query(Image.id)
+                  .filter((Image.ingest_status == PENDING)
+                          | ((Image.ingest_status == PROCESSING) & (Image.ingest_claimed_at < stale)))
+                  .order_by(Image.id).limit(limit).all())
+    claimed = []
+    for (image_id,) in candidates:
+        updated = (db.query(Image)
+                   .filter(Image.id == image_id,
+                           (Image.ingest_status == PENDING)
+                           | ((Image.ingest_status == PROCESSING) & (Image.ingest_claimed_at < stale)))
+                   .update({Image.ingest_status: PROCESSING, Image.ingest_claimed_at: now},
+                           synchronize_session=False))
+        if updated:
+            claimed.append(image_id)
+    db.commit()
+    if not claimed:
+        return []
+    return db.query(Image).filter(Image.id.in_(claimed)).order_by(Image.id).all()
+
+
+class IngestWorker:
+    """
+    Embeds queued uploads: claim a batch, download the originals, extract them
+    through the batcher, then store and index the whole batch at once.
+    """
+
+    def __init__(self, batcher, pipeline, index_manager, batch_size=INGEST_BATCH_SIZE,
+                 poll_seconds=INGEST_POLL_SECONDS):
+        self.batcher = batcher
+        self.pipeline = pipeline
+        self.index_manager = index_manager
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.embedded = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    def run_once(self):
+        """Process one batch. Returns how many rows were claimed."""
+        with session_scope() as db:
+            rows = [(image.id, image.s3_key, image.content_hash) for image in claim(db, self.batch_size)]
+        if not rows:
+            return 0
+        downloads = list(io_executor.map(self._download, [s3_key for _, s3_key, _ in rows]))
+        futures = {}
+        errors = {}
+        for (image_id, _, digest), (data, error) in zip(rows, downloads):
+            if error is not None:
+                errors[image_id] = error
+                continue
+            while image_id not in futures:
+                try:
+                    futures[image_id] = self.batcher.submit(data, key=digest)
+                except queue.Full:
+                    # Wait for room rather than failing the row; the table holds the real backlog
+                    time.sleep(0.05)
+        feats = {}
+        for image_id, future in futures.items():
+            try:
+                feats[image_id] = future.result()
+            except Exception as e:
+                # Clients see the same messages as a sync upload; the details stay in the log
+                print(f"Ingest of image {image_id} failed: {type(e).__name__}: {e}")
+                errors[image_id] = NOT_AN_IMAGE if isinstance(e, DECODE_ERRORS) else EXTRACTION_FAILED
+        self._store(feats, errors)
+        return len(rows)
+
+    @staticmethod
+    def _download(s3_key):
+        try:
+            return download_bytes_from_s3(s3_key), None
+        except Exception as e:
+            print(f"Ingest download of {s3_key} failed: {type(e).__name__}: {e}")
+            return None, DOWNLOAD_FAILED
+
+    def _store(self, feats, errors):
+        """Write the batch's vectors and failures in one transaction, then index it with one call."""
+        ids = list(feats)
+        data, version, vectors = [], None, None
+        if ids:
+            data, version, vectors = self.pipeline.encode_for_storage(np.stack([feats[i] for i in ids]))
+        indexed = []
+        with session_scope() as db:
+            for n, image_id in enumerate(ids):
+                values = {Image.vector: data[n], Image.embedding_version: version, Image.ingest_status: None,
+                          Image.ingest_error: None, Image.ingest_claimed_at: None}
+                # Rows deleted while they were being embedded are skipped
+                if db.query(Image).filter(Image.id == image_id, Image.ingest_status == PROCESSING) \
+                        .update(values, synchronize_session=False):
+                    indexed.append(n)
+            for image_id, error in errors.items():
+                db.query(Image).filter(Image.id == image_id).update(
+                    {Image.ingest_status: FAILED, Image.ingest_error: error, Image.ingest_claimed_at: None},
+                    synchronize_session=False)
+            db.commit()
+            refs = [ImageRef(image.id, image.item_id, image.filename, image.s3_key)
+                    for image in db.query(Image).filter(Image.id.in_([ids[n] for n in indexed])).order_by(Image.id)]
+        if vectors is not None and refs:
+            by_id = {ids[n]: vectors[n] for n in indexed}
+            self.index_manager.add_many(refs, np.stack([by_id[ref.id] for ref in refs]))
+        self.embedded += len(indexed)
+        self.failed += len(errors)
+
+    def run(self):
+        """Process batches until stop(); sleep only when the queue is empty."""
+        while not self._stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                print(f"Ingest worker error: {type(e).__name__}: {e}")
+                claimed = 0
+            if not claimed:
+                self._stop.wait(self.poll_seconds)
+
+    def start(self, workers=INGEST_WORKERS):
+        for n in range(workers):
+            thread = threading.Thread(target=self.run, name=f"ingest-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with session_scope() as db:
+            queued = backlog(db)
+        return {
+            "mode": INGEST_MODE,
+            "workers": len(self._threads),
+            "backlog": queued,
+            "max_pending": INGEST_MAX_PENDING,
+            "embedded": self.embedded,
+            "failed": self.failed,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    from .batching import BatchScheduler
+    from .db import ensure_schema
+    from .embedding import EmbeddingPipeline
+    from .executors import configure_torch_threads, cpu_executor
+    from .feature_extractor import FeatureExtractor
+    from .index_service import IndexClient, INDEX_SERVICE_SOCKET
+
+    parser = argparse.ArgumentParser(description="Embed uploads queued by INGEST_MODE=async.")
+    parser.add_argument("--workers", type=int, default=max(INGEST_WORKERS, 1))
+    args = parser.parse_args()
+    if not INDEX_SERVICE_SOCKET:
+        raise SystemExit("A separate ingest worker needs INDEX_SERVICE_SOCKET: the API workers' "
+                         "private indexes would not see what it adds")
+
+    ensure_schema()
+    configure_torch_threads()
+    batcher = BatchScheduler(FeatureExtractor(), decode_executor=cpu_executor)
+    batcher.start()
+    worker = IngestWorker(batcher, EmbeddingPipeline(), IndexClient(INDEX_SERVICE_SOCKET))
+    worker.start(args.workers)
+    print(f"Embedding queued uploads with {args.workers} worker(s)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        batcher.stop()
@@ -0,0 +1,180 @@
+"""
+Latency bookkeeping and a small Prometheus registry served at /metrics.
+
+Histograms, counters and gauges here render in the Prometheus text format
+without needing prometheus_client. Gauges can read a callback at scrape time,
+so existing stats (batcher queue, caches, index size) are exported as-is.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LatencyStats:
+    """Running count/total/max of durations, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": (self.total / self.count) * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+# Seconds; covers sub-millisecond FAISS searches up to multi-second uploads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+                                for key, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.series = {}  # label values -> [per-bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with-block took, even if it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        lines = self.header()
+        with self.lock:
+            series = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self.series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """
+    Gauge (or counter, with kind="counter") read from func() at scrape time.
+    func returns a number, or a dict of label-value tuples to numbers; None
+    skips the metric for this scrape.
+    """
+
+    def __init__(self, name, documentation, func, labelnames=(), kind="gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+        self.kind = kind
+
+    def collect(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+                                for key, v in sorted(values.items())]
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# Per-stage request timings: read_upload, decode, preprocess, queue_wait, inference,
+# embed, search, rerank, format, index_add, db, s3_upload, s3_download, s3_delete, presign
+STAGE_SECONDS = Histogram("image_rec_stage_seconds", "Time spent in each stage of request handling",
+                          labelnames=("stage",))
+HTTP_REQUEST_SECONDS = Histogram("image_rec_http_request_seconds", "HTTP request latency by route",
+                                 labelnames=("method", "route", "status"))
+EXTRACT_BATCH_SIZE = Histogram("image_rec_extract_batch_size", "Images per batched forward pass",
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+INDEX_BUILD_SECONDS = Histogram("image_rec_index_build_seconds", "Full index builds and how long they took",
+                                buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
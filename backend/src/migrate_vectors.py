@@ -0,0 +1,149 @@
+"""
+Backfill Image.vector into the format configured by the EMBEDDING_* settings.
+
+Rows holding raw float32 features extracted with the configured
+EMBEDDING_VIEWS (embedding_version NULL or "raw" for the default single view)
+are converted in place. Rows written under another configuration, including
+raw features of other views, can't be converted, so they are skipped unless
+--reextract is given, which downloads the original image from S3 and runs the
+extractor again.
+
+--content-hash also fills in Image.content_hash for rows stored before it
+existed, downloading each original from S3, so duplicate uploads of them are
+detected too.
+
+Usage: python -m src.migrate_vectors [--retrain-pca] [--reextract] [--content-hash]
+"""
+import argparse
+
+import numpy as np
+
+from .db import SessionLocal, Image, ensure_schema
+from .embedding import EmbeddingPipeline, RAW_VERSION, decode_raw
+
+
+def _raw_filter(pipeline):
+    """Rows holding raw features extracted with the pipeline's views"""
+    if pipeline.raw_version == RAW_VERSION:
+        return (Image.embedding_version == None) | (Image.embedding_version == RAW_VERSION)
+    return Image.embedding_version == pipeline.raw_version
+
+
+def train_pca(pipeline, sample_size):
+    db = SessionLocal()
+    try:
+        rows = (db.query(Image.vector)
+                .filter(Image.vector != None, _raw_filter(pipeline))
+                .order_by(Image.id.desc())
+                .limit(sample_size)
+                .all())
+    finally:
+        db.close()
+    vectors = np.stack([decode_raw(row.vector) for row in rows]) if rows else np.empty((0, 0))
+    print(f"Training PCA to {pipeline.pca_dim} dims on {len(vectors)} raw vectors")
+    pipeline.train_pca(vectors)
+    print(f"Saved PCA to {pipeline.pca_path}")
+
+
+def backfill(pipeline, batch_size=500, reextract=False, dry_run=False):
+    target = pipeline.version
+    extractor = None
+    converted = reextracted = skipped = 0
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            query = db.query(Image).filter(Image.vector != None, Image.id > last_id)
+            if target == RAW_VERSION:
+                query = query.filter(~_raw_filter(pipeline))
+            else:
+                query = query.filter((Image.embedding_version == None) | (Image.embedding_version != target))
+            images = query.order_by(Image.id).limit(batch_size).all()
+            if not images:
+                break
+            for image in images:
+                last_id = image.id
+                if (image.embedding_version or RAW_VERSION) == pipeline.raw_version:
+                    raw = decode_raw(image.vector)
+                    converted += 1
+                elif reextract:
+                    if extractor is None:
+                        from .feature_extractor import FeatureExtractor
+                        from .storage import download_bytes_from_s3
+                        extractor = FeatureExtractor(views=pipeline.views)
+                    raw = extractor.extract(download_bytes_from_s3(image.s3_key))
+                    reextracted += 1
+                else:
+                    skipped += 1
+                    continue
+                if target == pipeline.raw_version:
+                    image.vector = np.asarray(raw, dtype=np.float32).tobytes()
+                else:
+                    image.vector = pipeline.encode(pipeline.transform(raw))
+                image.embedding_version = target
+            if dry_run:
+                db.rollback()
+            else:
+                db.commit()
+            print(f"  up to id {last_id}: {converted} converted, {reextracted} re-extracted, {skipped} skipped")
+        finally:
+            db.close()
+    return converted, reextracted, skipped
+
+
+def backfill_hashes(batch_size=500, dry_run=False):
+    from .embedding_cache import content_hash
+    from .storage import download_bytes_from_s3
+    hashed = failed = 0
+    last_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            images = (db.query(Image)
+                      .filter(Image.content_hash == None, Image.id > last_id)
+                      .order_by(Image.id).limit(batch_size).all())
+            if not images:
+                break
+            for image in images:
+                last_id = image.id
+                try:
+                    image.content_hash = content_hash(download_bytes_from_s3(image.s3_key))
+                    hashed += 1
+                except RuntimeError as e:
+                    print(f"  {e}")
+                    failed += 1
+            if dry_run:
+                db.rollback()
+            else:
+                db.commit()
+            print(f"  up to id {last_id}: {hashed} hashed, {failed} failed")
+        finally:
+            db.close()
+    return hashed, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill stored vectors to the configured embedding format.")
+    parser.add_argument("--retrain-pca", action="store_true", help="Retrain PCA even if EMBEDDING_PCA_PATH exists")
+    parser.add_argument("--pca-sample", type=int, default=50000, help="Number of raw vectors to train PCA on")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per transaction")
+    parser.add_argument("--reextract", action="store_true",
+                        help="Re-run the extractor on S3 originals for rows in another non-raw format")
+    parser.add_argument("--content-hash", action="store_true",
+                        help="Also hash S3 originals of rows that have no content_hash")
+    parser.add_argument("--dry-run", action="store_true", help="Convert but roll back every batch")
+    args = parser.parse_args()
+
+    ensure_schema()
+    pipeline = EmbeddingPipeline()
+    if pipeline.pca_dim and (pipeline.needs_pca or args.retrain_pca):
+        train_pca(pipeline, args.pca_sample)
+    print(f"Backfilling to embedding version {pipeline.version}")
+    converted, reextracted, skipped = backfill(pipeline, args.batch_size, args.reextract, args.dry_run)
+    print(f"Done: {converted} converted, {reextracted} re-extracted, {skipped} skipped")
+    if skipped:
+        print("Skipped rows are in another non-raw format; rerun with --reextract to convert them")
+    if args.content_hash:
+        print("Backfilling content hashes")
+        hashed, failed = backfill_hashes(args.batch_size, args.dry_run)
+        print(f"Done: {hashed} hashed, {failed} failed")
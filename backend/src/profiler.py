@@ -0,0 +1,104 @@
+"""
+A sampling profiler that can be switched on in a running server.
+
+Every interval it records the Python stack of each thread, and stop() returns
+the counts in the collapsed-stack format flamegraph.pl and speedscope read:
+    curl -X POST 'localhost:8000/debug/profiler/start?interval_ms=5'
+    ... send some traffic ...
+    curl -X POST localhost:8000/debug/profiler/stop > profile.folded
+The endpoints only exist when PROFILER_ENABLED is set.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Exposes /debug/profiler/start and /debug/profiler/stop; keep it off on public deployments
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+# Stop sampling on its own after this long, in case nobody calls stop
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "300"))
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples every thread's stack on a background thread while running."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = Counter()  # "thread;outer;...;inner" -> times seen
+        self.sample_count = 0
+        self.interval = None
+        self.started_at = None
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=0.01, max_seconds=PROFILER_MAX_SECONDS):
+        """Start sampling, discarding any previous profile. Returns False if already running."""
+        with self.lock:
+            if self.running:
+                return False
+            self.samples = Counter()
+            self.sample_count = 0
+            self.interval = interval
+            self.started_at = time.monotonic()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop, max_seconds),
+                                            name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """Stop sampling and return the profile as collapsed stacks."""
+        with self.lock:
+            thread = self._thread
+            if thread is not None:
+                self._stop.set()
+        if thread is not None:
+            thread.join()
+        return self.collapsed()
+
+    def collapsed(self):
+        with self.lock:
+            samples = sorted(self.samples.items())
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "interval_ms": self.interval * 1000 if self.interval else None,
+                "samples": self.sample_count,
+                "stacks": len(self.samples),
+                "seconds": time.monotonic() - self.started_at if self.started_at else None,
+            }
+
+    def _run(self, stop, max_seconds):
+        own = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks.append(";".join(reversed(labels)))
+            with self.lock:
+                self.samples.update(stacks)
+                self.sample_count += 1
+
+
+profiler = SamplingProfiler()
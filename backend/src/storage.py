@@ -1,10 +1,25 @@
 import boto3
 import os
+import threading
+import time
+from collections import OrderedDict
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from typing import Optional
 
+from .metrics import STAGE_SECONDS
+
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "your-s3-bucket-name")
+# Presigned URLs are cached for this fraction of their lifetime, so a cached URL
+# always has at least the rest of it left when handed out
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000"))
+PRESIGNED_URL_CACHE_TTL_FRACTION = float(os.getenv("PRESIGNED_URL_CACHE_TTL_FRACTION", "0.5"))
+# Objects above the threshold are sent as a multipart upload, part by part, so
+# at most S3_MAX_CONCURRENCY parts of a file are in memory at once
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "4"))
 
 s3_client = boto3.client(
     "s3",
@@ -13,27 +28,100 @@ s3_client = boto3.client(
     aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
 )
 
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+    io_chunksize=256 * 1024,
+)
+
+class PresignedUrlCache:
+    """
+    Bounded LRU cache of presigned URLs keyed by s3_key, with a TTL.
+    """
+    def __init__(self, max_size: int = PRESIGNED_URL_CACHE_SIZE, ttl_fraction: float = PRESIGNED_URL_CACHE_TTL_FRACTION):
+        self.max_size = max_size
+        self.ttl_fraction = ttl_fraction
+        self.entries = OrderedDict()  # s3_key -> (expires_in, url, cached_until)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, s3_key: str, expires_in: int) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(s3_key)
+            if entry is not None and entry[0] == expires_in and entry[2] > time.monotonic():
+                self.entries.move_to_end(s3_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, s3_key: str, expires_in: int, url: str):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[s3_key] = (expires_in, url, time.monotonic() + expires_in * self.ttl_fraction)
+            self.entries.move_to_end(s3_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, s3_key: str):
+        with self.lock:
+            self.entries.pop(s3_key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+presigned_url_cache = PresignedUrlCache()
+
 def upload_fileobj_to_s3(fileobj, s3_key: str, content_type: Optional[str] = None) -> str:
     """
-    Upload a file-like object to S3 and return the S3 key.
+    Upload a file-like object to S3 and return the S3 key. The object is read
+    in parts (see transfer_config), never as a whole.
     """
     extra_args = {"ContentType": content_type} if content_type else {}
     try:
-        s3_client.upload_fileobj(fileobj, S3_BUCKET, s3_key, ExtraArgs=extra_args)
+        with STAGE_SECONDS.time(stage="s3_upload"):
+            s3_client.upload_fileobj(fileobj, S3_BUCKET, s3_key, ExtraArgs=extra_args, Config=transfer_config)
         return s3_key
     except ClientError as e:
         raise RuntimeError(f"Failed to upload to S3: {e}")
 
+def download_bytes_from_s3(s3_key: str) -> bytes:
+    """
+    Download an S3 object into memory and return its bytes.
+    """
+    try:
+        with STAGE_SECONDS.time(stage="s3_download"):
+            response = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
+            return response["Body"].read()
+    except ClientError as e:
+        raise RuntimeError(f"Failed to download {s3_key} from S3: {e}")
+
 def generate_presigned_url(s3_key: str, expires_in: int = 3600) -> str:
     """
-    Generate a presigned URL for an S3 object.
+    Generate a presigned URL for an S3 object, reusing a cached one when it is still fresh.
     """
+    url = presigned_url_cache.get(s3_key, expires_in)
+    if url is not None:
+        return url
     try:
-        url = s3_client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": S3_BUCKET, "Key": s3_key},
-            ExpiresIn=expires_in,
-        )
+        with STAGE_SECONDS.time(stage="presign"):
+            url = s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": S3_BUCKET, "Key": s3_key},
+                ExpiresIn=expires_in,
+            )
+        presigned_url_cache.put(s3_key, expires_in, url)
         return url
     except ClientError as e:
         raise RuntimeError(f"Failed to generate presigned URL for {s3_key}: {e}")
@@ -42,7 +130,9 @@ def delete_file_from_s3(s3_key: str):
     """
     Delete a file from S3.
     """
+    presigned_url_cache.invalidate(s3_key)
     try:
-        s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+        with STAGE_SECONDS.time(stage="s3_delete"):
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
     except ClientError as e:
         raise RuntimeError(f"Failed to delete {s3_key} from S3: {e}")
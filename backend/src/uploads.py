@@ -0,0 +1,111 @@
+"""
+Size limits and chunked reading for uploaded images.
+
+Starlette spools each multipart file to a temporary file (on disk past 1 MiB)
+while parsing the request. The endpoints read that spool in fixed-size chunks
+to hash it and enforce UPLOAD_MAX_BYTES, then hand the same file object to S3
+and to the decoder, so an upload is never held in memory as one bytes object.
+RequestSizeLimit caps the whole request body before any of that happens.
+"""
+import os
+
+from PIL.Image import DecompressionBombError
+from starlette.responses import JSONResponse
+
+from .embedding_cache import content_hasher
+
+# Largest image accepted by /upload/ and the query endpoints
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+# Largest request body: checked against Content-Length before the body is read,
+# and against the bytes received for bodies without one (chunked uploads)
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# What decoding an upload that isn't a readable image raises
+DECODE_ERRORS = (OSError, DecompressionBombError)
+# Client-facing messages for failed extractions; the exception itself is only logged
+NOT_AN_IMAGE = "The file is not an image that can be decoded"
+EXTRACTION_FAILED = "Feature extraction failed"
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self, limit):
+        super().__init__(f"Upload exceeds the {limit} byte limit")
+        self.limit = limit
+
+
+def scan_upload(fileobj, max_bytes=UPLOAD_MAX_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Hash a file object chunk by chunk and rewind it. Returns (content hash, size).
+    Raises UploadTooLarge as soon as more than max_bytes have been read.
+    """
+    hasher = content_hasher()
+    size = 0
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise UploadTooLarge(max_bytes)
+        hasher.update(chunk)
+    fileobj.seek(0)
+    return hasher.hexdigest(), size
+
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class RequestSizeLimit:
+    """
+    ASGI middleware that answers 413 to request bodies over max_bytes: at once
+    when Content-Length declares more, otherwise as soon as more than
+    max_bytes have arrived, so the rest is never read or spooled.
+    """
+
+    def __init__(self, app, max_bytes=UPLOAD_MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.max_bytes:
+            await self._refuse(scope, receive, send)
+            return
+        received = 0
+        exceeded = False
+        started = False
+
+        async def counting_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if exceeded and not started:
+                # The app's answer to the cut-off body (FastAPI turns it into a 400); the 413 replaces it
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not started:
+            await self._refuse(scope, receive, send)
+
+    async def _refuse(self, scope, receive, send):
+        response = JSONResponse({"error": f"Request exceeds the {self.max_bytes} byte limit"}, status_code=413)
+        await response(scope, receive, send)
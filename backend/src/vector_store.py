@@ -0,0 +1,188 @@
+"""
+Full-precision copies of the indexed vectors, for exact re-ranking.
+
+Approximate indexes (HNSW, IVF, PQ, fp16 scalar quantizers) lose precision at
+the top of the ranking. With re-ranking, a search over-fetches topk*RERANK_FACTOR
+candidates from the index and re-scores them exactly against the float32
+vectors kept here. The vectors are already transformed by the pipeline (PCA,
+normalization), so re-ranking undoes the index's compression, not the PCA.
+
+Vectors live in a float32 matrix memory-mapped from RERANK_VECTORS_PATH, with
+row i holding Image.id i. Looking up the candidates is one fancy-indexing
+read, and workers share the pages through the OS page cache. Rows of deleted
+or missing ids are zero and read as holes, which keeps the file sparse. A
+one-byte-per-row ".mask" file records which rows are filled, and a ".json"
+header records the dim and embedding version of the rows.
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Candidates re-scored per result: a search fetches topk*RERANK_FACTOR; 0 disables.
+# /query/ can override it per request.
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", "0"))
+# Memory-mapped float32 vectors for re-ranking; empty disables the store (and re-ranking).
+# It doubles the vectors kept on disk, so by default it only exists when RERANK_FACTOR is set.
+RERANK_VECTORS_PATH = os.getenv("RERANK_VECTORS_PATH", "data/index/vectors-v1.f32" if RERANK_FACTOR > 0 else "")
+# Upper bound for a per-request factor
+RERANK_MAX_FACTOR = int(os.getenv("RERANK_MAX_FACTOR", "32"))
+
+_MIN_CAPACITY = 1024
+
+
+def rerank_factor(factor=None):
+    """The re-rank factor for a request: factor, or RERANK_FACTOR if None, clamped to [0, RERANK_MAX_FACTOR]."""
+    factor = RERANK_FACTOR if factor is None else int(factor)
+    return max(0, min(factor, RERANK_MAX_FACTOR))
+
+
+class ExactVectorStore:
+    """
+    float32 vectors keyed by Image.id in a memory-mapped matrix.
+
+    Rebuilt files are written to unique temp files beside the old ones and
+    swapped in with os.replace, so another process that still maps the old
+    file never sees it truncated, and concurrent rebuilds don't share a file.
+    Growth extends the files in place. Callers serialize writes
+    (FaissIndexManager holds its write lock).
+    """
+
+    def __init__(self, path=RERANK_VECTORS_PATH):
+        self.path = path
+        self.dim = None
+        self.version = None
+        self.matrix = None  # np.memmap (capacity, dim) float32
+        self.present = None  # np.memmap (capacity,) uint8
+        self.capacity = 0
+
+    def _read_header(self):
+        try:
+            with open(self.path + ".json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _map(self):
+        """(Re)map the files at their current size."""
+        row_bytes = self.dim * 4
+        capacity = min(os.path.getsize(self.path) // row_bytes, os.path.getsize(self.path + ".mask"))
+        self.matrix = self.present = None
+        if capacity:
+            self.matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+            self.present = np.memmap(self.path + ".mask", dtype=np.uint8, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+
+    def open(self, dim, version):
+        """
+        Map the store for vectors of dim under embedding version. Files left
+        by another dim or version are replaced with an empty store.
+        Returns True if existing rows were kept.
+        """
+        self.dim, self.version = dim, version
+        header = self._read_header()
+        if (header == {"dim": dim, "embedding_version": version}
+                and os.path.exists(self.path) and os.path.exists(self.path + ".mask")):
+            self._map()
+            return True
+        self.rebuild(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=np.float32), dim, version)
+        return False
+
+    def rebuild(self, ids, vectors, dim, version):
+        """Replace the whole store with exactly these vectors."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        ids = np.asarray(ids, dtype=np.int64)
+        capacity = max(_MIN_CAPACITY, int(ids.max()) + 1 if len(ids) else 0)
+        # Invalidate the header first, so a crash part-way leaves a store open() discards
+        if os.path.exists(self.path + ".json"):
+            os.remove(self.path + ".json")
+        tmps = []
+        try:
+            for path, size in ((self.path, capacity * dim * 4), (self.path + ".mask", capacity)):
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                           suffix=".tmp")
+                tmps.append(tmp)
+                with os.fdopen(fd, "wb") as f:
+                    f.truncate(size)
+            if len(ids):
+                matrix = np.memmap(tmps[0], dtype=np.float32, mode="r+", shape=(capacity, dim))
+                matrix[ids] = vectors
+                matrix.flush()
+                present = np.memmap(tmps[1], dtype=np.uint8, mode="r+", shape=(capacity,))
+                present[ids] = 1
+                present.flush()
+                del matrix, present
+        except BaseException:
+            for tmp in tmps:
+                os.remove(tmp)
+            raise
+        os.replace(tmps[0], self.path)
+        os.replace(tmps[1], self.path + ".mask")
+        with open(self.path + ".json", "w") as f:
+            json.dump({"dim": dim, "embedding_version": version}, f)
+        self.dim, self.version = dim, version
+        self._map()
+
+    def _reserve(self, max_id):
+        """Grow the files (in place, sparsely) so row max_id exists."""
+        if max_id < self.capacity:
+            return
+        capacity = max(max_id + 1, 2 * self.capacity, _MIN_CAPACITY)
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.present.flush()
+        self.matrix = self.present = None
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * self.dim * 4)
+        with open(self.path + ".mask", "r+b") as f:
+            f.truncate(capacity)
+        self._map()
+
+    def put(self, ids, vectors):
+        """Store vectors under their Image.ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        self._reserve(int(ids.max()))
+        self.matrix[ids] = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        self.present[ids] = 1
+
+    def discard(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[ids < self.capacity]
+        if len(ids):
+            self.present[ids] = 0
+
+    def missing(self, ids):
+        """The subset of ids that have no stored vector."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.present is None:
+            return ids
+        inside = ids < self.capacity
+        found = np.zeros(len(ids), dtype=bool)
+        found[inside] = self.present[ids[inside]] != 0
+        return ids[~found]
+
+    def get(self, ids):
+        """Return (vectors, found) for ids; rows not found are zero. Safe to call from concurrent searches."""
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.zeros((len(ids), self.dim), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        inside = ids < self.capacity
+        if inside.any():
+            found[inside] = self.present[ids[inside]] != 0
+            vectors[found] = self.matrix[ids[found]]
+        return vectors, found
+
+    def flush(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.present.flush()
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "rows": int(np.count_nonzero(self.present)) if self.present is not None else 0,
+            "capacity": self.capacity,
+        }
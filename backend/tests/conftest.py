@@ -0,0 +1,37 @@
+"""
+The tests run against a throwaway SQLite database, and never write index
+snapshots or exact-vector files. STARTUP_MODE=background keeps importing
+src.app from loading the model. The environment is set here, before any src
+module reads it at import time.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix="image-rec-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp}/test.db"
+os.environ["INDEX_SNAPSHOT_PATH"] = ""
+os.environ["RERANK_VECTORS_PATH"] = ""
+os.environ["STARTUP_MODE"] = "background"
+# Small enough that the request size tests don't send hundreds of megabytes
+os.environ["UPLOAD_MAX_REQUEST_BYTES"] = str(1024 * 1024)
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
+os.environ.setdefault("S3_BUCKET", "test-bucket")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.db import Image, Item, engine, ensure_schema  # noqa: E402
+
+ensure_schema()
+
+
+@pytest.fixture
+def empty_db():
+    """A database with no items or images."""
+    with engine.begin() as conn:
+        conn.execute(Image.__table__.delete())
+        conn.execute(Item.__table__.delete())
+    yield engine
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from src.image_database_multi import aggregate_by_item
+
+
+def test_min_orders_items_by_best_hit():
+    items, scores = aggregate_by_item([0, 1, 0, 2, 1], [5.0, 2.0, 1.0, 3.0, 4.0], mode="min")
+    assert items.tolist() == [0, 1, 2]
+    assert scores.tolist() == [1.0, 2.0, 3.0]
+
+
+def test_mean_top_averages_each_items_best_hits():
+    items, scores = aggregate_by_item([0, 0, 0, 1, 1], [1.0, 9.0, 2.0, 2.0, 2.0], mode="mean_top", top_m=2)
+    # item 0: mean(1, 2) = 1.5, item 1: mean(2, 2) = 2
+    assert items.tolist() == [0, 1]
+    assert scores.tolist() == pytest.approx([1.5, 2.0])
+
+
+def test_count_rewards_items_with_more_hits():
+    items, scores = aggregate_by_item([0, 1, 1, 1], [1.0, 1.2, 1.3, 1.4], mode="count")
+    assert items.tolist() == [1, 0]
+    assert scores[0] == pytest.approx(1.2 / (1 + np.log(3)))
+
+
+def test_ties_keep_item_order_and_negative_items_are_ignored():
+    items, scores = aggregate_by_item([2, -1, 1], [1.0, 0.0, 1.0])
+    assert items.tolist() == [1, 2]
+
+
+def test_empty_and_unknown_mode():
+    items, scores = aggregate_by_item([], [])
+    assert len(items) == 0 and len(scores) == 0
+    with pytest.raises(ValueError):
+        aggregate_by_item([0], [1.0], mode="median")
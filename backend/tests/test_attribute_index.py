@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from src.attribute_index import AttributeIndex, parse_attributes, parse_filters
+
+
+def test_parse_filters_empty():
+    assert parse_filters() is None
+    assert parse_filters("", "") is None
+
+
+def test_parse_filters_normalizes_values():
+    spec = parse_filters('{"Category": "Shoes", "brand": ["Acme", "zenith", "ACME"]}')
+    assert spec == {"category": ["shoes"], "brand": ["acme", "zenith"]}
+
+
+def test_parse_filters_item_ids_are_exact_and_intersected():
+    assert parse_filters(None, "B, a,,a") == {"item_id": ["B", "a"]}
+    assert parse_filters('{"item_id": ["a", "b"]}', "b,c") == {"item_id": ["b"]}
+
+
+@pytest.mark.parametrize("filters", ["not json", "[1, 2]", '"shoes"', '{"category": []}',
+                                     '{"category": null}', '{"category": {"a": 1}}', '{"category": [["a"]]}'])
+def test_parse_filters_rejects_malformed_input(filters):
+    with pytest.raises(ValueError):
+        parse_filters(filters)
+
+
+def test_parse_attributes_formats():
+    assert parse_attributes('{"Color": ["Red", "white"], "size": 42, "extra": {"a": 1}}') == {
+        ("color", "red"), ("color", "white"), ("size", "42")}
+    assert parse_attributes("Color: Red; size=42\nfree text") == {("color", "red"), ("size", "42")}
+    assert parse_attributes(None) == set()
+
+
+def select_ids(index, spec, images):
+    """Image.ids a filter selects, where images maps item_id -> Image.ids."""
+    selection = index.select(spec, lambda items: np.array(sorted(i for item in items for i in images.get(item, ())),
+                                                          dtype=np.int64))
+    return selection.ids.tolist()
+
+
+def test_select_matches_values_and_keys():
+    index = AttributeIndex()
+    index.set_items({"a": "color: red\nsize: s", "b": "color: blue\nsize: s", "c": "color: red\nsize: m"})
+    images = {"a": [1, 2], "b": [3], "c": [4]}
+    assert select_ids(index, {"color": ["red"]}, images) == [1, 2, 4]
+    assert select_ids(index, {"color": ["red", "blue"], "size": ["s"]}, images) == [1, 2, 3]
+    assert select_ids(index, {"color": ["green"]}, images) == []
+
+
+def test_cache_keeps_bitmaps_of_unrelated_items():
+    index = AttributeIndex()
+    index.set_items({"a": "color: red", "b": "color: blue"})
+    images = {"a": [1], "b": [2]}
+    select_ids(index, {"color": ["red"]}, images)
+    select_ids(index, {"color": ["blue"]}, images)
+    index.invalidate(["a"])
+    assert list(index.cache) == ['{"color": ["blue"]}']
+    images["a"].append(5)
+    assert select_ids(index, {"color": ["red"]}, images) == [1, 5]
+
+
+def test_attribute_change_updates_cached_filters():
+    index = AttributeIndex()
+    index.set_items({"a": "color: red", "b": "color: blue"})
+    images = {"a": [1], "b": [2]}
+    assert select_ids(index, {"color": ["red"]}, images) == [1]
+    assert select_ids(index, {"color": ["blue"]}, images) == [2]
+    index.set_items({"b": "color: red"})
+    assert select_ids(index, {"color": ["red"]}, images) == [1, 2]
+    assert select_ids(index, {"color": ["blue"]}, images) == []
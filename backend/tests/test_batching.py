@@ -0,0 +1,151 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+from src.batching import BatchScheduler
+from src.embedding_cache import EmbeddingCache
+
+
+class FakeExtractor:
+    """Features are the image bytes' length; b"bad" fails to decode. Records every batch it runs."""
+
+    backend = "fake"
+
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def preprocess(self, source):
+        if source == b"bad":
+            raise OSError("cannot identify image file")
+        return np.full(4, len(source), dtype=np.float32)
+
+    def extract_batch(self, tensors):
+        self.gate.wait(5)
+        self.batches.append(len(tensors))
+        return np.stack(tensors)
+
+
+def results(futures):
+    return [float(f.result(5)[0]) for f in futures]
+
+
+@pytest.fixture
+def extractor():
+    return FakeExtractor()
+
+
+def test_waiting_images_share_forward_passes(extractor):
+    scheduler = BatchScheduler(extractor, max_batch_size=3, max_wait_ms=50)
+    # Queued before the worker starts, so all five are waiting when it looks
+    futures = [scheduler.submit(b"x" * n) for n in range(1, 6)]
+    scheduler.start()
+    try:
+        assert results(futures) == [1, 2, 3, 4, 5]
+    finally:
+        scheduler.stop()
+    assert extractor.batches == [3, 2]
+    stats = scheduler.stats()
+    assert stats["batches"] == 2 and stats["avg_batch_size"] == 2.5
+    assert stats["queue_wait"]["count"] == 5 and stats["inference"]["count"] == 2
+
+
+def test_a_bad_image_fails_only_its_own_future(extractor):
+    scheduler = BatchScheduler(extractor, max_wait_ms=50)
+    good, bad = scheduler.submit(b"abc"), scheduler.submit(b"bad")
+    scheduler.start()
+    try:
+        assert results([good]) == [3]
+        with pytest.raises(OSError):
+            bad.result(5)
+    finally:
+        scheduler.stop()
+    assert extractor.batches == [1]
+
+
+def test_inference_error_fails_the_whole_batch(extractor):
+    def broken(tensors):
+        raise RuntimeError("out of memory")
+
+    extractor.extract_batch = broken
+    scheduler = BatchScheduler(extractor, max_wait_ms=50)
+    futures = [scheduler.submit(b"a"), scheduler.submit(b"bb")]
+    scheduler.start()
+    try:
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(5)
+    finally:
+        scheduler.stop()
+
+
+def test_cancelled_requests_are_not_extracted(extractor):
+    scheduler = BatchScheduler(extractor, max_wait_ms=50)
+    kept, cancelled = scheduler.submit(b"a"), scheduler.submit(b"bb")
+    assert cancelled.cancel()
+    scheduler.start()
+    try:
+        assert results([kept]) == [1]
+    finally:
+        scheduler.stop()
+    assert extractor.batches == [1]
+
+
+def test_full_queue_is_refused(extractor):
+    scheduler = BatchScheduler(extractor, max_queue_size=2)
+    scheduler.submit(b"a")
+    scheduler.submit(b"b")
+    with pytest.raises(queue.Full):
+        scheduler.submit(b"c")
+
+
+def test_identical_keys_in_flight_share_one_extraction(extractor):
+    extractor.gate.clear()
+    scheduler = BatchScheduler(extractor, max_wait_ms=1, cache=EmbeddingCache())
+    scheduler.start()
+    try:
+        first = scheduler.submit(b"abc", key="k")
+        second = scheduler.submit(b"abc", key="k")
+        # One client goes away; the other still gets its features
+        assert second.cancel()
+        third = scheduler.submit(b"abc", key="k")
+        extractor.gate.set()
+        assert results([first, third]) == [3, 3]
+    finally:
+        scheduler.stop()
+    assert extractor.batches == [1]
+    assert scheduler.stats()["coalesced"] == 2
+
+
+def test_cache_answers_repeated_keys_without_extracting(extractor):
+    cache = EmbeddingCache()
+    scheduler = BatchScheduler(extractor, max_wait_ms=1, cache=cache)
+    scheduler.start()
+    try:
+        assert results([scheduler.submit(b"abc", key="k")]) == [3]
+        repeat = scheduler.submit(b"other bytes", key="k")
+        assert repeat.done() and results([repeat]) == [3]
+        with pytest.raises(OSError):
+            scheduler.submit(b"bad", key="bad").result(5)
+        # Failures are not cached
+        assert cache.get("bad") is None
+    finally:
+        scheduler.stop()
+    assert extractor.batches == [1]
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(max_size=2)
+    for key in "ab":
+        cache.put(key, np.full(4, ord(key), dtype=np.float32))
+    cache.get("a")
+    cache.put("c", np.zeros(4, dtype=np.float32))
+    assert list(cache.entries) == ["a", "c"]
+    assert not cache.get("a").flags.writeable
+    assert cache.stats()["hits"] == 2 and cache.stats()["size"] == 2
+    disabled = EmbeddingCache(max_size=0)
+    disabled.put("a", np.zeros(4, dtype=np.float32))
+    assert disabled.get("a") is None
@@ -0,0 +1,32 @@
+import numpy as np
+
+from src.embedding import RAW_VERSION, EmbeddingPipeline
+
+
+def raw_features(n, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+
+def test_encode_for_storage_keeps_raw_features_until_pca_is_trained(tmp_path):
+    pipeline = EmbeddingPipeline(metric="cosine", pca_dim=4, pca_path=str(tmp_path / "pca.npz"))
+    feats = raw_features(8)
+    data, version, vectors = pipeline.encode_for_storage(feats)
+    assert vectors is None
+    assert version == pipeline.raw_version == RAW_VERSION
+    assert data == [row.tobytes() for row in feats]
+
+    pipeline.train_pca(feats)
+    data, version, vectors = pipeline.encode_for_storage(feats)
+    assert version == pipeline.version == pipeline.storage_version != RAW_VERSION
+    assert vectors.shape == (8, 4)
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1, rtol=1e-5)
+    assert [pipeline.decode(d).tolist() for d in data] == vectors.tolist()
+
+
+def test_encode_for_storage_single_vector():
+    pipeline = EmbeddingPipeline(dtype="float16")
+    feat = raw_features(1)[0]
+    data, version, vector = pipeline.encode_for_storage(feat)
+    assert isinstance(data, bytes) and len(data) == 2 * len(feat)
+    assert version == pipeline.version
+    np.testing.assert_allclose(pipeline.decode(data), vector, rtol=1e-3)
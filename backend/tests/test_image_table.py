@@ -0,0 +1,81 @@
+import numpy as np
+
+from src.image_table import ImageTable
+
+
+def make_table():
+    table = ImageTable()
+    table.add([3, 7, 10], ["a", "b", "a"], ["3.jpg", "7.jpg", "10.jpg"], ["a/3.jpg", "b/7.jpg", "a/10.jpg"])
+    return table
+
+
+def test_add_and_get():
+    table = make_table()
+    assert len(table) == 3
+    assert table.get(7) == {"item_id": "b", "filename": "7.jpg", "s3_key": "b/7.jpg"}
+    assert table.get(4) is None
+    assert table.get(10_000) is None
+    assert table.ids().tolist() == [3, 7, 10]
+    assert table.present([3, 4, 10, 10_000]).tolist() == [True, False, True, False]
+
+
+def test_replace_keeps_count_and_moves_item():
+    table = make_table()
+    table.add([7], ["a"], ["7-new.jpg"], ["a/7-new.jpg"])
+    assert len(table) == 3
+    assert table.get(7) == {"item_id": "a", "filename": "7-new.jpg", "s3_key": "a/7-new.jpg"}
+    assert table.ids_of_items(["a"]).tolist() == [3, 7, 10]
+    assert table.ids_of_items(["b"]).tolist() == []
+
+
+def test_repeated_id_in_one_add_counts_once():
+    table = ImageTable()
+    table.add([5, 5], ["a", "a"], ["x.jpg", "y.jpg"], ["a/x.jpg", "a/y.jpg"])
+    assert len(table) == 1
+    assert table.get(5)["filename"] == "y.jpg"
+
+
+def test_remove_returns_ids_that_were_present():
+    table = make_table()
+    removed = table.remove([7, 7, 8, 10_000])
+    assert removed.tolist() == [7]
+    assert len(table) == 2
+    assert 7 not in table
+    assert table.remove([7]).tolist() == []
+
+
+def test_remove_then_re_add():
+    table = make_table()
+    table.remove([3])
+    table.add([3], ["c"], ["3.jpg"], ["c/3.jpg"])
+    assert len(table) == 3
+    assert table.get(3)["item_id"] == "c"
+
+
+def test_compaction_keeps_live_rows():
+    table = ImageTable()
+    ids = np.arange(2000)
+    table.add(ids, [f"item{i % 10}" for i in ids], [f"{i}.jpg" for i in ids], [f"key/{i}.jpg" for i in ids])
+    table.remove(ids[:1500])
+    assert len(table.strings) < 2000 * len("key/0000.jpg")  # garbage was dropped
+    assert len(table) == 500
+    assert table.get(1999) == {"item_id": "item9", "filename": "1999.jpg", "s3_key": "key/1999.jpg"}
+    assert table.get(10) is None
+
+
+def test_columns_round_trip():
+    table = make_table()
+    table.remove([3])
+    copy = ImageTable.from_columns(table.columns())
+    assert copy.ids().tolist() == [7, 10]
+    assert [copy.get(i) for i in (7, 10)] == [table.get(i) for i in (7, 10)]
+
+
+def test_merge():
+    table = make_table()
+    other = ImageTable()
+    other.add([7, 20], ["c", "c"], ["7.jpg", "20.jpg"], ["c/7.jpg", "c/20.jpg"])
+    table.merge(other)
+    assert len(table) == 4
+    assert table.get(7)["item_id"] == "c"
+    assert table.get(20)["s3_key"] == "c/20.jpg"
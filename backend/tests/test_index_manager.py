@@ -0,0 +1,210 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from src.db import Image, Item
+from src.index_manager import FaissIndexManager
+
+DIM = 8
+
+
+def vectors(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+
+def image(image_id, item_id="a"):
+    return SimpleNamespace(id=image_id, item_id=item_id, filename=f"{image_id}.jpg", s3_key=f"{item_id}/{image_id}.jpg")
+
+
+def insert_images(engine, vecs, first_id=1, item_id="a"):
+    with engine.begin() as conn:
+        if not conn.execute(Item.__table__.select().where(Item.id == item_id)).first():
+            conn.execute(Item.__table__.insert(), [{"id": item_id, "name": item_id}])
+        conn.execute(Image.__table__.insert(), [
+            {"id": first_id + n, "item_id": item_id, "filename": f"{first_id + n}.jpg",
+             "s3_key": f"{item_id}/{first_id + n}.jpg", "vector": v.tobytes()} for n, v in enumerate(vecs)])
+
+
+def top_id(manager, query):
+    hits = manager.search(query, 1)
+    return hits[0][0] if hits else None
+
+
+@pytest.mark.parametrize("index_type", ["flat", "HNSW"])
+def test_remove_and_re_add(empty_db, index_type):
+    manager = FaissIndexManager(index_type=index_type, vectors_path="")
+    vecs = vectors(50)
+    manager.add_many([image(i) for i in range(50)], vecs)
+    assert top_id(manager, vecs[7]) == 7
+
+    assert manager.remove([7, 7, 1000]) == 1
+    assert len(manager) == 49
+    assert all(hit[0] != 7 for hit in manager.search(vecs[7], 10))
+
+    manager.add(image(7, "b"), vecs[8])
+    assert len(manager) == 50
+    hits = manager.search(vecs[8], 2)
+    assert {hit[0] for hit in hits} == {7, 8}
+    assert dict((hit[0], hit[1]["item_id"]) for hit in hits)[7] == "b"
+
+
+def test_replaced_vector_is_not_returned_twice(empty_db):
+    manager = FaissIndexManager(index_type="HNSW", vectors_path="")
+    vecs = vectors(20)
+    manager.add_many([image(i) for i in range(20)], vecs)
+    manager.add(image(3), vecs[4])
+    ids = [hit[0] for hit in manager.search(vecs[4], 5)]
+    assert len(ids) == len(set(ids)) == 5
+
+
+def test_build_and_catch_up_on_empty_database(empty_db):
+    manager = FaissIndexManager(vectors_path="")
+    manager.build()
+    assert manager.index is None
+    assert manager.search(vectors(1)[0], 3) == []
+    assert manager.catch_up() == (0, 0)
+
+    vecs = vectors(5)
+    insert_images(empty_db, vecs)
+    assert manager.catch_up() == (5, 0)
+    assert len(manager) == 5
+    assert top_id(manager, vecs[2]) == 3
+
+    with empty_db.begin() as conn:
+        conn.execute(Image.__table__.delete().where(Image.id == 3))
+    assert manager.catch_up() == (0, 1)
+    assert top_id(manager, vecs[2]) != 3
+
+
+def test_writes_during_a_build_are_kept(empty_db):
+    vecs = vectors(12)
+    insert_images(empty_db, vecs[:10])
+    manager = FaissIndexManager(vectors_path="")
+    manager.build()
+    load_vectors = manager.load_vectors
+    loading = threading.Event()
+
+    def slow_load():
+        rows = load_vectors()
+        loading.set()
+        time.sleep(0.2)
+        return rows
+
+    manager.load_vectors = slow_load
+    build = threading.Thread(target=manager.build)
+    build.start()
+    loading.wait()
+    # Neither write is in the database the build loaded
+    manager.add(image(100), vecs[11])
+    manager.remove([1])
+    build.join()
+
+    assert 100 in manager.metadata
+    assert 1 not in manager.metadata
+    assert top_id(manager, vecs[11]) == 100
+
+
+def test_compaction_runs_in_the_background(empty_db):
+    vecs = vectors(10)
+    insert_images(empty_db, vecs)
+    manager = FaissIndexManager(index_type="HNSW", vectors_path="")
+    manager.build()
+    load_vectors = manager.load_vectors
+    release = threading.Event()
+
+    def blocked_load():
+        release.wait(5)
+        return load_vectors()
+
+    manager.load_vectors = blocked_load
+    with empty_db.begin() as conn:
+        conn.execute(Image.__table__.delete().where(Image.id.in_([1, 2, 3, 4])))
+    # 3 of 10 vectors deleted crosses TOMBSTONE_REBUILD_RATIO; remove() returns while the rebuild waits
+    assert manager.remove([1, 2, 3]) == 3
+    compaction = manager.compaction
+    assert compaction is not None and compaction.is_alive()
+    assert manager.tombstones == 3
+    assert {hit[0] for hit in manager.search(vecs[0], 10)} == set(range(4, 11))
+
+    manager.remove([4])
+    assert manager.compaction is compaction
+    release.set()
+    compaction.join(5)
+    assert manager.compaction is None
+    assert manager.tombstones == 0
+    assert manager.index.ntotal == len(manager) == 6
+
+
+@pytest.mark.parametrize("index_type,mmap", [("flat", True), ("flat", False), ("HNSW", True)])
+def test_snapshot_round_trip(empty_db, tmp_path, index_type, mmap):
+    path = str(tmp_path / "index.faiss")
+    vecs = vectors(30)
+    manager = FaissIndexManager(index_type=index_type, vectors_path="")
+    manager.add_many([image(i, f"item{i % 3}") for i in range(30)], vecs)
+    manager.remove([5])
+    assert manager.save_snapshot(path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["index.faiss", "index.faiss.meta"]
+
+    loaded = FaissIndexManager(index_type=index_type, vectors_path="")
+    assert loaded.load_snapshot(path, mmap=mmap)
+    assert len(loaded) == 29 and loaded.tombstones == manager.tombstones
+    assert loaded.metadata.get(7) == manager.metadata.get(7)
+    for q in vecs[[0, 5, 29]]:
+        assert loaded.search(q, 5) == manager.search(q, 5)
+    # A loaded snapshot keeps taking writes
+    loaded.add(image(100), vecs[5])
+    assert top_id(loaded, vecs[5]) == 100
+
+
+def test_snapshot_of_another_configuration_is_ignored(empty_db, tmp_path):
+    path = str(tmp_path / "index.faiss")
+    manager = FaissIndexManager(index_type="flat", vectors_path="")
+    manager.add_many([image(i) for i in range(5)], vectors(5))
+    manager.save_snapshot(path)
+    assert not FaissIndexManager(index_type="HNSW", vectors_path="").load_snapshot(path)
+
+
+@pytest.mark.parametrize("damaged", ["index.faiss", "index.faiss.meta"])
+def test_corrupt_snapshot_falls_back_to_a_build(empty_db, tmp_path, capsys, damaged):
+    path = str(tmp_path / "index.faiss")
+    vecs = vectors(10)
+    insert_images(empty_db, vecs)
+    manager = FaissIndexManager(vectors_path="")
+    assert manager.warm_start(path) == "build"
+    target = tmp_path / damaged
+    target.write_bytes(target.read_bytes()[:len(target.read_bytes()) // 2])
+
+    restarted = FaissIndexManager(vectors_path="")
+    assert not restarted.load_snapshot(path)
+    assert "Ignoring snapshot" in capsys.readouterr().out
+    assert restarted.warm_start(path) == "build"
+    assert len(restarted) == 10 and top_id(restarted, vecs[4]) == 5
+    # The rebuilt snapshot is usable again
+    assert FaissIndexManager(vectors_path="").load_snapshot(path)
+
+
+def test_rerank_rescores_compressed_candidates_exactly(empty_db, tmp_path):
+    vecs = vectors(500)
+    insert_images(empty_db, vecs)
+    manager = FaissIndexManager(index_type="PQ4x4", vectors_path=str(tmp_path / "vectors.f32"))
+    manager.build()
+    queries = vecs[:20] + 0.3 * vectors(20, seed=1)
+    exact = ((queries[:, None, :] - vecs[None, :, :]) ** 2).sum(-1)
+    truth = np.argsort(exact, axis=1)[:, :5] + 1  # Image.ids start at 1
+
+    def recall(rerank):
+        found = 0
+        for q, (query, expected) in enumerate(zip(queries, truth)):
+            hits = manager.search(query, 5, rerank=rerank)
+            found += len({hit[0] for hit in hits} & set(expected))
+            if rerank:
+                # Re-ranked distances are the exact float32 ones, in order
+                distances = [hit[2] for hit in hits]
+                np.testing.assert_allclose(distances, exact[q, [hit[0] - 1 for hit in hits]], rtol=1e-4)
+                assert distances == sorted(distances)
+        return found / truth.size
+
+    assert recall(20) > max(recall(0), 0.9)
@@ -0,0 +1,69 @@
+import os
+import stat
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from src.index_manager import FaissIndexManager
+from src.index_service import IndexClient, IndexService
+
+DIM = 8
+
+
+@pytest.fixture
+def address(empty_db, tmp_path):
+    address = str(tmp_path / "index.sock")
+    service = IndexService(FaissIndexManager(vectors_path=""), address)
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+    return address
+
+
+def images(ids, item_id="a"):
+    return [SimpleNamespace(id=i, item_id=item_id, filename=f"{i}.jpg", s3_key=f"{item_id}/{i}.jpg") for i in ids]
+
+
+def test_writes_from_one_client_are_seen_by_another(address):
+    vecs = np.random.default_rng(0).standard_normal((10, DIM)).astype(np.float32)
+    writer, reader = IndexClient(address, connect_timeout=5), IndexClient(address, connect_timeout=5)
+    writer.add_many(images(range(1, 11)), vecs)
+    first = writer.generation
+    assert len(reader) == 10
+    assert reader.generation == first
+    hits = reader.search(vecs[2], 3)
+    assert hits[0][0] == 3 and hits[0][1] == {"item_id": "a", "filename": "3.jpg", "s3_key": "a/3.jpg"}
+
+    assert writer.remove([3, 99]) == 1
+    assert writer.generation == first + 1
+    assert all(hit[0] != 3 for hit in reader.search(vecs[2], 5))
+    writer.set_item_attributes("a", "color: red")
+    assert [item for item, *_ in reader.search_items(vecs[0], 1, filters={"color": ["red"]})] == ["a"]
+    assert reader.search_batch(vecs[:2], 1)[1][0][0] == 2
+
+
+def test_errors_are_raised_in_the_client_and_the_connection_survives(address):
+    client = IndexClient(address, connect_timeout=5)
+    with pytest.raises(RuntimeError, match="Unknown index service method"):
+        client._call("drop_everything")
+    assert client.stats()["size"] == 0
+
+
+def test_dropped_connection_is_reopened(address):
+    client = IndexClient(address, connect_timeout=5)
+    client.stats()
+    client._local.conn.close()
+    assert client.stats()["size"] == 0
+
+
+def test_clients_without_the_key_are_rejected(address):
+    client = IndexClient(address, connect_timeout=5)
+    client.stats()
+    assert stat.S_IMODE(os.stat(address + ".key").st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+    with pytest.raises(AuthenticationError):
+        Client(address, family="AF_UNIX", authkey=b"not the key")
+    # The service keeps serving everyone else
+    assert IndexClient(address, connect_timeout=5).stats()["size"] == 0
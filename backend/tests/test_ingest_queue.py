@@ -0,0 +1,101 @@
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from src import ingest_queue
+from src.db import Image, Item, SessionLocal
+from src.embedding import EmbeddingPipeline
+from src.index_manager import FaissIndexManager
+from src.ingest_queue import DOWNLOAD_FAILED, FAILED, PENDING, PROCESSING, IngestWorker, claim, job_status
+from src.uploads import EXTRACTION_FAILED, NOT_AN_IMAGE
+
+DIM = 8
+
+
+def queue_images(engine, n, **values):
+    with engine.begin() as conn:
+        if not conn.execute(Item.__table__.select().where(Item.id == "a")).first():
+            conn.execute(Item.__table__.insert(), [{"id": "a", "name": "a"}])
+        conn.execute(Image.__table__.insert(), [
+            {"item_id": "a", "filename": f"{i}.jpg", "s3_key": f"a/{i}.jpg", "ingest_status": PENDING, **values}
+            for i in range(n)])
+    with SessionLocal() as db:
+        return [image_id for (image_id,) in db.query(Image.id).order_by(Image.id)]
+
+
+def statuses():
+    with SessionLocal() as db:
+        return {image.id: job_status(image) for image in db.query(Image)}
+
+
+def test_claim_takes_each_pending_row_once(empty_db):
+    ids = queue_images(empty_db, 5)
+    with SessionLocal() as db:
+        first = [image.id for image in claim(db, limit=3)]
+        second = [image.id for image in claim(db, limit=3)]
+        assert claim(db, limit=3) == []
+    assert first == ids[:3] and second == ids[3:]
+    assert {s["status"] for s in statuses().values()} == {PROCESSING}
+
+
+def test_stale_claims_are_taken_again(empty_db):
+    stale = datetime.utcnow() - timedelta(seconds=120)
+    ids = queue_images(empty_db, 2, ingest_status=PROCESSING, ingest_claimed_at=stale)
+    with SessionLocal() as db:
+        # Claimed a minute ago by a worker that is presumably still alive
+        assert claim(db, claim_timeout=600) == []
+        assert [image.id for image in claim(db, claim_timeout=60)] == ids
+        assert claim(db, claim_timeout=60) == []
+
+
+class FakeBatcher:
+    """Resolves each submit() at once with features, or the exception queued for those bytes."""
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+
+    def submit(self, data, key=None):
+        future = Future()
+        outcome = self.outcomes[data]
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+        return future
+
+
+def test_worker_embeds_and_reports_failures_without_internals(empty_db, monkeypatch, capsys):
+    ids = queue_images(empty_db, 4)
+    feats = np.random.default_rng(0).standard_normal((2, DIM)).astype(np.float32)
+    objects = {f"a/{n}.jpg": f"bytes{n}".encode() for n in range(4)}
+
+    def download(s3_key):
+        if s3_key == "a/3.jpg":
+            raise RuntimeError("An error occurred (AccessDenied) calling GetObject: bucket internals")
+        return objects[s3_key]
+
+    monkeypatch.setattr(ingest_queue, "download_bytes_from_s3", download)
+    batcher = FakeBatcher({b"bytes0": feats[0], b"bytes1": feats[1],
+                           b"bytes2": OSError("cannot identify image file <_io.BytesIO object at 0x7f>")})
+    manager = FaissIndexManager(vectors_path="")
+    worker = IngestWorker(batcher, EmbeddingPipeline(), manager)
+    assert worker.run_once() == 4
+
+    status = statuses()
+    assert [status[i]["status"] for i in ids] == ["done", "done", FAILED, FAILED]
+    assert status[ids[2]]["error"] == NOT_AN_IMAGE
+    assert status[ids[3]]["error"] == DOWNLOAD_FAILED
+    assert len(manager) == 2 and (worker.embedded, worker.failed) == (2, 2)
+    # The details are logged for operators
+    log = capsys.readouterr().out
+    assert "AccessDenied" in log and "cannot identify image file" in log
+
+
+def test_unexpected_extraction_error_is_not_echoed(empty_db, monkeypatch):
+    [image_id] = queue_images(empty_db, 1)
+    monkeypatch.setattr(ingest_queue, "download_bytes_from_s3", lambda s3_key: b"data")
+    worker = IngestWorker(FakeBatcher({b"data": RuntimeError("CUDA out of memory at 0xdeadbeef")}),
+                          EmbeddingPipeline(), FaissIndexManager(vectors_path=""))
+    worker.run_once()
+    assert statuses()[image_id]["error"] == EXTRACTION_FAILED
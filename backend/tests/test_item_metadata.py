@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+from src import app as api
+from src.db import Item
+from src.index_manager import FaissIndexManager
+
+
+def test_metadata_update_while_loading_reaches_the_attribute_index(empty_db, monkeypatch):
+    with empty_db.begin() as conn:
+        conn.execute(Item.__table__.insert(), [{"id": "a", "name": "a", "meta_text": "color: red"}])
+    for name in ("extractor", "batcher", "embedding_pipeline", "index_manager", "ingest_worker"):
+        monkeypatch.setattr(api, name, None)
+    monkeypatch.setattr(api, "startup_status", dict(api.startup_status))
+    client = TestClient(api.app)  # not entered: the startup hook doesn't load anything
+
+    loaded = FaissIndexManager(vectors_path="")
+
+    def load_index(pipeline):
+        # The update lands after the index read the old meta_text from the database
+        loaded.build()
+        response = client.post("/item/a/metadata", json="color: blue")
+        assert response.json()["status"] == "updated"
+        return loaded
+
+    monkeypatch.setattr(api, "_load_index", load_index)
+    monkeypatch.setattr(api, "_load_extractor", lambda: SimpleNamespace(backend="fake"))
+    api.load_models()
+    try:
+        assert api.index_manager is loaded
+        assert api.pending_attributes == {}
+        assert loaded.attributes.item_attributes["a"] == {("color", "blue")}
+    finally:
+        api.batcher.stop()
@@ -0,0 +1,55 @@
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src.app import app
+from src.db import Item
+
+
+@pytest.fixture
+def client(empty_db):
+    # Created at 00:00..00:06, two of them at the same time to exercise the id tie-break
+    start = datetime(2024, 1, 1)
+    rows = [{"id": f"item{n}", "name": f"Item {n}", "created_at": start + timedelta(minutes=min(n, 5))}
+            for n in range(7)]
+    with empty_db.begin() as conn:
+        conn.execute(Item.__table__.insert(), rows)
+    # Not entered as a context manager: listing items doesn't need the model or index loaded
+    return TestClient(app)
+
+
+def all_pages(client, url, limit):
+    ids, cursor = [], None
+    while True:
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+        body = client.get(url, params=params).json()
+        assert len(body["items"]) <= limit
+        ids += [item["item_id"] for item in body["items"]]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return ids
+
+
+def test_items_pages_oldest_first(client):
+    assert all_pages(client, "/items/", 2) == [f"item{n}" for n in range(7)]
+
+
+def test_recent_items_pages_newest_first(client):
+    assert all_pages(client, "/items/recent", 3) == [f"item{n}" for n in reversed(range(7))]
+
+
+def test_items_without_limit_returns_everything(client):
+    body = client.get("/items/").json()
+    assert len(body["items"]) == 7
+    assert body["next_cursor"] is None
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", base64.urlsafe_b64encode(b'["yesterday", "item1"]').decode(),
+                                    base64.urlsafe_b64encode(b"[1]").decode()])
+def test_invalid_cursor_is_400(client, cursor):
+    for url in ("/items/", "/items/recent"):
+        response = client.get(url, params={"limit": 2, "cursor": cursor})
+        assert response.status_code == 400
+        assert response.json() == {"error": "Invalid cursor"}
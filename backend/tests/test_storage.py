@@ -0,0 +1,68 @@
+import pytest
+
+from src import storage
+from src.storage import PresignedUrlCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(storage.time, "monotonic", clock)
+    return clock
+
+
+def test_cached_url_expires_after_its_share_of_the_lifetime(clock):
+    cache = PresignedUrlCache(ttl_fraction=0.5)
+    cache.put("a/1.jpg", 3600, "url-1")
+    clock.now += 1799
+    assert cache.get("a/1.jpg", 3600) == "url-1"
+    # Another lifetime is another URL
+    assert cache.get("a/1.jpg", 60) is None
+    clock.now += 2
+    assert cache.get("a/1.jpg", 3600) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_cache_evicts_least_recently_used_and_invalidates(clock):
+    cache = PresignedUrlCache(max_size=2)
+    cache.put("a", 3600, "url-a")
+    cache.put("b", 3600, "url-b")
+    cache.get("a", 3600)
+    cache.put("c", 3600, "url-c")
+    assert list(cache.entries) == ["a", "c"]
+    cache.invalidate("a")
+    assert cache.get("a", 3600) is None
+
+
+class FakeS3:
+    def __init__(self):
+        self.signed = 0
+        self.deleted = []
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        self.signed += 1
+        return f"https://s3/{Params['Key']}?expires={ExpiresIn}&n={self.signed}"
+
+    def delete_object(self, Bucket, Key):
+        self.deleted.append(Key)
+
+
+def test_generate_presigned_url_signs_once_until_expiry_or_delete(clock, monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(storage, "s3_client", s3)
+    monkeypatch.setattr(storage, "presigned_url_cache", PresignedUrlCache(ttl_fraction=0.5))
+    first = storage.generate_presigned_url("a/1.jpg")
+    assert storage.generate_presigned_url("a/1.jpg") == first and s3.signed == 1
+    clock.now += 1801
+    assert storage.generate_presigned_url("a/1.jpg") != first and s3.signed == 2
+    storage.delete_file_from_s3("a/1.jpg")
+    storage.generate_presigned_url("a/1.jpg")
+    assert s3.signed == 3 and s3.deleted == ["a/1.jpg"]
@@ -0,0 +1,70 @@
+import io
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.app import app
+from src.metrics import HTTP_REQUEST_SECONDS
+from src.uploads import RequestSizeLimit, UploadTooLarge, scan_upload
+
+LIMIT = 1024
+
+
+def chunks(total, size=256):
+    """A body without Content-Length: httpx sends a generator chunked."""
+    for start in range(0, total, size):
+        yield b"x" * min(size, total - start)
+
+
+@pytest.fixture
+def echo_client():
+    echo = FastAPI()
+
+    @echo.post("/echo")
+    async def read_body(request: Request):
+        return {"received": len(await request.body())}
+
+    echo.add_middleware(RequestSizeLimit, max_bytes=LIMIT)
+    return TestClient(echo)
+
+
+def test_body_within_limit_is_passed_through(echo_client):
+    assert echo_client.post("/echo", content=b"x" * LIMIT).json() == {"received": LIMIT}
+    assert echo_client.post("/echo", content=chunks(LIMIT)).json() == {"received": LIMIT}
+
+
+def test_declared_length_over_limit_is_refused(echo_client):
+    response = echo_client.post("/echo", content=b"x" * (LIMIT + 1))
+    assert response.status_code == 413
+    assert str(LIMIT) in response.json()["error"]
+
+
+def test_chunked_body_over_limit_is_refused(echo_client):
+    response = echo_client.post("/echo", content=chunks(4 * LIMIT))
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("body", [lambda n: b"x" * n, chunks], ids=["content-length", "chunked"])
+def test_refused_request_is_seen_by_cors_and_metrics(empty_db, body):
+    client = TestClient(app)
+
+    def refused():
+        return sum(series[2] for key, series in HTTP_REQUEST_SECONDS.series.items() if key[-1] == "413")
+
+    before = refused()
+    # A multipart type, so /query/ reads the chunked body while parsing its form
+    headers = {"Origin": "https://shop.example", "Content-Type": "multipart/form-data; boundary=b"}
+    response = client.post("/query/", content=body(2 * 1024 * 1024), headers=headers)
+    assert response.status_code == 413
+    assert response.headers["access-control-allow-origin"] in ("*", "https://shop.example")
+    assert refused() == before + 1
+
+
+def test_scan_upload_hashes_and_rewinds():
+    f = io.BytesIO(b"abc" * 100)
+    digest, size = scan_upload(f, max_bytes=300, chunk_size=7)
+    assert size == 300 and f.tell() == 0
+    assert scan_upload(io.BytesIO(b"abc" * 100), chunk_size=300)[0] == digest
+    with pytest.raises(UploadTooLarge):
+        scan_upload(io.BytesIO(b"x" * 301), max_bytes=300, chunk_size=7)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from src.vector_store import ExactVectorStore, rerank_factor
+
+DIM = 4
+
+
+def rows(ids, seed=0):
+    return np.random.default_rng(seed).standard_normal((len(ids), DIM)).astype(np.float32)
+
+
+def test_vectors_are_kept_by_image_id_across_reopen(tmp_path):
+    path = str(tmp_path / "vectors.f32")
+    store = ExactVectorStore(path)
+    assert not store.open(DIM, "v1")
+    ids = np.array([3, 7, 5000])  # 5000 is past the initial capacity
+    vecs = rows(ids)
+    store.put(ids, vecs)
+    store.discard([7])
+    store.flush()
+
+    reopened = ExactVectorStore(path)
+    assert reopened.open(DIM, "v1")
+    found_vecs, found = reopened.get([3, 7, 5000, 9, 10 ** 6])
+    assert found.tolist() == [True, False, True, False, False]
+    np.testing.assert_array_equal(found_vecs[[0, 2]], vecs[[0, 2]])
+    assert not found_vecs[[1, 3, 4]].any()
+    assert reopened.missing([3, 7, 9]).tolist() == [7, 9]
+    assert reopened.stats()["rows"] == 2
+
+
+def test_other_version_starts_empty(tmp_path):
+    path = str(tmp_path / "vectors.f32")
+    store = ExactVectorStore(path)
+    store.open(DIM, "v1")
+    store.put([1], rows([1]))
+    store.flush()
+    other = ExactVectorStore(path)
+    assert not other.open(DIM, "v2")
+    assert other.missing([1]).tolist() == [1]
+
+
+def test_rebuild_replaces_the_store_without_leaving_temp_files(tmp_path):
+    path = str(tmp_path / "vectors.f32")
+    store = ExactVectorStore(path)
+    store.open(DIM, "v1")
+    store.put([1, 2], rows([1, 2]))
+    vecs = rows([2, 4], seed=1)
+    store.rebuild([2, 4], vecs, DIM, "v1")
+    found_vecs, found = store.get([1, 2, 4])
+    assert found.tolist() == [False, True, True]
+    np.testing.assert_array_equal(found_vecs[1:], vecs)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["vectors.f32", "vectors.f32.json", "vectors.f32.mask"]
+
+
+def test_rerank_factor_is_clamped(monkeypatch):
+    import src.vector_store as vector_store
+    monkeypatch.setattr(vector_store, "RERANK_MAX_FACTOR", 8)
+    assert rerank_factor(-1) == 0
+    assert rerank_factor(4) == 4
+    assert rerank_factor(100) == 8